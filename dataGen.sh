@@ -1,5 +1,6 @@
 #!/bin/bash
+#Usage: ./dataGen.sh N [DataGen.py args], e.g. ./dataGen.sh 3 medium --workers 8
 
 for i in $(seq 1 $1); do
-	python ./src/DataGen.py
+	python ./src/DataGen.py "${@:2}"
 done
@@ -0,0 +1,148 @@
+#Noisy simulation with an adaptive shot count.
+#Backends are simulated in rounds of BATCH_SHOTS shots. After every round
+#the confidence intervals of PST, TVD and fitness are re-estimated, and a
+#backend stops once its intervals are narrower than CI_WIDTH or, with TOP_K
+#set, once its fitness upper bound is below the k-th best lower bound.
+import numpy as np
+
+import EvalMetrics as EM
+import QUtil
+import NoiseCache
+import IdealCache
+import TranspileCache
+
+BATCH_SHOTS = 256
+MAX_SHOTS = 8192
+
+#Never stop on fewer shots, small batches give overconfident intervals
+MIN_SHOTS = 2*BATCH_SHOTS
+
+#Target interval width, absolute for PST/TVD and relative for fitness (but
+#never narrower than CI_WIDTH, fitness near zero has no useful relative width)
+CI_WIDTH = 0.05
+
+#Only rank the best TOP_K backends confidently, None to converge all
+TOP_K = None
+
+CONFIDENCE = 0.95
+
+#Resampled distributions per TVD/fitness interval
+BOOTSTRAP = 200
+
+#Two sided normal quantile of CONFIDENCE
+_Z = {0.9: 1.645, 0.95: 1.960, 0.99: 2.576}
+
+
+def _wilson(successes, n, z):
+    """Wilson score interval of a proportion, not degenerate at 0 or 1"""
+    p = successes/n
+    center = (p + z*z/(2*n))/(1 + z*z/n)
+    half = z*np.sqrt(p*(1 - p)/n + z*z/(4*n*n))/(1 + z*z/n)
+
+    return float(center - half), float(center + half)
+
+
+def getIntervals(idealCounts, counts, swaps, rng):
+    """Metric estimates of the counts so far and their confidence intervals"""
+    ideal, noisy, in_ideal, in_noisy = EM.alignCounts(idealCounts, [counts])
+    estimates = EM.computeMetricsArrays(ideal, noisy, in_ideal, in_noisy, swaps)
+    estimates = {k: float(v[0]) for k, v in estimates.items()}
+
+    #Bootstrap by resampling the observed distribution, scored in one call
+    shots = int(noisy.sum())
+    samples = rng.multinomial(shots, noisy[0]/shots, size=BOOTSTRAP).astype(np.float64)
+    boot = EM.computeMetricsArrays(ideal, samples, in_ideal, samples > 0, swaps)
+
+    alpha = (1 - CONFIDENCE)/2
+    intervals = {}
+    for m in ["TVD", "Fitness"]:
+        intervals[m] = (float(np.quantile(boot[m], alpha)),
+                        float(np.quantile(boot[m], 1 - alpha)))
+
+    #PST is a proportion of shots, so it has an exact interval
+    intervals["PST"] = _wilson(estimates["PST"]*shots, shots, _Z.get(CONFIDENCE, 1.960))
+
+    return estimates, intervals
+
+
+def _isConverged(run, ciWidth) -> bool:
+    intervals = run["intervals"]
+    fitness = abs(run["estimates"]["Fitness"])
+
+    return intervals["PST"][1] - intervals["PST"][0] <= ciWidth \
+        and intervals["TVD"][1] - intervals["TVD"][0] <= ciWidth \
+        and intervals["Fitness"][1] - intervals["Fitness"][0] <= max(ciWidth*fitness, ciWidth)
+
+
+def simCircuits(qc, profiles, optimizationLevel=0, topK=None, ciWidth=None,
+                batchShots=None, maxShots=None, seed=None) -> dict:
+    """
+    simCircuit() over several backends with adaptive shots, returns
+    {backend name: outDict} with the intervals, shots and stop reason added.
+    """
+    from qiskit import Aer
+
+    topK = topK if topK is not None else TOP_K
+    ciWidth = ciWidth if ciWidth is not None else CI_WIDTH
+    batchShots = batchShots or BATCH_SHOTS
+    #No backend stops before MIN_SHOTS, so a lower limit could not hold
+    minShots = max(MIN_SHOTS, 2*batchShots)
+    maxShots = max(maxShots or MAX_SHOTS, minShots)
+    rng = np.random.default_rng(seed)
+
+    idealCounts = IdealCache.getIdealCounts(qc, QUtil.MAX_JOBS)
+
+    runs = []
+    for profile in profiles:
+        swaps = QUtil.getSwapCount(qc, profile, optimizationLevel)
+
+        #Transpiler threw an error and we couldn't route circuit
+        if swaps == None:
+            continue
+
+        runs.append({"profile": profile, "swaps": swaps, "counts": {}, "shots": 0,
+                     "stop": None, "estimates": None, "intervals": None,
+                     "qc": TranspileCache.getTranspiled(
+                         qc, optimizationLevel=optimizationLevel, profile=profile)})
+
+    simulator = Aer.get_backend('qasm_simulator')
+    while any(r["stop"] is None for r in runs):
+        active = [r for r in runs if r["stop"] is None]
+        for r in active:
+            result = simulator.run(r["qc"], shots=batchShots,
+                                   noise_model=NoiseCache.getNoiseModel(r["profile"]),
+                                   max_parallel_threads=QUtil.MAX_JOBS).result()
+            for k, v in result.get_counts().items():
+                r["counts"][k] = r["counts"].get(k, 0) + v
+            r["shots"] += batchShots
+
+            r["estimates"], r["intervals"] = getIntervals(
+                idealCounts, r["counts"], r["swaps"], rng)
+
+        #k-th best fitness lower bound, anything certainly below is out
+        cutoff = None
+        if topK is not None and len(runs) > topK:
+            lower = sorted([r["intervals"]["Fitness"][0] for r in runs], reverse=True)
+            cutoff = lower[topK - 1]
+
+        for r in active:
+            if r["shots"] < minShots:
+                continue
+
+            if _isConverged(r, ciWidth):
+                r["stop"] = "converged"
+            elif cutoff is not None and r["intervals"]["Fitness"][1] < cutoff:
+                r["stop"] = "dismissed"
+            elif r["shots"] >= maxShots:
+                r["stop"] = "max_shots"
+
+    results = {}
+    for r in runs:
+        outDict = {"Swaps": r["swaps"], **r["estimates"]}
+        for m, interval in r["intervals"].items():
+            outDict[m + "CI"] = list(interval)
+        outDict["Shots"] = r["shots"]
+        outDict["Stop"] = r["stop"]
+        results[r["profile"].name] = outDict
+
+    return results
@@ -0,0 +1,262 @@
+#Persistent store of precomputed fake backend profiles.
+#Built once with `python ./src/BackendStore.py` (or lazily on first query)
+#and reused by every later run instead of re-instantiating each backend.
+from os.path import exists, join
+import numpy as np
+import networkx
+import qiskit
+import json
+import sys
+import os
+import re
+
+import QUtil
+import CalibrationStore
+
+STORE_DIR = "./backend_profiles/"
+INDEX_FILE = "index.json"
+STORE_VERSION = 1
+
+#Success table row holding readout success, placed after the basis gates
+MEASURE = "measure"
+
+PROFILES = []
+GLOBAL_BASIS_GATES = None
+
+#Calibration CSV directory applied by load(), None keeps the qiskit calibrations
+CALIBRATION_DIR = None
+
+
+class BackendProfile:
+    """Static description of a backend, usable without instantiating it"""
+
+    def __init__(self, entry, storeDir):
+        self.name = entry["name"]
+        self.className = entry["className"]
+        self.timestamp = entry["timestamp"]
+        self.numQubits = entry["numQubits"]
+        self.basisGates = entry["basisGates"]
+        self.couplingMap = entry["couplingMap"]
+        self.avgDegree = entry["avgDegree"]
+        self.measureSuccess = entry["measureSuccess"]
+        self.gateSuccess = entry["gateSuccess"]
+        self.topology = entry["topology"]
+        self.gateIds = entry["gateIds"]
+
+        self._tablePath = join(storeDir, entry["table"])
+        self._table = None
+        self._backend = None
+
+        #CalibrationStore snapshot replacing the fake backend's errors, if any
+        self.calibration = None
+
+    @property
+    def key(self) -> str:
+        return "{}@{}".format(self.name, self.timestamp)
+
+    def getSuccessTable(self) -> np.ndarray:
+        """Success probability indexed by (gate id, qubit 0, qubit 1)"""
+        if self._table is None:
+            self._table = np.load(self._tablePath, mmap_mode='r')
+        return self._table
+
+    def getBackend(self):
+        """Instantiate the qiskit backend, only for modes that need one"""
+        if self._backend is None:
+            self._backend = getattr(QUtil.getBackendsModule(), self.className)()
+        return self._backend
+
+    def getTopologyMetrics(self, label: str) -> dict:
+        """Machine graph metrics named as getGraphMetrics(graph, label) would"""
+        if self.topology is None:
+            raise RuntimeError(
+                "No topology metrics for backend {}".format(self.name))
+
+        return {label + k: v for k, v in self.topology.items()}
+
+    def setCalibration(self, timestamp: str, table: np.ndarray,
+                       measureSuccess: float, gateSuccess: dict,
+                       calibration=None) -> None:
+        """Replace the error data, e.g. with a CalibrationStore snapshot"""
+        #A new timestamp gives a new key, so per-key caches keep them apart
+        self.timestamp = timestamp
+        self.measureSuccess = measureSuccess
+        self.gateSuccess = gateSuccess
+        self.calibration = calibration
+        self._table = table
+
+    def getNoiseBackend(self):
+        """Backend whose properties NoiseModel.from_backend() should read"""
+        if self.calibration is None:
+            return self.getBackend()
+        return CalibrationStore.calibrateBackend(self.getBackend(), self.calibration)
+
+
+def _fileSafe(s: str) -> str:
+    return re.sub(r'[^0-9A-Za-z]', '-', s)
+
+
+def _getTopology(couplingMap) -> dict:
+    graph = networkx.DiGraph()
+    graph.add_edges_from(couplingMap or [])
+
+    #Single qubit devices have no graph to measure
+    try:
+        return QUtil.getGraphMetrics(graph, '')
+    except ValueError:
+        return None
+
+
+def _buildSuccessTable(noise, gateIds: dict, n: int) -> np.ndarray:
+    """Same success probabilities QUtil.getESP used to read per instruction"""
+    table = np.ones((len(gateIds), n, n))
+
+    for gate in noise._noise_instructions:
+        if gate == MEASURE or gate not in gateIds:
+            continue
+
+        for qb, qe in noise._local_quantum_errors.get(gate, {}).items():
+            #Assume that highest probability is for success
+            table[gateIds[gate], qb[0], qb[-1]] = max(qe.probabilities)
+
+    for qb, qe in noise._local_readout_errors.items():
+        m0e = qe.probabilities[0][0]
+        m1e = qe.probabilities[1][1]
+        table[gateIds[MEASURE], qb[0], qb[0]] = (m0e + m1e)/2
+
+    return table
+
+
+def _buildEntry(className: str, backend, gateIds: dict, storeDir: str) -> dict:
+    from qiskit.providers.aer.noise import NoiseModel
+
+    config = backend.configuration()
+    properties = backend.properties()
+
+    timestamp = "none"
+    if properties is not None:
+        timestamp = properties.last_update_date.isoformat()
+
+    noise = NoiseModel.from_backend(backend)
+
+    entry = {}
+    entry["name"] = config.backend_name
+    entry["className"] = className
+    entry["timestamp"] = timestamp
+    entry["numQubits"] = config.n_qubits
+    entry["basisGates"] = config.basis_gates
+    entry["couplingMap"] = config.coupling_map
+    entry["avgDegree"] = QUtil.getAverageDegree(config.coupling_map)
+    entry["measureSuccess"] = QUtil.getAvgMeasurementSuccess(noise)
+    entry["gateSuccess"] = QUtil.getAvgGateSuccess(noise)
+    entry["topology"] = _getTopology(config.coupling_map)
+    entry["gateIds"] = gateIds
+    entry["table"] = "{}_{}.npy".format(
+        entry["name"], _fileSafe(timestamp))
+
+    table = _buildSuccessTable(noise, gateIds, config.n_qubits)
+    np.save(join(storeDir, entry["table"]), table)
+
+    return entry
+
+
+def build(storeDir=STORE_DIR) -> dict:
+    """Instantiate every fake backend once and persist its profile"""
+    os.makedirs(storeDir, exist_ok=True)
+
+    backends = QUtil.extractBackends(withNames=True)
+
+    basisGates = set()
+    for className, be in backends:
+        basisGates.update(be.configuration().basis_gates)
+    globalBasisGates = sorted(basisGates)
+    QUtil.GLOBAL_BASIS_GATES = globalBasisGates
+
+    gateIds = {g: i for i, g in enumerate(globalBasisGates + [MEASURE])}
+
+    index = {}
+    index["version"] = STORE_VERSION
+    index["qiskit"] = qiskit.__version__
+    index["globalBasisGates"] = globalBasisGates
+    index["backends"] = []
+    for className, be in backends:
+        print("Profiling", be.configuration().backend_name, "...")
+        index["backends"].append(
+            _buildEntry(className, be, gateIds, storeDir))
+
+    #Write index last so a partial build is never picked up
+    tmpPath = join(storeDir, INDEX_FILE + ".tmp")
+    with open(tmpPath, 'w') as f:
+        json.dump(index, f, default=float)
+    os.replace(tmpPath, join(storeDir, INDEX_FILE))
+
+    return index
+
+
+def load(storeDir=STORE_DIR, rebuild=False, calibrationDir=None) -> None:
+    """
+    Load profiles from disk, building the store if missing or stale.
+    Calibration CSVs in calibrationDir (or CALIBRATION_DIR) replace the error
+    data of the backends they name.
+    """
+    global PROFILES, GLOBAL_BASIS_GATES
+
+    index = None
+    indexPath = join(storeDir, INDEX_FILE)
+    if not rebuild and exists(indexPath):
+        with open(indexPath) as f:
+            index = json.load(f)
+
+        #Calibrations ship with qiskit, a new version may change them
+        if index.get("version") != STORE_VERSION \
+                or index.get("qiskit") != qiskit.__version__:
+            index = None
+
+    if index is None:
+        index = build(storeDir)
+
+    GLOBAL_BASIS_GATES = index["globalBasisGates"]
+    QUtil.GLOBAL_BASIS_GATES = GLOBAL_BASIS_GATES
+    PROFILES = [BackendProfile(e, storeDir) for e in index["backends"]]
+
+    calibrationDir = calibrationDir or CALIBRATION_DIR
+    if calibrationDir is not None:
+        applied = CalibrationStore.apply(
+            PROFILES, GLOBAL_BASIS_GATES, calibrationDir)
+        sys.stderr.write("Applied calibrations of {}\n".format(", ".join(applied) or "no backends"))
+
+
+def getProfile(name: str, timestamp=None) -> BackendProfile:
+    if not PROFILES:
+        load()
+
+    for profile in PROFILES:
+        if profile.name == name and timestamp in (None, profile.timestamp):
+            return profile
+
+    raise KeyError("No profile for backend {}".format(name))
+
+
+def getProfiles(qc, n) -> list:
+    """Stored equivalent of picking the n smallest backends that fit qc"""
+    if not PROFILES:
+        load()
+
+    #Filter out backends with too few qubits for circuit
+    lb = qc.num_qubits
+    profiles = list(filter(lambda p: p.numQubits >= lb, PROFILES))
+
+    #Sort backends by qubit count
+    profiles = list(sorted(profiles, key=lambda p: p.numQubits))
+
+    #Return first n backends, all of them for n=None
+    return profiles[:n]
+
+
+def main():
+    load(rebuild=True)
+    print("Stored {} backend profiles in {}".format(len(PROFILES), STORE_DIR))
+
+
+if __name__ == "__main__":
+    main()
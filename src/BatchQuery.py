@@ -0,0 +1,155 @@
+#Scores many QASM files in one process.
+#Circuits come from directories, glob patterns or a manifest (one path per
+#line). Backend profiles and predictors are loaded once and every
+#(circuit, backend, mode) record is written as a JSON line when computed.
+#
+#  python ./src/BatchQuery.py ./qasm/ --modes esp p2 --sink scores.parquet
+from contextlib import redirect_stdout
+from os.path import isdir, join
+import argparse
+import glob
+import json
+import sys
+import os
+
+import Est
+import BackendStore
+import QasmCache
+
+
+def expandInputs(paths, manifest=None) -> list:
+    """QASM files named by paths (files, dirs, globs) and a manifest, in order"""
+    if manifest is not None:
+        with open(manifest) as f:
+            paths = list(paths) + [l.strip() for l in f
+                                   if l.strip() and not l.startswith("#")]
+
+    files = []
+    for p in paths:
+        if isdir(p):
+            found = []
+            for root, _, names in os.walk(p):
+                found += [join(root, n) for n in names if n.endswith(".qasm")]
+            files += sorted(found)
+        elif glob.has_magic(p):
+            files += sorted(glob.glob(p, recursive=True))
+        else:
+            files.append(p)
+
+    #Keep first occurrence so overlapping inputs are scored once
+    return list(dict.fromkeys(files))
+
+
+def scoreCircuit(qasmFile, modes, n=None, jobs=1):
+    """
+    Yields one record per (backend, mode) of a circuit as it is computed.
+    n=None queries 10 backends, every fitting one in cascade mode, as Est.py.
+    """
+    try:
+        qc = QasmCache.getCircuit(qasmFile)
+    except Exception as e:
+        yield {"circuit": qasmFile, "error": repr(e)}
+        return
+    qc.name = qasmFile
+
+    for mode in modes:
+        count = n
+        if count is None and mode != "cascade":
+            count = 10
+        backends = BackendStore.getProfiles(qc, count)
+
+        #ML, adaptive and cascade modes rank all backends together, the others run per backend
+        if mode in Est.MODE_FEATURES or mode in ["adaptive", "cascade"] or jobs > 1:
+            groups = [backends]
+        else:
+            groups = [[b] for b in backends]
+
+        for group in groups:
+            try:
+                #eval functions log progress on stdout, keep it for records
+                with redirect_stdout(sys.stderr):
+                    resultDict, execTimes = Est.runQuery(qc, group, mode, jobs)
+            except Exception as e:
+                yield {"circuit": qasmFile, "mode": mode,
+                       "backends": [b.name for b in group], "error": repr(e)}
+                continue
+
+            for record in Est.getRecords(mode, resultDict):
+                record["time"] = [t/(10**9) for t in execTimes]
+                yield record
+
+
+def writeSink(records, path) -> None:
+    import pandas as pd
+
+    df = pd.DataFrame(records)
+    #Flat columns only, swap_compare reports predict and compile time
+    df["time"] = df["time"].map(sum)
+    if path.endswith(".parquet"):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Query Quarry for many QASM files, streaming JSON lines.")
+    parser.add_argument(
+        'inputs', type=str, nargs='*', help='QASM files, directories or glob patterns.')
+    parser.add_argument(
+        '--manifest', type=str, help='File listing one QASM path per line.', default=None)
+    parser.add_argument(
+        '--modes', type=str, nargs='+', help='Query modes to run per circuit. (Default esp)', default=["esp"])
+    parser.add_argument(
+        '--n', type=int, help='Number of backend platforms to test on. (Default 10, every fitting backend in cascade mode)', default=None)
+    parser.add_argument(
+        '--jobs', type=int, help='Number of worker processes to query backends with. (Default 1)', default=1)
+    parser.add_argument(
+        '--out', type=str, help='JSON lines output file. (Default stdout)', default=None)
+    parser.add_argument(
+        '--sink', type=str, help='Also write all records to a .parquet or .csv file.', default=None)
+
+    args = parser.parse_args()
+
+    modes = [m.lower() for m in args.modes]
+    for mode in modes:
+        if mode not in Est.MODES:
+            parser.error("Unknown mode {}".format(mode))
+
+    files = expandInputs(args.inputs, args.manifest)
+    if not files:
+        parser.error("No QASM files given")
+
+    #Single context for the whole corpus
+    BackendStore.load()
+    for mode in modes:
+        if mode in Est.MODE_FEATURES:
+            Est.getPredictor(Est.MODE_FEATURES[mode][1])
+
+    out = open(args.out, 'w') if args.out is not None else sys.stdout
+    records = []
+    errors = 0
+    try:
+        for i, qasmFile in enumerate(files):
+            sys.stderr.write("[{}/{}] {}\n".format(i + 1, len(files), qasmFile))
+            for record in scoreCircuit(qasmFile, modes, args.n, args.jobs):
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+
+                if "error" in record:
+                    errors += 1
+                elif args.sink is not None:
+                    records.append(record)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if args.sink is not None and records:
+        writeSink(records, args.sink)
+
+    sys.stderr.write("Scored {} circuits, {} failed queries\n".format(
+        len(files), errors))
+
+
+if __name__ == "__main__":
+    main()
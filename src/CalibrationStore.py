@@ -0,0 +1,258 @@
+#Backend error tables read from calibration CSV snapshots.
+#The calibration_data/ CSVs (IBM Quantum device exports) hold per qubit
+#readout and single qubit gate errors, and per edge CNOT errors in
+#"0_1:1.779e-2; 0_2:..." cells. They are turned into the success table of a
+#BackendStore profile, 1 - error per (gate, qubit, qubit), and the average
+#success features of P2, without building a backend or a NoiseModel.
+#Simulations get the same errors through calibrateBackend(), a fake backend
+#whose properties carry the CSV values.
+#Blank cells are unknown errors, not zero ones: those entries keep the
+#profile's fake backend values, and a warning is written to stderr.
+from os.path import basename, join
+import numpy as np
+import datetime
+import hashlib
+import copy
+import csv
+import sys
+import os
+
+CALIBRATION_DIR = "./calibration_data/"
+FILE_SUFFIX = "_calibrations.csv"
+
+#Error columns per gate, gates without a column are taken as error free
+GATE_COLUMNS = {"id": "ID error",
+                "sx": "√x (sx) error",
+                "x": "Single-qubit Pauli-X error"}
+EDGE_COLUMNS = {"cx": "CNOT error"}
+
+MEASURE = "measure"
+PROB_MEAS0_PREP1 = "Prob meas0 prep1"
+PROB_MEAS1_PREP0 = "Prob meas1 prep0"
+
+#Names of the same errors in qiskit BackendProperties
+GATE_ERROR = "gate_error"
+READOUT_ERROR = "readout_error"
+PROPERTY_MEAS0_PREP1 = "prob_meas0_prep1"
+PROPERTY_MEAS1_PREP0 = "prob_meas1_prep0"
+
+
+def _toFloat(cell):
+    cell = (cell or "").strip()
+    return float(cell) if cell else None
+
+
+def _toArray(rows, column) -> np.ndarray:
+    """Column of every row, nan where the cell is blank"""
+    return np.array([_toFloat(r.get(column)) for r in rows], dtype=np.float64)
+
+
+def parseEdgeCell(cell) -> dict:
+    """'1_3:1.084e-2; 1_2:1.086e-2' -> {(1, 3): 0.01084, (1, 2): 0.01086}"""
+    edges = {}
+    for item in (cell or "").split(";"):
+        if not item.strip():
+            continue
+
+        qubits, value = item.split(":")
+        a, b = qubits.strip().split("_")
+        edges[(int(a), int(b))] = float(value)
+
+    return edges
+
+
+def getBackendName(path) -> str:
+    """ibmq_belem_calibrations.csv -> fake_belem, the matching profile name"""
+    device = basename(path)[:-len(FILE_SUFFIX)]
+    for prefix in ["ibmq_", "ibm_"]:
+        if device.startswith(prefix):
+            device = device[len(prefix):]
+
+    return "fake_" + device
+
+
+def readCalibration(path) -> dict:
+    """Per gate error arrays of one calibration CSV"""
+    with open(path, 'rb') as f:
+        source = f.read()
+    rows = list(csv.reader(source.decode('utf-8').splitlines()))
+
+    #Profile keys carry the timestamp, the content hash tells edited files apart
+    timestamp = "{}-{}".format(
+        datetime.datetime.fromtimestamp(os.stat(path).st_mtime).isoformat(),
+        hashlib.sha256(source).hexdigest()[:12])
+
+    #Exported headers carry trailing spaces
+    header = [h.strip() for h in rows[0]]
+    rows = [dict(zip(header, r)) for r in rows[1:] if r]
+    n = len(rows)
+
+    calibration = {"name": getBackendName(path), "numQubits": n,
+                   "timestamp": timestamp, "gates": {}, "edges": {}, "missing": 0}
+
+    p10 = _toArray(rows, PROB_MEAS1_PREP0)
+    p01 = _toArray(rows, PROB_MEAS0_PREP1)
+    calibration["readout"] = (p10, p01)
+    calibration["missing"] += int(np.isnan(p10).sum() + np.isnan(p01).sum())
+
+    for gate, column in GATE_COLUMNS.items():
+        if column in header:
+            calibration["gates"][gate] = _toArray(rows, column)
+            calibration["missing"] += int(np.isnan(calibration["gates"][gate]).sum())
+
+    for gate, column in EDGE_COLUMNS.items():
+        if column in header:
+            edges = {}
+            for r in rows:
+                if not (r[column] or "").strip():
+                    calibration["missing"] += 1
+                edges.update(parseEdgeCell(r[column]))
+            calibration["edges"][gate] = edges
+
+    return calibration
+
+
+def buildSuccessTable(calibration, gateIds: dict, numQubits: int, stored) -> np.ndarray:
+    """
+    Success table laid out like BackendStore._buildSuccessTable(), entries
+    missing from the calibration taken from the stored table.
+    """
+    table = np.ones((len(gateIds), numQubits, numQubits))
+    diagonal = np.arange(calibration["numQubits"])
+
+    for gate, errors in calibration["gates"].items():
+        if gate in gateIds:
+            table[gateIds[gate], diagonal, diagonal] = 1 - errors
+
+    #Edges without a value are unknown, not error free
+    for gate, edges in calibration["edges"].items():
+        if gate in gateIds:
+            table[gateIds[gate]] = np.nan
+            if edges:
+                a, b = zip(*edges.keys())
+                table[gateIds[gate], list(a), list(b)] = 1 - np.array(list(edges.values()))
+
+    p10, p01 = calibration["readout"]
+    table[gateIds[MEASURE], diagonal, diagonal] = ((1 - p10) + (1 - p01))/2
+
+    missing = np.isnan(table)
+    table[missing] = np.asarray(stored)[missing]
+
+    return table
+
+
+def _meanSuccess(errors, default) -> float:
+    """Mean of 1 - errors over the known errors, default if none is known"""
+    known = errors[~np.isnan(errors)]
+    return float(np.mean(1 - known)) if len(known) else default
+
+
+def getAvgSuccess(calibration, globalBasisGates, profile) -> tuple:
+    """
+    measureSuccess and gateSuccess features, as averaged from a NoiseModel,
+    the profile's values where the calibration has none.
+    """
+    p10, p01 = calibration["readout"]
+    measureSuccess = _meanSuccess((p10 + p01)/2, profile.measureSuccess)
+
+    gateSuccess = {}
+    for gate in globalBasisGates:
+        errors = calibration["gates"].get(gate)
+        if errors is None and calibration["edges"].get(gate):
+            errors = np.array(list(calibration["edges"][gate].values()))
+
+        #Gates without errors are not part of a noise model either
+        gateSuccess[gate + "Success"] = 1 if errors is None \
+            else _meanSuccess(errors, profile.gateSuccess.get(gate + "Success", 1))
+
+    return measureSuccess, gateSuccess
+
+
+def _setParameter(parameters: list, name: str, value) -> None:
+    """Set a BackendProperties parameter dict, blank (nan) values keep the stored one"""
+    if value is None or np.isnan(value):
+        return
+
+    for p in parameters:
+        if p["name"] == name:
+            p["value"] = float(value)
+            return
+
+    parameters.append({"name": name, "unit": "", "value": float(value),
+                       "date": parameters[0]["date"]})
+
+
+def calibrateProperties(properties, calibration):
+    """Copy of a backend's BackendProperties with the calibration's errors"""
+    from qiskit.providers.models import BackendProperties
+
+    data = properties.to_dict()
+    for gate in data["gates"]:
+        name, qubits = gate["gate"], tuple(gate["qubits"])
+        if name in calibration["gates"] and len(qubits) == 1:
+            _setParameter(gate["parameters"], GATE_ERROR,
+                          calibration["gates"][name][qubits[0]])
+        elif name in calibration["edges"]:
+            _setParameter(gate["parameters"], GATE_ERROR,
+                          calibration["edges"][name].get(qubits))
+
+    p10, p01 = calibration["readout"]
+    for q, parameters in enumerate(data["qubits"]):
+        _setParameter(parameters, PROPERTY_MEAS1_PREP0, p10[q])
+        _setParameter(parameters, PROPERTY_MEAS0_PREP1, p01[q])
+        _setParameter(parameters, READOUT_ERROR, (p10[q] + p01[q])/2)
+
+    return BackendProperties.from_dict(data)
+
+
+def calibrateBackend(backend, calibration):
+    """
+    Shallow copy of a fake backend reporting the calibration's errors, so
+    NoiseModel.from_backend() simulates what ESP and P2 are computed from.
+    """
+    properties = calibrateProperties(backend.properties(), calibration)
+    calibrated = copy.copy(backend)
+    calibrated.properties = lambda: properties
+
+    return calibrated
+
+
+def loadCalibrations(calibrationDir=CALIBRATION_DIR) -> dict:
+    """Calibrations of every CSV in calibrationDir by backend profile name"""
+    calibrations = {}
+    for f in sorted(os.listdir(calibrationDir)):
+        if f.endswith(FILE_SUFFIX):
+            calibration = readCalibration(join(calibrationDir, f))
+            calibrations[calibration["name"]] = calibration
+
+    return calibrations
+
+
+def apply(profiles, globalBasisGates, calibrationDir=CALIBRATION_DIR) -> list:
+    """Replace the error data of matching profiles, returns their names"""
+    calibrations = loadCalibrations(calibrationDir)
+
+    applied = []
+    for profile in profiles:
+        calibration = calibrations.get(profile.name)
+        if calibration is None:
+            continue
+
+        if calibration["numQubits"] != profile.numQubits:
+            sys.stderr.write("Calibration of {} has {} qubits, backend has {}, skipping\n".format(
+                profile.name, calibration["numQubits"], profile.numQubits))
+            continue
+
+        if calibration["missing"]:
+            sys.stderr.write("Calibration of {} has {} blank cells, keeping the backend's values for them\n".format(
+                profile.name, calibration["missing"]))
+
+        measureSuccess, gateSuccess = getAvgSuccess(calibration, globalBasisGates, profile)
+        profile.setCalibration(
+            calibration["timestamp"],
+            buildSuccessTable(calibration, profile.gateIds, profile.numQubits,
+                              profile.getSuccessTable()),
+            measureSuccess, gateSuccess, calibration)
+        applied.append(profile.name)
+
+    return applied
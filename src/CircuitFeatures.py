@@ -0,0 +1,116 @@
+#Circuit features of the V2 and SWAP inputs from single instruction walks.
+#extract() returns the gate counts and depth of a transpiled circuit in one
+#pass over qc._data, getCxEdges() the CX interaction graph of a circuit in
+#the node and edge order networkx would give, without building the graph.
+#QASMBench metrics are read once per transpiled circuit instead of once per
+#backend, since every backend with the same basis gates shares it.
+from collections import OrderedDict
+import threading
+
+#Instructions that synchronize qubits without adding to the depth
+DIRECTIVES = ["barrier", "snapshot"]
+
+#Cached evaluate_qasm() results
+MAX_ENTRIES = 1024
+
+HITS = 0
+MISSES = 0
+
+_CACHE = OrderedDict()
+_LOCK = threading.RLock()
+
+
+def extract(qc, basisGates) -> dict:
+    """
+    Gate counts as QUtil.getGateCounts() and depth as qc.depth() would
+    compute them, from one walk over the instructions.
+    """
+    from qiskit.circuit import Clbit
+
+    gateCounts = {g: 0 for g in basisGates}
+    gateCounts["reset"] = 0
+    gateCounts["measure"] = 0
+
+    #Depth is stacked like QuantumCircuit.depth(), one level per bit
+    bitIds = {bit: i for i, bit in enumerate(qc.qubits + qc.clbits)}
+    levels = [0]*len(bitIds)
+
+    for instruction, qargs, cargs in qc._data:
+        name = instruction.name
+        ids = [bitIds[b] for b in qargs + cargs]
+        step = 0 if name in DIRECTIVES else 1
+        level = max([levels[i] + step for i in ids], default=0)
+
+        #Conditions also wait on the classical bits they read
+        if instruction.condition:
+            condition = instruction.condition[0]
+            bits = [condition] if isinstance(condition, Clbit) else list(condition)
+            for b in bits:
+                if bitIds[b] not in ids:
+                    ids.append(bitIds[b])
+                    level = max(level, levels[bitIds[b]] + 1)
+
+        for i in ids:
+            levels[i] = level
+
+        #Barriers are not counted, as in getGateCounts()
+        if name == "barrier":
+            continue
+
+        if name.lower() not in gateCounts:
+            print("Unhandled instruction: ", name)
+            raise RuntimeError
+
+        gateCounts[name.lower()] += 1
+
+    return {"gateCounts": gateCounts, "depth": max(levels, default=0)}
+
+
+def getCxEdges(qc):
+    """
+    Nodes and edges of QUtil.getCxGraph(qc), in G.nodes and G.edges order.
+    Edges join the first two qubits of every multi qubit instruction.
+    """
+    adjacency = {}
+    for instruction, qargs, cargs in qc._data:
+        if len(qargs) > 1:
+            u, v = qargs[0]._index, qargs[1]._index
+            adjacency.setdefault(u, {})[v] = None
+            adjacency.setdefault(v, {})[u] = None
+
+    #Graph.edges lists each edge once, from the node added first
+    edges = []
+    seen = set()
+    for u, neighbors in adjacency.items():
+        edges += [(u, v) for v in neighbors if v not in seen]
+        seen.add(u)
+
+    return list(adjacency), edges
+
+
+def getQASMetrics(out_qc, key) -> dict:
+    """QASMBench evaluate_qasm() of out_qc, evaluated once per key"""
+    global HITS, MISSES
+
+    with _LOCK:
+        if key in _CACHE:
+            HITS += 1
+            _CACHE.move_to_end(key)
+            return dict(_CACHE[key])
+
+    import QUtil
+    QB = QUtil.getQASMetricModule()
+
+    MISSES += 1
+    metrics = QB.QASMetric(out_qc.qasm()).evaluate_qasm()
+
+    with _LOCK:
+        _CACHE[key] = metrics
+        while len(_CACHE) > MAX_ENTRIES:
+            _CACHE.popitem(last=False)
+
+    return dict(metrics)
+
+
+def getStats() -> dict:
+    return {"hits": HITS, "misses": MISSES, "entries": len(_CACHE)}
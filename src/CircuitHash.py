@@ -0,0 +1,35 @@
+#Canonical content hash of a circuit, used to key on-disk caches.
+#Only the structure of the circuit is hashed, its name is ignored so the
+#same circuit read from different paths shares cache entries.
+import hashlib
+
+
+def _updateInstructions(h, qc, definitions: dict) -> None:
+    for instruction, qargs, cargs in qc._data:
+        h.update(repr((instruction.name,
+                       [str(p) for p in instruction.params],
+                       [q._index for q in qargs],
+                       [c._index for c in cargs],
+                       str(instruction.condition))).encode())
+
+        #Gate declarations in the QASM file may reuse a name with a
+        #different body, so custom gate bodies are part of the hash
+        if instruction.name not in definitions:
+            definitions[instruction.name] = None
+            if instruction.definition is not None:
+                sub = hashlib.sha256()
+                _updateInstructions(sub, instruction.definition, definitions)
+                definitions[instruction.name] = sub.hexdigest()
+
+            h.update(str(definitions[instruction.name]).encode())
+
+
+def getCircuitHash(qc) -> str:
+    """Hex digest identifying the instructions and registers of qc"""
+    h = hashlib.sha256()
+
+    for reg in qc.qregs + qc.cregs:
+        h.update("{}[{}];".format(reg.name, reg.size).encode())
+
+    _updateInstructions(h, qc, {})
+    return h.hexdigest()
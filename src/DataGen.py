@@ -12,23 +12,29 @@ import matplotlib.pyplot as plt
 
 import pandas as pd
 import QUtil
-
+import BackendStore
+import NoiseCache
+import TranspileCache
+import QasmCache
+import FeatureStore
+import CircuitHash
+import DatasetStore
+from DatasetWriter import DatasetWriter, getOutputFile
+
+from multiprocessing.connection import wait
+import multiprocessing
+import resource
+import argparse
+import json
+import time
 import os
-import sys
-import inspect
-
-currentdir = os.path.dirname(os.path.abspath(
-    inspect.getfile(inspect.currentframe())))
-parentdir = os.path.dirname(currentdir)
-sys.path.insert(0, parentdir)
-import qasm.QASMBench.metrics.OpenQASMetric as QB
 
 
-def genSwapDataEntry(qc, backend) -> DataFrame:
+def genSwapDataEntry(qc, profile) -> DataFrame:
     optimizationLevel = 2
     try:
-        dataEntry = QUtil.getV2Input(qc, backend)
-        swapCount = QUtil.getSwapCount(qc, backend, optimizationLevel)
+        dataEntry = FeatureStore.getFeatures(qc, profile, "v2")
+        swapCount = QUtil.getSwapCount(qc, profile, optimizationLevel)
         if swapCount == None:
             return None
         dataEntry['Swaps'] = swapCount
@@ -40,10 +46,10 @@ def genSwapDataEntry(qc, backend) -> DataFrame:
     return dataEntry
 
 
-def genDataEntry(qc, backend) -> DataFrame:
+def genDataEntry(qc, profile) -> DataFrame:
     optimizationLevel = 0
-    dataEntry = QUtil.getSWAPInput(qc, backend)
-    outEntries = QUtil.simCircuit(qc, backend, optimizationLevel)
+    dataEntry = FeatureStore.getFeatures(qc, profile, "swap")
+    outEntries = QUtil.simCircuit(qc, profile, optimizationLevel)
 
     if outEntries == None:
         return None
@@ -58,15 +64,16 @@ def genDataEntry(qc, backend) -> DataFrame:
     dataEntry['L2'] = outEntries['L2']
     dataEntry['Hellinger'] = outEntries['Hellinger']
 
-    unroll_qc = transpile(
-        qc, optimization_level=optimizationLevel, backend=backend)
-    esp = QUtil.getESP(unroll_qc, NoiseModel.from_backend(backend))
+    unroll_qc = TranspileCache.getTranspiled(
+        qc, basisGates=profile.basisGates, couplingMap=profile.couplingMap,
+        optimizationLevel=optimizationLevel)
+    esp = QUtil.getESP(unroll_qc, profile)
     dataEntry['ESP'] = esp
 
     return dataEntry
 
 
-def genESPHMDataEntry(qc: QuantumCircuit, backend) -> DataFrame:
+def genESPHMDataEntry(qc: QuantumCircuit, profile) -> DataFrame:
     """Collect circuit depth,width -> ESP"""
     optimizationLevel = 0
     dataEntry = {}
@@ -75,83 +82,288 @@ def genESPHMDataEntry(qc: QuantumCircuit, backend) -> DataFrame:
     dataEntry['depth'] = qc.depth()
     dataEntry['size'] = qc.size()
 
-    unroll_qc = transpile(
-        qc, optimization_level=optimizationLevel, backend=backend)
-    esp = QUtil.getESP(unroll_qc, NoiseModel.from_backend(backend))
+    unroll_qc = TranspileCache.getTranspiled(
+        qc, basisGates=profile.basisGates, couplingMap=profile.couplingMap,
+        optimizationLevel=optimizationLevel)
+    esp = QUtil.getESP(unroll_qc, profile)
 
     dataEntry['ESP'] = esp
 
     return DataFrame(dataEntry, index=[0])
 
 
+#Generator run for each kind of task
+GENERATORS = {
+    "data": genDataEntry,
+    "esphm": genESPHMDataEntry,
+    "swap": genSwapDataEntry,
+}
 
-def createDataSet(directory, outputFile) -> None:
-    #TODO: Standardize data set creation so we don't have a dozen functions doing this
-    entries = []
-    fileList = getListOfFiles(directory)
-    i = 0
+#Optimization level each generator transpiles at, part of the task key
+OPT_LEVELS = {
+    "data": 0,
+    "esphm": 0,
+    "swap": 2,
+}
+
+#Failed tasks with their failure count. Tasks that time out or run out of
+#memory, or fail MAX_FAILURES times, are quarantined and skipped by later runs
+FAULT_FILE = "./logs/fault_tasks.json"
+MAX_FAILURES = 3
+
+#Per task limits, wall clock (s) and address space (bytes, None for no limit)
+TASK_TIMEOUT = 30*60
+TASK_MEMORY = None
+
+#Task worker processes, None to use one per core of QUtil.MAX_JOBS
+WORKERS = None
+
+
+def getFaultKey(inputFile, backendName, kind) -> str:
+    return "{}:{}:{}".format(kind, inputFile, backendName)
+
+
+def loadFaults(faultFile=FAULT_FILE) -> dict:
+    if not os.path.exists(faultFile):
+        return {}
+
+    with open(faultFile) as f:
+        return json.load(f)
+
+
+def isQuarantined(fault) -> bool:
+    #Older fault files hold just the reason of a quarantined task
+    return isinstance(fault, str) or fault["quarantined"]
+
+
+def saveFaults(faults, faultFile=FAULT_FILE) -> None:
+    tmpPath = faultFile + ".tmp"
+    with open(tmpPath, 'w') as f:
+        json.dump(faults, f, indent=1, sort_keys=True)
+    os.replace(tmpPath, faultFile)
+
+
+def splitJobs(workers=None):
+    """
+    Split the QUtil.MAX_JOBS core budget into task workers and Aer threads
+    per worker, so workers*threads never oversubscribes the machine.
+    """
+    maxJobs = QUtil.MAX_JOBS if QUtil.MAX_JOBS > 0 else os.cpu_count()
+    workers = min(workers or maxJobs, maxJobs)
+
+    return workers, max(1, maxJobs // workers)
+
+
+def getTaskKey(qc, profile, kind) -> str:
+    """Data set key of a task, (circuit hash, backend calibration, opt level)"""
+    return "{}:{}:{}".format(CircuitHash.getCircuitHash(qc), profile.key, OPT_LEVELS[kind])
+
+
+def expandTasks(fileList, kind, n) -> dict:
+    """(circuit, backend, kind) tasks for every circuit and fitting backend, mapped to their keys"""
+    tasks = {}
     for inputFile in fileList:
-        print("Running", inputFile, "...")
         if inputFile in QUtil.FAULT_CIRCUITS:
-            print("Faulty circuit, skipping...")
-            i += 1
+            print("Faulty circuit, skipping", inputFile)
+            continue
+
+        try:
+            qc = QasmCache.getCircuit(inputFile)
+        except Exception as e:
+            print("{} failed to parse: {!r}".format(inputFile, e))
             continue
 
-        #Read in given circuit
-        qc = QuantumCircuit.from_qasm_file(inputFile)
-        qc.name = inputFile
+        for be in BackendStore.getProfiles(qc, n):
+            tasks[(inputFile, be.name, kind)] = getTaskKey(qc, be, kind)
 
-        n = 1
-        backends = QUtil.getFakeBackends(qc, n)
-        j = 0
-        for be in backends:
-            print("\tRunning", be.configuration().backend_name, "on", inputFile,
-                  "(file: {}/{}, be: {}/{})...".format(i, len(fileList), j, len(backends)))
-            e = genDataEntry(qc, be)
-            if type(e) == DataFrame:
-                if not e.empty:
-                    entries.append(e)
-            j += 1
-        i += 1
+    return tasks
 
-    df = pd.concat(entries)
 
-    df.to_csv(outputFile, index=False)
+def _taskWorker(conn, aerThreads, memoryLimit) -> None:
+    if memoryLimit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memoryLimit, memoryLimit))
+    QUtil.MAX_JOBS = aerThreads
+
+    #Consecutive tasks usually share a circuit
+    qc = None
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+
+        inputFile, backendName, kind = task
+        try:
+            if qc is None or qc.name != inputFile:
+                qc = QasmCache.getCircuit(inputFile)
+                qc.name = inputFile
+
+            e = GENERATORS[kind](qc, BackendStore.getProfile(backendName))
+            conn.send(("done", e))
+        except MemoryError as e:
+            conn.send(("memory", repr(e)))
+        except Exception as e:
+            conn.send(("error", repr(e)))
+
+
+def _startWorker(aerThreads, memoryLimit):
+    conn, childConn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_taskWorker, args=(
+        childConn, aerThreads, memoryLimit), daemon=True)
+    proc.start()
+    childConn.close()
+
+    return {"proc": proc, "conn": conn, "task": None, "start": None}
+
+
+def runTasks(tasks, onEntry, workers=None, timeout=TASK_TIMEOUT, memoryLimit=TASK_MEMORY,
+             faultFile=FAULT_FILE, maxFailures=None) -> None:
+    """
+    Run tasks on a pool of worker processes, one task per worker at a time,
+    passing each task and its entry (or None) to onEntry as it completes.
+    Failures are counted in faultFile. Tasks that raise or crash their worker
+    are retried until they fail maxFailures times, tasks over the time or
+    memory limit are quarantined at once.
+    """
+    maxFailures = maxFailures or MAX_FAILURES
+    if not BackendStore.PROFILES:
+        BackendStore.load()
+
+    faults = loadFaults(faultFile)
+    pending = []
+    for taskId, task in enumerate(tasks):
+        if isQuarantined(faults.get(getFaultKey(*task), {"quarantined": False})):
+            print("Quarantined task, skipping", getFaultKey(*task))
+        else:
+            pending.append((taskId, task))
+    pending.reverse()
+
+    total = len(pending)
+    workers, aerThreads = splitJobs(workers)
+    workers = min(workers, total) or 1
+    print("Running {} tasks on {} workers with {} Aer threads each".format(
+        len(pending), workers, aerThreads))
+
+    pool = [_startWorker(aerThreads, memoryLimit) for _ in range(workers)]
+    done = 0
+
+    def fail(w, reason, fatal=False) -> bool:
+        """Record a failure, returns False if the task was queued again"""
+        key = getFaultKey(*w["task"][1])
+        fault = faults.get(key)
+        if not isinstance(fault, dict):
+            fault = {"failures": 0}
+
+        fault["failures"] += 1
+        fault["reason"] = reason
+        fault["quarantined"] = fatal or fault["failures"] >= maxFailures
+        faults[key] = fault
+        saveFaults(faults, faultFile)
+
+        if fault["quarantined"]:
+            print("\tQuarantining", key, "({})".format(reason))
+            return True
+
+        print("\tRetrying", key, "after failure {} of {} ({})".format(
+            fault["failures"], maxFailures, reason))
+        pending.insert(0, w["task"])
+        return False
+
+    try:
+        while True:
+            for i, w in enumerate(pool):
+                if w["task"] is None and pending:
+                    if not w["proc"].is_alive():
+                        w = pool[i] = _startWorker(aerThreads, memoryLimit)
+                    w["task"] = pending.pop()
+                    w["start"] = time.time()
+                    w["conn"].send(w["task"][1])
+
+            busy = [w for w in pool if w["task"] is not None]
+            if not busy:
+                break
+
+            wait([w["conn"] for w in busy] + [w["proc"].sentinel for w in busy], timeout=1)
+
+            for i, w in enumerate(pool):
+                if w["task"] is None:
+                    continue
+
+                restart = False
+                finished = True
+                if w["conn"].poll():
+                    try:
+                        status, out = w["conn"].recv()
+                    except EOFError:
+                        status, out = "error", "worker exited"
+                        restart = True
+
+                    if status == "done":
+                        onEntry(w["task"][1], out if type(out) == DataFrame else None)
+                        key = getFaultKey(*w["task"][1])
+                        if key in faults:
+                            del faults[key]
+                            saveFaults(faults, faultFile)
+                    else:
+                        finished = fail(w, out, fatal=status == "memory")
+
+                elif not w["proc"].is_alive():
+                    finished = fail(w, "worker exited with code {}".format(w["proc"].exitcode))
+                    restart = True
+
+                elif time.time() - w["start"] > timeout:
+                    w["proc"].kill()
+                    finished = fail(w, "timed out after {}s".format(timeout), fatal=True)
+                    restart = True
+
+                else:
+                    continue
+
+                if finished:
+                    done += 1
+                    print("\t({}/{}) {}".format(done, total, getFaultKey(*w["task"][1])))
+                w["task"] = None
+                if restart:
+                    w["proc"].join()
+                    pool[i] = _startWorker(aerThreads, memoryLimit)
+
+    finally:
+        for w in pool:
+            if w["proc"].is_alive():
+                if w["task"] is None:
+                    w["conn"].send(None)
+                else:
+                    w["proc"].kill()
+            w["proc"].join()
+
+
+def generateDataSet(fileList, kind, n, outputFile) -> None:
+    """Run every task of the data set not already in outputFile, appending as they finish"""
+    tasks = expandTasks(fileList, kind, n)
+
+    with DatasetWriter(outputFile) as writer:
+        pending = [t for t in tasks if not writer.isDone(tasks[t])]
+        if len(pending) < len(tasks):
+            print("Resuming {}, {}/{} tasks already written".format(
+                outputFile, len(tasks) - len(pending), len(tasks)))
+
+        runTasks(pending, lambda task, e: writer.write(tasks[task], e),
+                 WORKERS, TASK_TIMEOUT, TASK_MEMORY)
+
+
+
+def createDataSet(directory, outputFile) -> None:
+    fileList = getListOfFiles(directory)
+
+    n = 1
+    generateDataSet(fileList, "data", n, outputFile)
 
 
 def createESPHMDataSet(directory, outputFile) -> None:
-    entries = []
     fileList = getListOfFiles(directory)
     fileList = list(filter(lambda x: "large" not in x, fileList))
-    i = 0
-    for inputFile in fileList:
-        print("Running", inputFile, "...")
-        if inputFile in QUtil.FAULT_CIRCUITS:
-            print("Faulty circuit, skipping...")
-            continue
 
-        try:
-            #Read in given circuit
-            qc = QuantumCircuit.from_qasm_file(inputFile)
-            qc.name = inputFile
-
-            n = 1000
-            backends = QUtil.getFakeBackends(qc, n)
-            j = 0
-            for be in backends:
-                print("\tRunning", be.configuration().backend_name, "on", inputFile,
-                      "(file: {}/{}, be: {}/{})...".format(i, len(fileList), j, len(backends)))
-                e = genESPHMDataEntry(qc, be)
-                if not e.empty:
-                    entries.append(e)
-                j += 1
-        except:
-            print("{} failed to produce data.".format(inputFile))
-        i += 1
-
-    df = pd.concat(entries)
-
-    df.to_csv(outputFile, index=False)
+    n = 1000
+    generateDataSet(fileList, "esphm", n, outputFile)
 
 def printSpearMan() -> None:
     """Calculate SpearMan correlation coefficient for output features and ESP."""
@@ -159,48 +371,43 @@ def printSpearMan() -> None:
     corMetric = 'ESP'
 
     #TODO: Generalize this so it isn't hard coded to these files.
-    files = getListOfFiles('./dataSets_V2/dataSets_Small/', '.csv')
-    files += getListOfFiles('./dataSets_V2/dataSets_Medium/', '.csv')
+    dirs = ['./dataSets_V2/dataSets_Small/', './dataSets_V2/dataSets_Medium/']
 
-    dfs = [pd.read_csv(f) for f in files]
-    df = pd.concat(dfs)
+    #Only the correlated columns are read from the columnar store
+    datasets = [DatasetStore.openDataset(d) for d in dirs]
+    df = pd.concat([ds.toFrame(outputMetrics + [corMetric]) for ds in datasets])
     print("{:10}{:>20}{:>10}".format("Metric","Spearman Correlation","PValue"))
     for metric in outputMetrics:
         sm = stats.spearmanr(df[metric], df[corMetric])
         print("{:10}{:20.3f}{:10.3f}".format(metric, sm.correlation, sm.pvalue))
 
 def runNoise() -> None:
-    ts = QUtil.getTS()
     directory = "./qasm/Noise_Benchmarks/"
-    outFile = './dataSets_V2/dataSets_Noise/' + ts + '_data.csv'
+    outFile = getOutputFile('./dataSets_V2/dataSets_Noise/')
     createDataSet(directory, outFile)
 
 
 def runESPHM() -> None:
-    ts = QUtil.getTS()
     directory = "./qasm/QASMBench/"
-    outFile = './dataSets_ESP/' + ts + '_data.csv'
+    outFile = getOutputFile('./dataSets_ESP/')
     createESPHMDataSet(directory, outFile)
 
 
 def runSupermarQ() -> None:
-    ts = QUtil.getTS()
     directory = "./qasm/SupermarQ/"
-    outFile = './dataSets_V2/dataSets_SupermarQ/' + ts + '_data.csv'
+    outFile = getOutputFile('./dataSets_V2/dataSets_SupermarQ/')
     createDataSet(directory, outFile)
 
 
 def runSmall() -> None:
-    ts = QUtil.getTS()
     directory = "./qasm/QASMBench/small/"
-    outFile = './dataSets_V2/dataSets_Small/' + ts + '_data.csv'
+    outFile = getOutputFile('./dataSets_V2/dataSets_Small/')
     createDataSet(directory, outFile)
 
 
 def runMedium() -> None:
-    ts = QUtil.getTS()
     directory = "./qasm/QASMBench/medium/"
-    outFile = './dataSets_V2/dataSets_Medium/' + ts + '_data.csv'
+    outFile = getOutputFile('./dataSets_V2/dataSets_Medium/')
     createDataSet(directory, outFile)
 
 
@@ -226,48 +433,17 @@ def getListOfFiles(dirName, ext='.qasm'):
 
 
 def genSwapData(directory) -> None:
-    ts = QUtil.getTS()
-    outFile = './dataSets_SWAP/' + ts + '_data.csv'
-    entries = []
-    i = 1
+    outFile = getOutputFile('./dataSets_SWAP/')
     inputs = getListOfFiles(directory)
     inputs = list(filter(lambda x: "large" not in x, inputs))
-    for inputFile in inputs:
-        print("Running", inputFile, "...({}/{})".format(i, len(inputs)))
-        if inputFile in QUtil.FAULT_CIRCUITS:
-            print("Faulty circuit, skipping...")
-            continue
-
-        #Read in given circuit
-        try:
-            qc = QuantumCircuit.from_qasm_file(inputFile)
-            qc.name = inputFile
-
-            n = 1000
-            backends = QUtil.getFakeBackends(qc, n)
 
-            for be in backends:
-                e = genSwapDataEntry(qc, be)
-                if type(e) == DataFrame:
-                    if not e.empty:
-                        entries.append(e)
-        except:
-            print("Circuit failed to generate data.")
-
-        i += 1
-
-    df = pd.concat(entries)
-
-    df.to_csv(outFile, index=False)
+    n = 1000
+    generateDataSet(inputs, "swap", n, outFile)
 
 
 def drawESPDepthVar(dir):
-    files = [os.path.join(dir, f) for f in os.listdir(
-        dir) if os.path.isfile(os.path.join(dir, f))]
-
     #Read in entries
-    dfs = [pd.read_csv(f) for f in files]
-    df = pd.concat(dfs)
+    df = DatasetStore.openDataset(dir).toFrame(['ESP', 'depth', 'size'])
 
     #Filter out those with ESP == 1
     #Likely from faulty noise models
@@ -293,16 +469,58 @@ def drawESPDepthVar(dir):
     plt.show()
 
 
+RUNS = {
+    "small": runSmall,
+    "medium": runMedium,
+    "noise": runNoise,
+    "supermarq": runSupermarQ,
+    "esphm": runESPHM,
+    "swap": lambda: genSwapData("./qasm/QASMBench/"),
+}
+
+
 def main():
-    #QUtil.GLOBAL_BASIS_GATES = QUtil.getGlobalBasisGates()
+    global WORKERS, TASK_TIMEOUT, TASK_MEMORY, MAX_FAILURES
+
+    parser = argparse.ArgumentParser(
+        description="Generate training data sets from the QASM benchmarks.")
+    parser.add_argument(
+        'run', type=str, nargs='?', choices=list(RUNS), help='Data set to generate, draws the ESP variance plot if omitted.', default=None)
+    parser.add_argument(
+        '--workers', type=int, help='Task worker processes, MAX_JOBS is split between them and Aer. (Default MAX_JOBS)', default=None)
+    parser.add_argument(
+        '--timeout', type=float, help='Seconds before a task is killed and quarantined. (Default {})'.format(TASK_TIMEOUT), default=TASK_TIMEOUT)
+    parser.add_argument(
+        '--memory', type=int, help='Per task memory limit in MB. (Default none)', default=None)
+    parser.add_argument(
+        '--retry-faults', action='store_true', help='Clear the quarantined task list before running.')
+    parser.add_argument(
+        '--max-failures', type=int, help='Failures after which a task is quarantined, timeouts and memory errors quarantine at once. (Default {})'.format(MAX_FAILURES), default=MAX_FAILURES)
+    parser.add_argument(
+        '--noise-cache', type=int, help='Noise models kept in memory per worker. (Default {})'.format(NoiseCache.MAX_ENTRIES), default=NoiseCache.MAX_ENTRIES)
+    parser.add_argument(
+        '--noise-cache-memory', type=int, help='Cap on the pickled size of cached noise models per worker in MB. (Default none)', default=None)
+    args = parser.parse_args()
+
+    MAX_FAILURES = args.max_failures
+
+    #Workers are forked after this and inherit the limits
+    NoiseCache.setLimits(args.noise_cache, None if args.noise_cache_memory is None
+                         else args.noise_cache_memory*(1024**2))
+
+    WORKERS = args.workers
+    TASK_TIMEOUT = args.timeout
+    if args.memory is not None:
+        TASK_MEMORY = args.memory*(1024**2)
+
+    if args.retry_faults and os.path.exists(FAULT_FILE):
+        os.remove(FAULT_FILE)
 
     #printSpearMan()
-    #runMedium()
-    #runNoise()
-    #runESPHM()
-    #runSupermarQ()
-    #genSwapData("./qasm/QASMBench/")
-    drawESPDepthVar("./dataSets_ESP")
+    if args.run is not None:
+        RUNS[args.run]()
+    else:
+        drawESPDepthVar("./dataSets_ESP")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,286 @@
+#Columnar, memory-mapped copy of a CSV data set directory.
+#The CSVs DataGen writes are converted once into NumPy shards kept in
+#<dataset dir>/.store/, each shard a (columns, rows) float64 array so a
+#column is contiguous on disk. schema.json records the version, column
+#names and types, the source CSVs and the shards. Trainers and analytics
+#read batches or single columns from the shards instead of re-parsing text.
+#
+#  python ./src/DatasetStore.py ./dataSets_V2/dataSets_Medium/
+from os.path import exists, isfile, join
+import numpy as np
+import argparse
+import shutil
+import json
+import os
+
+STORE_SUBDIR = ".store"
+SCHEMA_FILE = "schema.json"
+STORE_VERSION = 1
+
+#Rows per shard, also the CSV read chunk size
+SHARD_ROWS = 1 << 16
+
+#Rows per batch when streaming over a whole data set
+BATCH_ROWS = 1 << 14
+
+
+def _getSources(datasetDir) -> dict:
+    #Size and mtime tell whether a CSV changed since it was converted
+    sources = {}
+    for f in sorted(os.listdir(datasetDir)):
+        path = join(datasetDir, f)
+        if isfile(path) and f.endswith(".csv"):
+            stat = os.stat(path)
+            sources[f] = [stat.st_size, stat.st_mtime]
+
+    return sources
+
+
+def _appendCsv(path, schema, storeDir) -> None:
+    import pandas as pd
+
+    for chunk in pd.read_csv(path, chunksize=SHARD_ROWS):
+        if schema["columns"] is None:
+            schema["columns"] = list(chunk.columns)
+            schema["dtypes"] = [str(chunk[c].dtype) for c in chunk.columns]
+
+        if set(chunk.columns) != set(schema["columns"]):
+            raise ValueError("{} columns {} do not match data set schema {}".format(
+                path, list(chunk.columns), schema["columns"]))
+
+        #Shards hold float64, dtypes only decide the cast on read. A column
+        #first read as int turns float once a chunk has a NaN or a fraction
+        for i, c in enumerate(schema["columns"]):
+            schema["dtypes"][i] = str(np.promote_types(schema["dtypes"][i], chunk[c].dtype))
+
+        try:
+            data = chunk[schema["columns"]].to_numpy(np.float64).T
+        except ValueError:
+            raise ValueError("{} has non numeric columns".format(path))
+
+        shard = "shard_{:06d}.npy".format(len(schema["shards"]))
+        np.save(join(storeDir, shard), np.ascontiguousarray(data))
+        schema["shards"].append({"file": shard, "rows": len(chunk)})
+
+
+def build(datasetDir, rebuild=False) -> dict:
+    """Convert new CSVs of datasetDir into shards, rebuilding if any changed"""
+    storeDir = join(datasetDir, STORE_SUBDIR)
+    schemaPath = join(storeDir, SCHEMA_FILE)
+    sources = _getSources(datasetDir)
+
+    schema = None
+    if not rebuild and exists(schemaPath):
+        with open(schemaPath) as f:
+            schema = json.load(f)
+
+        #Shards are append only, a changed or removed CSV needs a rebuild
+        if schema.get("version") != STORE_VERSION or any(
+                sources.get(f) != s for f, s in schema["sources"].items()):
+            schema = None
+
+    if schema is None:
+        shutil.rmtree(storeDir, ignore_errors=True)
+        schema = {"version": STORE_VERSION, "columns": None, "dtypes": None,
+                  "sources": {}, "shards": []}
+
+    newSources = [f for f in sources if f not in schema["sources"]]
+    if not newSources:
+        return schema
+
+    os.makedirs(storeDir, exist_ok=True)
+    for f in newSources:
+        print("Converting", join(datasetDir, f), "...")
+        _appendCsv(join(datasetDir, f), schema, storeDir)
+        schema["sources"][f] = sources[f]
+
+    #Schema is written last so shards are never referenced half written
+    tmpPath = schemaPath + ".tmp"
+    with open(tmpPath, 'w') as f:
+        json.dump(schema, f, indent=1)
+    os.replace(tmpPath, schemaPath)
+
+    return schema
+
+
+class Dataset:
+    """Read only view of the shards of one data set"""
+
+    def __init__(self, datasetDir, schema):
+        storeDir = join(datasetDir, STORE_SUBDIR)
+        self.columns = schema["columns"] or []
+        self.dtypes = dict(zip(self.columns, schema["dtypes"] or []))
+        self._colIds = {c: i for i, c in enumerate(self.columns)}
+
+        self.shards = [np.load(join(storeDir, s["file"]), mmap_mode='r')
+                       for s in schema["shards"]]
+        self.offsets = np.cumsum([0] + [s["rows"] for s in schema["shards"]])
+        self.numRows = int(self.offsets[-1])
+
+    def getColumnIds(self, columns) -> list:
+        return [self._colIds[c] for c in columns]
+
+    def column(self, name) -> np.ndarray:
+        """Every value of one column, only that column is read"""
+        i = self._colIds[name]
+        values = np.concatenate([s[i] for s in self.shards]) if self.shards \
+            else np.empty(0)
+
+        return self._cast(name, values)
+
+    def take(self, rows, colIds) -> np.ndarray:
+        """(len(rows), len(colIds)) array of the given rows, rows sorted"""
+        out = np.empty((len(rows), len(colIds)))
+        shardIds = np.searchsorted(self.offsets, rows, side='right') - 1
+
+        start = 0
+        for shardId in np.unique(shardIds):
+            n = np.count_nonzero(shardIds == shardId)
+            local = rows[start:start + n] - self.offsets[shardId]
+            #Gather only the needed cells, not whole shard columns
+            out[start:start + n] = self.shards[shardId][np.ix_(colIds, local)].T
+            start += n
+
+        return out
+
+    def iterBatches(self, columns=None, batchSize=BATCH_ROWS):
+        """DataFrames of at most batchSize consecutive rows"""
+        import pandas as pd
+
+        columns = columns or self.columns
+        colIds = self.getColumnIds(columns)
+        for shard in self.shards:
+            for begin in range(0, shard.shape[1], batchSize):
+                data = shard[colIds, begin:begin + batchSize].T
+                df = pd.DataFrame(data, columns=columns)
+                yield df.astype({c: self.dtypes[c] for c in columns
+                                 if self.dtypes[c].startswith("int")})
+
+    def toFrame(self, columns=None):
+        """Selected columns as one DataFrame"""
+        import pandas as pd
+
+        columns = columns or self.columns
+        return pd.DataFrame({c: self.column(c) for c in columns})
+
+    def _cast(self, name, values):
+        dtype = self.dtypes.get(name, "float64")
+        if dtype.startswith("int"):
+            return values.astype(dtype)
+        return values
+
+
+def openDataset(datasetDir, rebuild=False) -> Dataset:
+    """Data set of a DataGen output directory, converting new CSVs first"""
+    return Dataset(datasetDir, build(datasetDir, rebuild))
+
+
+def splitRows(numRows, fractions=(0.7, 0.15, 0.15), seed=None) -> list:
+    """Shuffled row indices split into train/validation/test like train_test_split"""
+    rows = np.random.default_rng(seed).permutation(numRows)
+    bounds = np.cumsum([int(round(f*numRows)) for f in fractions[:-1]])
+
+    return np.split(rows, bounds)
+
+
+def fitScaler(dataset, columns, fillNonFinite=False):
+    """MinMaxScaler fitted batch by batch, keeps the feature names"""
+    from sklearn import preprocessing
+
+    scaler = preprocessing.MinMaxScaler()
+    for X in dataset.iterBatches(columns):
+        if fillNonFinite:
+            X = X.replace([np.inf, -np.inf, np.nan], 0)
+        scaler.partial_fit(X)
+
+    return scaler
+
+
+class BatchLoader:
+    """
+    Scaled (X, Y) batches of the given rows, gathered from the shards on
+    demand. Use getKerasSequence() to pass one to Model.fit.
+    """
+
+    def __init__(self, dataset, rows, xColumns, yColumns, batchSize=32,
+                 scaler=None, shuffle=True, fillNonFinite=False, yDict=False,
+                 derived=None):
+        self.dataset = dataset
+        self.rows = np.array(rows)
+        self.xIds = dataset.getColumnIds(xColumns)
+        self.batchSize = batchSize
+        self.shuffle = shuffle
+        self.fillNonFinite = fillNonFinite
+        self.yDict = yDict
+
+        #Targets computed from stored columns, {name: (columns, function)}
+        self.derived = derived or {}
+        self.yColumns = list(yColumns)
+        self.storedY = [c for c in self.yColumns if c not in self.derived]
+        for columns, _ in self.derived.values():
+            self.storedY += [c for c in columns if c not in self.storedY]
+        self.yIds = dataset.getColumnIds(self.storedY)
+
+        #Same transform as MinMaxScaler.transform, without pandas per batch
+        self.scale = scaler.scale_ if scaler is not None else 1
+        self.shift = scaler.min_ if scaler is not None else 0
+
+        if self.shuffle:
+            np.random.shuffle(self.rows)
+
+    def __len__(self):
+        return -(-len(self.rows)//self.batchSize)
+
+    def __getitem__(self, i):
+        rows = np.sort(self.rows[i*self.batchSize:(i + 1)*self.batchSize])
+        data = self.dataset.take(rows, self.xIds + self.yIds)
+        if self.fillNonFinite:
+            data[~np.isfinite(data)] = 0
+
+        X = data[:, :len(self.xIds)]*self.scale + self.shift
+        stored = dict(zip(self.storedY, data[:, len(self.xIds):].T))
+
+        Y = {}
+        for c in self.yColumns:
+            if c in self.derived:
+                columns, func = self.derived[c]
+                Y[c] = func(*[stored[k] for k in columns])
+            else:
+                Y[c] = stored[c]
+
+        if self.yDict:
+            return X, {c: y[:, None] for c, y in Y.items()}
+        return X, np.stack([Y[c] for c in self.yColumns], axis=1)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.rows)
+
+
+def getKerasSequence(*args, **kwargs):
+    """BatchLoader that Keras accepts as a Sequence, imports TensorFlow"""
+    from tensorflow.keras.utils import Sequence
+
+    class KerasBatchLoader(BatchLoader, Sequence):
+        pass
+
+    return KerasBatchLoader(*args, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert DataGen CSV directories into the columnar store.")
+    parser.add_argument(
+        'dirs', type=str, nargs='+', help='Data set directories.')
+    parser.add_argument(
+        '--rebuild', action='store_true', help='Convert every CSV again.')
+    args = parser.parse_args()
+
+    for d in args.dirs:
+        dataset = openDataset(d, args.rebuild)
+        print("{}: {} rows, {} columns in {} shards".format(
+            d, dataset.numRows, len(dataset.columns), len(dataset.shards)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#Incremental, resumable CSV writer for DataGen.
+#Rows are appended in chunks next to a JSON lines manifest recording the
+#column schema, the task keys each chunk completed and the data file size
+#after it. A run that dies is resumed by truncating the data file to the
+#last recorded chunk and skipping the keys already written.
+from os.path import exists, join
+import json
+import time
+import os
+
+import QUtil
+
+MANIFEST_EXT = ".manifest"
+
+#Rows buffered before a chunk is written, and the longest a row may wait (s)
+CHUNK_SIZE = 64
+FLUSH_INTERVAL = 60
+
+
+def getManifestPath(path: str) -> str:
+    return path + MANIFEST_EXT
+
+
+def readManifest(path: str) -> dict:
+    """Schema, completed keys, last chunk end and completion of a data file"""
+    state = {"schema": None, "keys": set(), "end": 0, "complete": False}
+    if not exists(getManifestPath(path)):
+        return state
+
+    with open(getManifestPath(path)) as f:
+        for l in f:
+            try:
+                record = json.loads(l)
+            #A crash may leave the last line half written
+            except json.JSONDecodeError:
+                break
+
+            if "schema" in record:
+                state["schema"] = record["schema"]
+            if "keys" in record:
+                state["keys"].update(record["keys"])
+                state["end"] = record["end"]
+            if record.get("complete"):
+                state["complete"] = True
+
+    return state
+
+
+def getOutputFile(directory: str, suffix="_data.csv") -> str:
+    """Unfinished data set in directory to resume, else a new getTS() name"""
+    if exists(directory):
+        for f in sorted(os.listdir(directory)):
+            path = join(directory, f)
+            if f.endswith(suffix) and exists(getManifestPath(path)) \
+                    and not readManifest(path)["complete"]:
+                return path
+
+    return join(directory, QUtil.getTS() + suffix)
+
+
+class DatasetWriter:
+    """Appends DataFrame rows to path, resuming a previous partial run"""
+
+    def __init__(self, path, chunkSize=CHUNK_SIZE, flushInterval=FLUSH_INTERVAL):
+        self.path = path
+        self.chunkSize = chunkSize
+        self.flushInterval = flushInterval
+
+        state = readManifest(path)
+        self.schema = state["schema"]
+        self.doneKeys = state["keys"]
+        self.complete = state["complete"]
+
+        #Drop rows written after the last chunk the manifest recorded
+        if exists(path) and os.path.getsize(path) != state["end"]:
+            with open(path, 'r+b') as f:
+                f.truncate(state["end"])
+
+        self._rows = []
+        self._keys = []
+        self._lastFlush = time.time()
+
+    def isDone(self, key) -> bool:
+        return key in self.doneKeys
+
+    def write(self, key, entry) -> None:
+        """Buffer entry (a DataFrame, possibly None) as the result of key"""
+        if entry is not None and not entry.empty:
+            if self.schema is None:
+                self.schema = list(entry.columns)
+                self._writeManifest({"schema": self.schema})
+
+            if set(entry.columns) != set(self.schema):
+                raise ValueError("Entry columns {} do not match data set schema {}".format(
+                    list(entry.columns), self.schema))
+            self._rows.append(entry[self.schema])
+
+        #Keys without rows are recorded too so they are not retried
+        self._keys.append(key)
+        if len(self._rows) >= self.chunkSize \
+                or time.time() - self._lastFlush > self.flushInterval:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._keys:
+            return
+
+        if self._rows:
+            import pandas as pd
+
+            header = not exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a') as f:
+                pd.concat(self._rows).to_csv(f, header=header, index=False)
+                f.flush()
+                os.fsync(f.fileno())
+
+        end = os.path.getsize(self.path) if exists(self.path) else 0
+        self._writeManifest({"keys": self._keys, "end": end})
+
+        self.doneKeys.update(self._keys)
+        self._rows = []
+        self._keys = []
+        self._lastFlush = time.time()
+
+    def close(self) -> None:
+        """Flush and mark the data set complete, later runs start a new file"""
+        self.flush()
+        self._writeManifest({"complete": True})
+        self.complete = True
+
+    def _writeManifest(self, record) -> None:
+        with open(getManifestPath(self.path), 'a') as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        #Only a finished run is marked complete, otherwise it is resumed
+        if excType is None:
+            self.close()
+        else:
+            self.flush()
@@ -0,0 +1,55 @@
+#Vectorized Estimated Success Probability.
+#Backend error tables are compiled once into flat log-success arrays, a
+#circuit is reduced to a histogram over (gate, qubit, qubit) and ESP becomes
+#a single gather plus dot product in log space.
+from qiskit import QuantumCircuit
+import numpy as np
+
+#Compiled tables per profile key, kept for the life of the process
+_LOG_TABLES = {}
+
+
+def getLogTable(profile) -> np.ndarray:
+    """Flattened log success table of a backend profile"""
+    if profile.key not in _LOG_TABLES:
+        table = np.asarray(profile.getSuccessTable(), dtype=np.float64)
+
+        #Zero success probabilities become -inf, i.e. ESP of 0
+        with np.errstate(divide='ignore'):
+            _LOG_TABLES[profile.key] = np.log(table).ravel()
+
+    return _LOG_TABLES[profile.key]
+
+
+def getHistogram(qc: QuantumCircuit, gateIds: dict, numQubits: int):
+    """Distinct flat table indices used by qc and how often each occurs"""
+    stride = numQubits*numQubits
+    index = []
+
+    for instruction, qargs, cargs in qc._data:
+        gate = gateIds.get(instruction.name)
+        if gate is None:
+            continue
+
+        #Single qubit and readout entries sit on the table diagonal
+        index.append(gate*stride + qargs[0]._index *
+                     numQubits + qargs[-1]._index)
+
+    return np.unique(np.asarray(index, dtype=np.int64), return_counts=True)
+
+
+def getLogESP(qc: QuantumCircuit, profile) -> float:
+    """Natural log of the ESP of a circuit transpiled for profile"""
+    index, counts = getHistogram(qc, profile.gateIds, profile.numQubits)
+    if len(index) == 0:
+        return 0.0
+
+    return float(np.dot(counts, getLogTable(profile)[index]))
+
+
+def getESP(qc: QuantumCircuit, profile) -> float:
+    """
+    Estimated Success Probability
+    https://dl.acm.org/doi/abs/10.1145/3386162
+    """
+    return float(np.exp(getLogESP(qc, profile)))
@@ -1,98 +1,152 @@
-from qiskit import QuantumCircuit, Aer, execute, IBMQ
 import sys
 import time
+import math
+import io
 import os
+import importlib
 from os.path import exists
-from qiskit.providers.aer.noise import NoiseModel
-from qiskit import transpile
+from qiskit import qpy
+from concurrent.futures import ProcessPoolExecutor
 import EvalMetrics as EM
 import argparse
 
 import QUtil
+import BackendStore
+import TranspileCache
+import QasmCache
+import FeatureStore
+import ESPEngine
+import NumpyRuntime
+import NoiseCache
+import AdaptiveSim
+import LayoutSearch
+import SwapEstimator
 
-import PredictorV1
-import PredictorV2
-import SwapPredictor
+#TensorFlow (predictors), Aer, the IBMQ provider and pandas are imported by
+#the modes that use them, see loadPredictor() and StartupBench.py
 
-def evalCircuitSim(resultDict, qc, backend):
+#ESP and simulation (also in cascade) place circuits by LayoutSearch instead of transpile()
+LAYOUT_SEARCH = False
+
+
+def getLayout(qc, profile):
+    '''Initial layout for qc on profile, None to leave it to transpile()'''
+    if not LAYOUT_SEARCH:
+        return None
+
+    result = LayoutSearch.getBestLayout(qc, profile)
+    sys.stderr.write("Layout: {} {} {:.3f}\n".format(
+        profile.name, result["layout"], result["logESP"]))
+    return result["layout"]
+
+
+def evalCircuitSim(resultDict, qc, profile):
     '''Run circuit on simulated backend and collect result metrics'''
     optimizationLevel = 0
-    backendName = backend.configuration().backend_name
+    backendName = profile.name
 
     if qc.name not in resultDict:
         resultDict[qc.name] = []
 
-    print(backendName, backend.configuration().n_qubits)
-    out = QUtil.simCircuit(qc, backend, optimizationLevel)
+    print(backendName, profile.numQubits)
+    out = QUtil.simCircuit(qc, profile, optimizationLevel, getLayout(qc, profile))
     if out != None:
         resultDict[qc.name].append([backendName, out])
 
 
-def evalCircuitESP(resultDict, qc, backend):
+def evalCircuitESP(resultDict, qc, profile):
     '''Estimate circuit fidelity via ESP'''
     optimizationLevel = 0
-    backendName = backend.configuration().backend_name
+    backendName = profile.name
 
     if qc.name not in resultDict:
         resultDict[qc.name] = []
 
-    print(backendName, backend.configuration().n_qubits)
-    unroll_qc = transpile(
-        qc, optimization_level=optimizationLevel, backend=backend)
+    print(backendName, profile.numQubits)
+    unroll_qc = TranspileCache.getTranspiled(
+        qc, basisGates=profile.basisGates, couplingMap=profile.couplingMap,
+        optimizationLevel=optimizationLevel, initialLayout=getLayout(qc, profile))
 
-    esp = QUtil.getESP(unroll_qc, NoiseModel.from_backend(backend))
-    resultDict[qc.name].append([backendName, esp])
+    #Log space keeps deep circuits rankable after ESP underflows
+    logESP = ESPEngine.getLogESP(unroll_qc, profile)
+    resultDict[qc.name].append([backendName, math.exp(logESP), logESP])
 
 
-def evalCircuitPredictV1(resultDict, qc, backend):
-    backendName = backend.configuration().backend_name
-
+def evalFeaturesV1(resultDict, qc, profile):
+    '''Collect V1 model inputs, predictions are batched across backends'''
     if qc.name not in resultDict:
         resultDict[qc.name] = []
 
-    args = QUtil.getV1Input(qc, backend)
+    resultDict[qc.name].append([profile.name, FeatureStore.getFeatures(qc, profile, "v1")])
 
-    outDict = {}
-    for output in PredictorV1.out_columns:
-        outDict[output] = float(PredictorV1.queryModel(args, output)[0][0])
-    outDict["Fitness"] = EM.fitness(
-        outDict["PST"], outDict["TVD"], outDict["Entropy"], outDict["Swaps"], 1, 1)
-    resultDict[qc.name].append([backendName, outDict])
 
+def evalFeaturesV2(resultDict, qc, profile):
+    if qc.name not in resultDict:
+        resultDict[qc.name] = []
+
+    resultDict[qc.name].append([profile.name, FeatureStore.getFeatures(qc, profile, "v2")])
 
-def evalCircuitPredictV2(resultDict, qc, backend):
-    backendName = backend.configuration().backend_name
 
+def evalFeaturesSwap(resultDict, qc, profile):
     if qc.name not in resultDict:
         resultDict[qc.name] = []
 
-    args = QUtil.getV2Input(qc, backend)
+    resultDict[qc.name].append([profile.name, FeatureStore.getFeatures(qc, profile, "swap")])
 
-    outDict = {}
-    for output in PredictorV2.out_columns:
-        outDict[output] = float(PredictorV2.queryModel(args, output)[0][0])
-    outDict["Fitness"] = EM.fitness(
-        outDict["PST"], outDict["TVD"], outDict["Entropy"], outDict["Swaps"], 1, 1)
-    resultDict[qc.name].append([backendName, outDict])
 
+def _concatFeatures(featureDict):
+    import pandas as pd
 
-def evalSwapPredictor(resultDict, qc, backend):
-    backendName = backend.configuration().backend_name
+    #One model call for every circuit and backend in the dict
+    rows = [(file, backendName) for file in featureDict.keys()
+            for backendName, _ in featureDict[file]]
+    X = pd.concat([i[1] for file in featureDict.keys()
+                   for i in featureDict[file]], ignore_index=True)
 
-    if qc.name not in resultDict:
-        resultDict[qc.name] = {}
+    return rows, X
 
-    if backendName not in resultDict[qc.name]:
-        resultDict[qc.name][backendName] = {}
 
-    args = QUtil.getSWAPInput(qc, backend)
+def predictBatch(featureDict, predictor):
+    '''Run each model once over the feature rows of every backend'''
+    import pandas as pd
+    timeBegin = time.time_ns()
 
-    predSwaps = int(SwapPredictor.queryModel(args)[0][0])
-    resultDict[qc.name][backendName]['PredSwaps'] = predSwaps
+    rows, X = _concatFeatures(featureDict)
+    Y = pd.DataFrame(predictor.queryModelBatch(X), index=X.index)
 
+    resultDict = {file: [] for file in featureDict.keys()}
+    for (file, backendName), (_, y) in zip(rows, Y.iterrows()):
+        outDict = {}
+        for output in predictor.out_columns:
+            outDict[output] = float(y[output])
+
+        #Fused models may predict fitness directly, trained on this same formula
+        if "Fitness" in Y.columns:
+            outDict["Fitness"] = float(y["Fitness"])
+        else:
+            outDict["Fitness"] = EM.fitness(
+                outDict["PST"], outDict["TVD"], outDict["Entropy"], outDict["Swaps"], 1, 1)
+        resultDict[file].append([backendName, outDict])
+
+    return resultDict, time.time_ns() - timeBegin
+
+
+def predictSwapBatch(featureDict, predictor):
+    import pandas as pd
+    timeBegin = time.time_ns()
+
+    rows, X = _concatFeatures(featureDict)
+    Y = pd.DataFrame(predictor.queryModelBatch(X), index=X.index)
+
+    resultDict = {file: {} for file in featureDict.keys()}
+    for (file, backendName), predSwaps in zip(rows, Y["Swaps"]):
+        resultDict[file][backendName] = {'PredSwaps': int(predSwaps)}
+
+    return resultDict, time.time_ns() - timeBegin
 
-def evalSwapCompiler(resultDict, qc, backend):
-    backendName = backend.configuration().backend_name
+
+def evalSwapCompiler(resultDict, qc, profile):
+    backendName = profile.name
 
     optimizationLevel = 2
 
@@ -102,13 +156,39 @@ def evalSwapCompiler(resultDict, qc, backend):
     if backendName not in resultDict[qc.name]:
         resultDict[qc.name][backendName] = {}
 
-    actSwaps = QUtil.getSwapCount(qc, backend, optimizationLevel)
+    actSwaps = QUtil.getSwapCount(qc, profile, optimizationLevel)
     resultDict[qc.name][backendName]['ActSwaps'] = actSwaps
 
 
+def evalSwapEstimate(resultDict, qc, profile):
+    '''Analytical SWAP estimate from the coupling map distances'''
+    if qc.name not in resultDict:
+        resultDict[qc.name] = {}
+
+    resultDict[qc.name][profile.name] = {
+        'PredSwaps': SwapEstimator.estimateSwaps(qc, profile)}
+
+
+def compareSwapCompiler(resultDict, qc, backends, jobs=1):
+    '''Add compiled SWAP counts to predicted ones, returns the compile time'''
+    resultDictSwapAct, execTimeSwapAct = query(
+        qc, backends, evalSwapCompiler, jobs)
+
+    #Merge predicted and actual dicts
+    for i in resultDict.keys():
+        for j in resultDict[i].keys():
+            resultDict[i][j] = {
+                **(resultDict[i][j]), **(resultDictSwapAct[i][j])}
+
+    return execTimeSwapAct
+
+
 def simCircuitIBMQ(resultDict, qc, backend):
     '''Run circuit on simulated backend and collect result metrics, TODO: Update this to work with new framework'''
 
+    from qiskit import Aer, execute
+    from qiskit.providers.aer.noise import NoiseModel
+
     backendName = backend.configuration().backend_name
     nm = NoiseModel.from_backend(backend)
 
@@ -143,7 +223,8 @@ def printResultsESP(resultDict, execTime):
 
     header = [
         ("Backend Name", 20),
-        ("ESP", 10)
+        ("ESP", 10),
+        ("log(ESP)", 12)
     ]
 
     def printHeader(header):
@@ -153,7 +234,7 @@ def printResultsESP(resultDict, execTime):
 
     for k in resultDict.keys():
         resultDict[k] = sorted(
-            resultDict[k], key=lambda i: i[1], reverse=True)
+            resultDict[k], key=lambda i: i[2], reverse=True)
 
     for file in resultDict.keys():
         print("{} {:.6f}(s) {}".format(
@@ -163,8 +244,9 @@ def printResultsESP(resultDict, execTime):
         for i in range(len(resultDict[file])):
             backend = resultDict[file][i][0]
             ESP = resultDict[file][i][1]
-            print("{:20}{:<10.3f}".format(
-                backend, ESP))
+            logESP = resultDict[file][i][2]
+            print("{:20}{:<10.3f}{:<12.3f}".format(
+                backend, ESP, logESP))
 
 
 def printResultsSwapCompare(resultDict, execTimePred, execTimeAct):
@@ -188,9 +270,9 @@ def printResultsSwapCompare(resultDict, execTimePred, execTimeAct):
             sortedKeys.append(
                 [i, j, resultDict[i][j]['PredSwaps'], resultDict[i][j]['ActSwaps']])
 
-    #Sort list on predicted counts
+    #Sort list on predicted counts, unroutable (None) last
     sortedKeys = sorted(
-        sortedKeys, key=lambda i: i[2], reverse=False)
+        sortedKeys, key=lambda i: (i[2] is None, i[2] or 0), reverse=False)
 
     #Organize by circuit
     sortedKeysDict = {}
@@ -208,7 +290,7 @@ def printResultsSwapCompare(resultDict, execTimePred, execTimeAct):
             predSwaps = resultDict[file][i]['PredSwaps']
             actSwaps = resultDict[file][i]['ActSwaps']
             print("{:20}{:<20}{:<20}".format(
-                backend, predSwaps, actSwaps))
+                backend, str(predSwaps), str(actSwaps)))
 
 
 def printResultsSwap(resultDict, execTimePred):
@@ -252,6 +334,70 @@ def printResultsSwap(resultDict, execTimePred):
             print("{:20}{:<20}".format(backend, predSwaps))
 
 
+def printResultsAdaptive(resultDict, execTime):
+    '''Prints adaptive simulation metrics, intervals and shots per backend'''
+
+    header = [
+        ("Backend Name", 20),
+        ("PST", 10),
+        ("TVD", 10),
+        ("Fitness", 10),
+        ("Fitness CI", 20),
+        ("Shots", 10),
+        ("Stop", 10)
+    ]
+
+    def printHeader(header):
+        for h in header:
+            print("{h:{field_size}}".format(h=h[0], field_size=h[1]), end='')
+        print('')
+
+    for k in resultDict.keys():
+        resultDict[k] = sorted(
+            resultDict[k], key=lambda i: i[1]["Fitness"], reverse=True)
+
+    for file in resultDict.keys():
+        print("{} {:.6f}(s) {}".format(
+            file, execTime/(10**9), '++++++++++++++'))
+        printHeader(header)
+
+        for backend, out in resultDict[file]:
+            fitnessCI = "[{:.3f}, {:.3f}]".format(*out["FitnessCI"])
+            print("{:20}{:<10.3f}{:<10.3f}{:<10.3f}{:20}{:<10}{:10}".format(
+                backend, out["PST"], out["TVD"], out["Fitness"], fitnessCI, out["Shots"], out["Stop"]))
+
+
+def printResultsCascade(resultDict, execTime):
+    '''Prints the cascade ranking and the stage that ranked each backend'''
+
+    header = [
+        ("Backend Name", 20),
+        ("Stage", 12),
+        ("log(ESP)", 12),
+        ("P2 Fitness", 12),
+        ("Fitness", 10)
+    ]
+
+    def printHeader(header):
+        for h in header:
+            print("{h:{field_size}}".format(h=h[0], field_size=h[1]), end='')
+        print('')
+
+    def formatValue(out, key):
+        return "{:.3f}".format(out[key]) if key in out else "N/A"
+
+    #Already in cascade order, later stages first
+    for file in resultDict.keys():
+        print("{} {:.6f}(s) {}".format(
+            file, execTime/(10**9), '++++++++++++++'))
+        printHeader(header)
+
+        for backend, out in resultDict[file]:
+            print("{:20}{:12}{:12}{:12}{:10}".format(
+                backend, out["Stage"], formatValue(out, "logESP"),
+                formatValue(out, "PredFitness"), formatValue(out, "Fitness")))
+
+
 def printResults(resultDict, execTime):
     '''Prints metrics per backend on each circuit'''
 
@@ -298,26 +444,285 @@ def printResults(resultDict, execTime):
                     backend, PST, TVD, Entropy, swapCount, L2, Hellinger, Fitness))
 
 
-def query(qc, backends, queryFunc):
+#Circuit shipped once to each query worker by _initWorker
+_WORKER_QC = None
+
+
+#Start method of query worker pools, None for the platform default.
+#Multithreaded callers (QuarryServer) set spawn, forking them is unsafe.
+POOL_CONTEXT = None
+
+
+def _initWorker(qpyBytes, name, maxJobs, calibrationDir):
+    global _WORKER_QC
+
+    _WORKER_QC = qpy.load(io.BytesIO(qpyBytes))[0]
+    _WORKER_QC.name = name
+
+    #Share the cores between workers instead of each simulator taking all
+    QUtil.MAX_JOBS = maxJobs
+    #Spawned workers start without the parent's profiles and settings
+    BackendStore.CALIBRATION_DIR = calibrationDir
+    if not BackendStore.PROFILES:
+        BackendStore.load()
+
+
+def _runWorkerTask(task):
+    queryFunc, backendName = task
+    timeBegin = time.time_ns()
+
+    resultDict = {}
+    queryFunc(resultDict, _WORKER_QC, BackendStore.getProfile(backendName))
+
+    return resultDict, time.time_ns() - timeBegin
+
+
+def _mergeResults(resultDict, partial):
+    for k, v in partial.items():
+        if isinstance(v, list):
+            resultDict.setdefault(k, []).extend(v)
+        else:
+            resultDict.setdefault(k, {}).update(v)
+
+
+def query(qc, backends, queryFunc, jobs=1):
     #Simulate circuit on each backend
     timeBegin = time.time_ns()
 
     resultDictSim = {}
-    for backend in backends:
-        queryFunc(resultDictSim, qc, backend)
+    backendTimes = []
+    if jobs > 1:
+        qpyFile = io.BytesIO()
+        qpy.dump(qc, qpyFile)
+        maxJobs = max(1, QUtil.MAX_JOBS // jobs)
+
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=POOL_CONTEXT, initializer=_initWorker,
+                                 initargs=(qpyFile.getvalue(), qc.name, maxJobs,
+                                           BackendStore.CALIBRATION_DIR)) as pool:
+            tasks = [(queryFunc, backend.name) for backend in backends]
+
+            #map() keeps backend order so results merge as in a serial run
+            for backend, (partial, t) in zip(backends, pool.map(_runWorkerTask, tasks)):
+                _mergeResults(resultDictSim, partial)
+                backendTimes.append((backend.name, t))
+    else:
+        for backend in backends:
+            backendBegin = time.time_ns()
+            queryFunc(resultDictSim, qc, backend)
+            backendTimes.append((backend.name, time.time_ns() - backendBegin))
     timeEnd = time.time_ns()
 
+    for backendName, t in backendTimes:
+        sys.stderr.write("BackendTime: {} {:.6f}\n".format(
+            backendName, t/(10**9)))
+
     #Time taken to simulate
     execTime = timeEnd - timeBegin
 
     return resultDictSim, execTime
 
 
+def loadPredictor(name, moduleName, loaderName):
+    '''Exported NumPy predictor when available and current, else the Keras module'''
+    predictor = NumpyRuntime.loadPredictor(name)
+    if predictor == None:
+        #Only now pay for importing TensorFlow
+        predictor = importlib.import_module(moduleName)
+        getattr(predictor, loaderName)()
+
+    return predictor
+
+
+#Predictors loaded so far, kept for the life of the process
+PREDICTORS = {}
+
+PREDICTOR_MODULES = {
+    "v1": ("PredictorV1", "load_models"),
+    "v2": ("PredictorV2", "load_models"),
+    "swap": ("SwapPredictor", "load"),
+}
+
+#Feature function and predictor used by each ML mode
+MODE_FEATURES = {
+    "p1": (evalFeaturesV1, "v1"),
+    "p2": (evalFeaturesV2, "v2"),
+    "swap_pred": (evalFeaturesSwap, "swap"),
+    "swap_compare": (evalFeaturesSwap, "swap"),
+}
+
+MODES = ["simulation", "adaptive", "p1", "p2", "esp",
+         "swap_pred", "swap_compile", "swap_compare", "cascade",
+         "swap_est", "swap_est_compare"]
+
+#Cascade mode: ESP ranks every backend, P2 re-ranks the best CASCADE_K1 and
+#simulation the best CASCADE_K2 of those. Later stages are skipped once
+#CASCADE_BUDGET seconds have passed, None for no limit.
+CASCADE_K1 = 10
+CASCADE_K2 = 3
+CASCADE_BUDGET = None
+
+
+def getPredictor(name, reload=False):
+    '''Load a predictor once, reload=True re-reads its checkpoint'''
+    if reload or name not in PREDICTORS:
+        moduleName, loaderName = PREDICTOR_MODULES[name]
+        PREDICTORS[name] = loadPredictor(name, moduleName, loaderName)
+
+    return PREDICTORS[name]
+
+
+def predictLocal(name, featureDict):
+    predictor = getPredictor(name)
+    if name == "swap":
+        return predictSwapBatch(featureDict, predictor)
+
+    return predictBatch(featureDict, predictor)
+
+
+def runCascade(qc, backends, jobs=1, predict=predictLocal, k1=None, k2=None, budget=None):
+    '''
+    Rank backends in stages of rising cost, each stage re-ranking the head
+    of the previous ranking. Returns the ranking as [backend, outDict] with
+    the deciding "Stage", the ESP and P2 scores and simulated metrics.
+    '''
+    k1 = k1 if k1 is not None else CASCADE_K1
+    k2 = k2 if k2 is not None else CASCADE_K2
+    budget = budget if budget is not None else CASCADE_BUDGET
+
+    timeBegin = time.time_ns()
+    deadline = None if budget is None else timeBegin + budget*10**9
+
+    def hasTime():
+        return deadline is None or time.time_ns() < deadline
+
+    profiles = {b.name: b for b in backends}
+
+    #Stage 1, ESP of every backend is always collected
+    espDict, espTime = query(qc, backends, evalCircuitESP, jobs)
+    espResults = sorted(espDict.get(qc.name, []), key=lambda i: i[2], reverse=True)
+    outDicts = {backendName: {"Stage": "esp", "ESP": ESP, "logESP": logESP}
+                for backendName, ESP, logESP in espResults}
+    ranking = [i[0] for i in espResults]
+    sys.stderr.write("StageTime: esp {:.6f}\n".format(espTime/(10**9)))
+
+    #Stage 2, P2 predictions for the ESP top k1
+    finalists = ranking[:k1]
+    if finalists and hasTime():
+        featureDict, featureTime = query(
+            qc, [profiles[b] for b in finalists], evalFeaturesV2, jobs)
+        predDict, predTime = predict("v2", featureDict)
+        for backendName, out in predDict.get(qc.name, []):
+            outDicts[backendName]["Stage"] = "p2"
+            outDicts[backendName]["PredFitness"] = out["Fitness"]
+
+        predicted = sorted([b for b in finalists if "PredFitness" in outDicts[b]],
+                           key=lambda b: outDicts[b]["PredFitness"], reverse=True)
+        ranking = predicted + [b for b in ranking if b not in predicted]
+        sys.stderr.write("StageTime: p2 {:.6f}\n".format((featureTime + predTime)/(10**9)))
+
+        #Stage 3, simulation of the P2 top k2, a round of jobs backends at a time
+        finalists = predicted[:k2]
+        stageBegin = time.time_ns()
+        simulated = []
+        for i in range(0, len(finalists), max(jobs, 1)):
+            if not hasTime():
+                break
+
+            simDict, _ = query(
+                qc, [profiles[b] for b in finalists[i:i + max(jobs, 1)]], evalCircuitSim, jobs)
+            for backendName, out in simDict.get(qc.name, []):
+                outDicts[backendName].update(out)
+                outDicts[backendName]["Stage"] = "simulation"
+                simulated.append(backendName)
+
+        simulated = sorted(simulated, key=lambda b: outDicts[b]["Fitness"], reverse=True)
+        ranking = simulated + [b for b in ranking if b not in simulated]
+        sys.stderr.write("StageTime: simulation {:.6f}\n".format(
+            (time.time_ns() - stageBegin)/(10**9)))
+
+    resultDict = {qc.name: [[b, outDicts[b]] for b in ranking]}
+    return resultDict, time.time_ns() - timeBegin
+
+
+def runQuery(qc, backends, mode, jobs=1, predict=predictLocal):
+    '''
+    Run one query mode, returns the result dict and a list of exec times (ns),
+    swap_compare reports predicted and compiled times separately.
+    '''
+    mode = mode.lower()
+
+    if mode == "esp":
+        resultDict, execTime = query(qc, backends, evalCircuitESP, jobs)
+        return resultDict, [execTime]
+
+    elif mode == "simulation":
+        resultDict, execTime = query(qc, backends, evalCircuitSim, jobs)
+        return resultDict, [execTime]
+
+    elif mode == "swap_compile":
+        resultDict, execTime = query(qc, backends, evalSwapCompiler, jobs)
+        return resultDict, [execTime]
+
+    #Backends share one shot budget loop, so they are not spread over jobs;
+    #each simulation uses all QUtil.MAX_JOBS Aer threads instead
+    elif mode == "adaptive":
+        timeBegin = time.time_ns()
+        results = AdaptiveSim.simCircuits(qc, backends)
+        resultDict = {qc.name: [[backendName, out] for backendName, out in results.items()]}
+        return resultDict, [time.time_ns() - timeBegin]
+
+    elif mode in ["swap_est", "swap_est_compare"]:
+        resultDict, execTime = query(qc, backends, evalSwapEstimate, jobs)
+        if mode == "swap_est":
+            return resultDict, [execTime]
+
+        execTimeSwapAct = compareSwapCompiler(resultDict, qc, backends, jobs)
+        return resultDict, [execTime, execTimeSwapAct]
+
+    elif mode == "cascade":
+        resultDict, execTime = runCascade(qc, backends, jobs, predict)
+        return resultDict, [execTime]
+
+    elif mode in MODE_FEATURES:
+        featureFunc, name = MODE_FEATURES[mode]
+        featureDict, featureTime = query(qc, backends, featureFunc, jobs)
+        resultDict, predTime = predict(name, featureDict)
+        if mode != "swap_compare":
+            return resultDict, [featureTime + predTime]
+
+        execTimeSwapAct = compareSwapCompiler(resultDict, qc, backends, jobs)
+        return resultDict, [featureTime + predTime, execTimeSwapAct]
+
+    raise ValueError("Unknown mode {}".format(mode))
+
+
+def getRecords(mode, resultDict):
+    '''Flatten a result dict into one record per (circuit, backend)'''
+    mode = mode.lower()
+
+    records = []
+    for file in resultDict.keys():
+        if isinstance(resultDict[file], dict):
+            entries = resultDict[file].items()
+        elif mode == "esp":
+            entries = [(i[0], {"ESP": i[1], "logESP": i[2]})
+                       for i in resultDict[file]]
+        else:
+            entries = resultDict[file]
+
+        for backendName, metrics in entries:
+            records.append({"circuit": file, "backend": backendName,
+                            "mode": mode, **metrics})
+
+    return records
+
+
 def QuarryInit(qasmFile, n=10):
-    QUtil.GLOBAL_BASIS_GATES = QUtil.getGlobalBasisGates()
+    #Precomputed profiles, also sets QUtil.GLOBAL_BASIS_GATES
+    BackendStore.load()
 
     #Read in given circuit
-    qc = QuantumCircuit.from_qasm_file(qasmFile)
+    qc = QasmCache.getCircuit(qasmFile)
     qc.name = qasmFile
 
     backendsIBMQ = None
@@ -328,6 +733,8 @@ def QuarryInit(qasmFile, n=10):
         with open(TOKEN_FILE) as f:
             TOKEN = f.read()
 
+        from qiskit import IBMQ
+
         print("Token found, using pulling IBMQ data...", end='')
         IBMQ.save_account(TOKEN, overwrite=True)
         IBMQ.load_account()
@@ -338,27 +745,66 @@ def QuarryInit(qasmFile, n=10):
         print("Done")
 
     else:
-        backends = QUtil.getFakeBackends(qc, n)
+        backends = BackendStore.getProfiles(qc, n)
 
     return qc, backends
 
 
 def main():
+    global CASCADE_K1, CASCADE_K2, CASCADE_BUDGET, LAYOUT_SEARCH
+
     parser = argparse.ArgumentParser(
         description="Make a query to Quarry for the given QASM circuit file.")
     parser.add_argument(
         'file', type=str, help='QASM file to estimate fidelity on.')
     parser.add_argument(
-        'mode', type=str, help='Method type to query with (simulation|P1|P2|ESP|SWAP_PRED|SWAP_COMPILE|SWAP_COMPARE)')
+        'mode', type=str, help='Method type to query with (simulation|ADAPTIVE|P1|P2|ESP|SWAP_PRED|SWAP_COMPILE|SWAP_COMPARE|SWAP_EST|SWAP_EST_COMPARE|CASCADE)')
+    parser.add_argument(
+        '--n', type=int, help='Number of backend platforms to test on. (Default 10, every fitting backend in cascade mode)', default=None)
     parser.add_argument(
-        '--n', type=int, help='Number of backend platforms to test on. (Default 10)', default=10)
+        '--jobs', type=int, help='Number of worker processes to query backends with, ignored in adaptive mode. (Default 1)', default=1)
+    parser.add_argument(
+        '--top-k', type=int, help='Adaptive mode: stop backends that cannot reach the top k. (Default rank all)', default=None)
+    parser.add_argument(
+        '--ci-width', type=float, help='Adaptive mode: target confidence interval width. (Default {})'.format(AdaptiveSim.CI_WIDTH), default=AdaptiveSim.CI_WIDTH)
+    parser.add_argument(
+        '--max-shots', type=int, help='Adaptive mode: shot limit per backend, at least {}. (Default {})'.format(AdaptiveSim.MIN_SHOTS, AdaptiveSim.MAX_SHOTS), default=AdaptiveSim.MAX_SHOTS)
+    parser.add_argument(
+        '--calibrations', type=str, help='Directory of calibration CSVs replacing the ESP, P2 and simulation error data of matching backends. (Default none)', default=None)
+    parser.add_argument(
+        '--k1', type=int, help='Cascade mode: ESP ranked backends passed to P2. (Default {})'.format(CASCADE_K1), default=CASCADE_K1)
+    parser.add_argument(
+        '--k2', type=int, help='Cascade mode: P2 ranked backends passed to simulation. (Default {})'.format(CASCADE_K2), default=CASCADE_K2)
+    parser.add_argument(
+        '--budget', type=float, help='Cascade mode: seconds after which no further stage is started. (Default no limit)', default=None)
+    parser.add_argument(
+        '--layout-search', action='store_true', help='ESP, simulation and cascade modes: place the circuit on the layout of highest estimated ESP.')
 
     args = parser.parse_args()
 
+    #Backends are never stopped before MIN_SHOTS
+    if args.max_shots < AdaptiveSim.MIN_SHOTS:
+        parser.error("--max-shots must be at least {}".format(AdaptiveSim.MIN_SHOTS))
+
+    LAYOUT_SEARCH = args.layout_search
+
+    CASCADE_K1 = args.k1
+    CASCADE_K2 = args.k2
+    CASCADE_BUDGET = args.budget
+
+    BackendStore.CALIBRATION_DIR = args.calibrations
+
+    AdaptiveSim.TOP_K = args.top_k
+    AdaptiveSim.CI_WIDTH = args.ci_width
+    AdaptiveSim.MAX_SHOTS = args.max_shots
+
     sys.stderr.write("QUARRY LOG HEADER ==========\n")
 
     backendCount = args.n
+    if backendCount is None and args.mode.lower() != "cascade":
+        backendCount = 10
     inputFile = args.file
+    jobs = args.jobs
 
     #Transform file to Qiskit circuit and retrieve compatible platforms
     qc, backends = QuarryInit(inputFile, backendCount)
@@ -366,57 +812,37 @@ def main():
     sys.stderr.write("Mode: {}\n".format(args.mode.lower()))
     sys.stderr.write("CircuitSize: {}\n".format(qc.size()))
     sys.stderr.write("NumQubits: {}\n".format(qc.num_qubits))
+    if args.mode.lower() == "adaptive" and jobs > 1:
+        sys.stderr.write("Adaptive mode runs in one process, --jobs is ignored\n")
+
+    resultDict, execTimes = runQuery(qc, backends, args.mode, jobs)
 
-    #ESP Estimate
     if args.mode.lower() == "esp":
-        resultDict, execTime = query(qc, backends, evalCircuitESP)
-        printResultsESP(resultDict, execTime)
+        printResultsESP(resultDict, execTimes[0])
 
-    #Simulation
     elif args.mode.lower() == "simulation":
-        resultDict, execTime = query(qc, backends, evalCircuitSim)
-        printResults(resultDict, execTime)
-
-    #ML Models
-    elif args.mode.lower() == "p1":
-        PredictorV1.load_models()
-        resultDict, execTime = query(qc, backends, evalCircuitPredictV1)
-        printResults(resultDict, execTime)
-
-    elif args.mode.lower() == "p2":
-        PredictorV2.load_models()
-        resultDict, execTime = query(qc, backends, evalCircuitPredictV2)
-        printResults(resultDict, execTime)
-
-    elif args.mode.lower() == "swap_pred":
-        SwapPredictor.load()
-        resultDictSwapPred, execTimeSwapPred = query(
-            qc, backends, evalSwapPredictor)
-
-        printResultsSwap(resultDictSwapPred, execTimeSwapPred)
+        printResults(resultDict, execTimes[0])
+        sys.stderr.write("NoiseCache: {}\n".format(NoiseCache.getStats()))
 
-    elif args.mode.lower() == "swap_compile":
-        resultDictSwapAct, execTimeSwapAct = query(
-            qc, backends, evalSwapCompiler)
+    elif args.mode.lower() == "adaptive":
+        printResultsAdaptive(resultDict, execTimes[0])
+        sys.stderr.write("Shots: {}\n".format(
+            sum(out["Shots"] for _, out in resultDict[qc.name])))
 
-        printResultsSwap(resultDictSwapAct, execTimeSwapAct)
+    elif args.mode.lower() in ["p1", "p2"]:
+        printResults(resultDict, execTimes[0])
 
-    elif args.mode.lower() == "swap_compare":
-        SwapPredictor.load()
-        resultDictSwapPred, execTimeSwapPred = query(
-            qc, backends, evalSwapPredictor)
-        resultDictSwapAct, execTimeSwapAct = query(
-            qc, backends, evalSwapCompiler)
+    elif args.mode.lower() in ["swap_pred", "swap_compile", "swap_est"]:
+        printResultsSwap(resultDict, execTimes[0])
 
-        #Merge predicted and actual dicts
-        for i in resultDictSwapPred.keys():
-            for j in resultDictSwapPred[i].keys():
-                resultDictSwapPred[i][j] = {
-                    **(resultDictSwapPred[i][j]), **(resultDictSwapAct[i][j])}
+    elif args.mode.lower() in ["swap_compare", "swap_est_compare"]:
+        printResultsSwapCompare(resultDict, execTimes[0], execTimes[1])
 
-        printResultsSwapCompare(
-            resultDictSwapPred, execTimeSwapPred, execTimeSwapAct)
+    elif args.mode.lower() == "cascade":
+        printResultsCascade(resultDict, execTimes[0])
 
+    if LAYOUT_SEARCH:
+        sys.stderr.write("LayoutSearch: {}\n".format(LayoutSearch.getStats()))
 
 if __name__ == "__main__":
     main()
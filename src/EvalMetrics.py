@@ -33,15 +33,13 @@ def _removekey(d, key_list):
 
 
 def normalizeDict(input_dict):
+    """Normalized copy of input_dict, the input is left unchanged"""
 
     if sum(input_dict.values()) == 0:
         print('Error, dictionary with total zero elements!!')
     factor = 1.0/sum(input_dict.values())
 
-    for k in input_dict:
-        input_dict[k] = input_dict[k]*factor
-
-    return input_dict
+    return {k: v*factor for k, v in input_dict.items()}
 
 
 def computePST(dict_in, correct_answer) -> float:
@@ -169,3 +167,85 @@ def computeEntropy(dict_in) -> float:
     P = np.asarray(P, dtype=np.float)
 
     return -1*sum(P*np.log(P))
+
+
+def alignCounts(dict_ideal, dicts_in):
+    """
+    Ideal and noisy counts as arrays over one shared outcome index.
+    Returns ideal (n,), noisy (m, n) and the masks of outcomes present in each.
+    """
+    index = {}
+
+    def encode(d):
+        ids = np.fromiter((index.setdefault(k, len(index)) for k in d),
+                          np.int64, len(d))
+        return ids, np.fromiter(d.values(), np.float64, len(d))
+
+    ideal_ids, ideal_vals = encode(dict_ideal)
+    encoded = [encode(d) for d in dicts_in]
+    n = len(index)
+
+    ideal = np.zeros(n)
+    ideal[ideal_ids] = ideal_vals
+    in_ideal = np.zeros(n, dtype=bool)
+    in_ideal[ideal_ids] = True
+
+    noisy = np.zeros((len(dicts_in), n))
+    in_noisy = np.zeros((len(dicts_in), n), dtype=bool)
+    for i, (ids, vals) in enumerate(encoded):
+        noisy[i, ids] = vals
+        in_noisy[i, ids] = True
+
+    return ideal, noisy, in_ideal, in_noisy
+
+
+def computeMetricsArrays(ideal, noisy, in_ideal, in_noisy, swaps=None) -> dict:
+    """
+    Metric arrays (one value per row of noisy) from aligned count arrays,
+    as returned by alignCounts.
+    """
+    q_norm = ideal/ideal.sum()
+    p_norm = noisy/noisy.sum(axis=1, keepdims=True)
+
+    pst = (p_norm*in_ideal).sum(axis=1)
+
+    #Same epsilons as computeTVD/L2/Hellinger add to the other side's outcomes
+    epsilon = 0.00000000001
+    p = p_norm + epsilon*in_ideal
+    q = q_norm + epsilon*in_noisy
+    tvd = np.abs(p - q).sum(axis=1)/2
+    l2 = np.sqrt(np.square(p - q).sum(axis=1))
+    hellinger = np.sqrt(np.square(np.sqrt(p) - np.sqrt(q)).sum(axis=1))
+
+    P = p_norm + 0.000001*in_noisy
+    entropy = -1*np.where(in_noisy, P*np.log(np.where(in_noisy, P, 1)), 0).sum(axis=1)
+
+    out = {"PST": pst, "TVD": tvd, "Entropy": entropy,
+           "L2": l2, "Hellinger": hellinger}
+
+    if swaps is not None:
+        #Vectorized fitness(), zero where the denominator is zero
+        swaps = np.broadcast_to(np.asarray(swaps, dtype=np.float64), pst.shape)
+        X = pst
+        Y = tvd + entropy/10 + swaps/10 + hellinger + l2
+        out["Fitness"] = np.divide(X, Y, out=np.zeros_like(X), where=Y != 0)
+
+    return out
+
+
+def computeMetrics(dict_ideal, dicts_in, swaps=None):
+    """
+    PST, TVD, L2, Hellinger, Entropy (and Fitness when swaps are given) of
+    one or many noisy count dicts against the ideal counts, matching the
+    single metric functions above. A list of dicts gives a list of results.
+    """
+    single = isinstance(dicts_in, dict)
+    if single:
+        dicts_in = [dicts_in]
+
+    out = computeMetricsArrays(*alignCounts(dict_ideal, dicts_in), swaps)
+
+    results = [{k: float(v[i]) for k, v in out.items()}
+               for i in range(len(dicts_in))]
+
+    return results[0] if single else results
@@ -0,0 +1,205 @@
+#Persistent store of model input rows for (circuit, backend) pairs.
+#Rows built by QUtil.getV1Input, getV2Input and getSWAPInput are kept in an
+#SQLite database keyed by the canonical circuit hash, the backend profile key
+#(name and calibration timestamp), the input kind and SCHEMA_VERSION. Bump
+#SCHEMA_VERSION whenever the feature code changes so stale rows are ignored.
+#
+#  python ./src/FeatureStore.py warm ./qasm/QASMBench/ --kinds v2 swap --jobs 8 &
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import threading
+import argparse
+import sqlite3
+import json
+import sys
+import os
+
+import QUtil
+import CircuitHash
+
+DB_PATH = "./feature_store.sqlite"
+
+SCHEMA_VERSION = 3
+
+#Seconds to wait on another process' write lock
+BUSY_TIMEOUT = 60
+
+KINDS = {"v1": QUtil.getV1Input,
+         "v2": QUtil.getV2Input,
+         "swap": QUtil.getSWAPInput}
+
+HITS = 0
+MISSES = 0
+
+#One connection per process and thread, sqlite3 connections are not shared
+_LOCAL = threading.local()
+
+
+def _connect(dbPath=DB_PATH):
+    connections = getattr(_LOCAL, "connections", None)
+    if connections is None or _LOCAL.pid != os.getpid():
+        connections = _LOCAL.connections = {}
+        _LOCAL.pid = os.getpid()
+
+    if dbPath not in connections:
+        conn = sqlite3.connect(dbPath, timeout=BUSY_TIMEOUT)
+        #WAL lets readers continue while a warming run writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS features (
+                            circuit TEXT, backend TEXT, kind TEXT, version INTEGER,
+                            row TEXT, PRIMARY KEY (circuit, backend, kind, version))""")
+        conn.commit()
+        connections[dbPath] = conn
+
+    return connections[dbPath]
+
+
+def _toRow(df) -> str:
+    #Object rows keep Python ints and floats, so dtypes survive the round trip
+    return json.dumps({"columns": list(df.columns), "values": df.astype(object).iloc[0].tolist()})
+
+
+def _fromRow(row: str):
+    from pandas import DataFrame
+
+    row = json.loads(row)
+    return DataFrame([row["values"]], columns=row["columns"])
+
+
+def getKey(qc, profile, kind) -> tuple:
+    return (CircuitHash.getCircuitHash(qc), profile.key, kind, SCHEMA_VERSION)
+
+
+def get(key, dbPath=DB_PATH):
+    """Stored input row of key as a one row DataFrame, None if missing"""
+    result = _connect(dbPath).execute(
+        "SELECT row FROM features WHERE circuit=? AND backend=? AND kind=? AND version=?",
+        key).fetchone()
+
+    return _fromRow(result[0]) if result is not None else None
+
+
+def put(key, df, dbPath=DB_PATH) -> None:
+    putMany([(key, df)], dbPath)
+
+
+def putMany(entries, dbPath=DB_PATH) -> None:
+    conn = _connect(dbPath)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?)",
+                         [(*key, _toRow(df)) for key, df in entries])
+
+
+def getFeatures(qc, profile, kind, dbPath=DB_PATH):
+    """KINDS[kind](qc, profile), computed once per circuit, calibration and schema"""
+    global HITS, MISSES
+
+    key = getKey(qc, profile, kind)
+    df = get(key, dbPath)
+    if df is not None:
+        HITS += 1
+        return df
+
+    MISSES += 1
+    df = KINDS[kind](qc, profile)
+    put(key, df, dbPath)
+
+    return df
+
+
+def _warmCircuit(qasmFile, kinds, n, dbPath):
+    """Missing input rows of one circuit, computed in a worker process"""
+    import BackendStore
+    import QasmCache
+
+    qc = QasmCache.getCircuit(qasmFile)
+    qc.name = qasmFile
+
+    entries = []
+    for profile in BackendStore.getProfiles(qc, n):
+        for kind in kinds:
+            key = getKey(qc, profile, kind)
+            if get(key, dbPath) is None:
+                entries.append((key, KINDS[kind](qc, profile)))
+
+    return entries
+
+
+def warm(files, kinds, n=10, jobs=1, dbPath=DB_PATH) -> int:
+    """Precompute the input rows of files on their n best fitting backends"""
+    import BackendStore
+
+    #Build the profile store and the table before workers race to
+    BackendStore.load()
+    _connect(dbPath)
+
+    count = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_warmCircuit, f, kinds, n, dbPath): f for f in files}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                entries = future.result()
+            except Exception as e:
+                sys.stderr.write("{} failed: {!r}\n".format(futures[future], e))
+                continue
+
+            #Rows are written by this process only, workers just read
+            putMany(entries, dbPath)
+            count += len(entries)
+            sys.stderr.write("[{}/{}] {}, {} new rows\n".format(
+                i + 1, len(files), futures[future], len(entries)))
+
+    return count
+
+
+def getStats(dbPath=DB_PATH) -> dict:
+    rows = _connect(dbPath).execute(
+        "SELECT kind, version, COUNT(*) FROM features GROUP BY kind, version").fetchall()
+
+    return {"hits": HITS, "misses": MISSES,
+            "rows": {"{}:v{}".format(kind, version): count for kind, version, count in rows}}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute and inspect stored model input rows.")
+    parser.add_argument(
+        'command', type=str, choices=["warm", "stats", "prune"],
+        help='warm: precompute rows for a corpus, stats: count rows, prune: drop rows of old schema versions.')
+    parser.add_argument(
+        'inputs', type=str, nargs='*', help='QASM files, directories or glob patterns to warm.')
+    parser.add_argument(
+        '--manifest', type=str, help='File listing one QASM path per line.', default=None)
+    parser.add_argument(
+        '--kinds', type=str, nargs='+', choices=list(KINDS), help='Input rows to compute. (Default v1 v2 swap)',
+        default=list(KINDS))
+    parser.add_argument(
+        '--n', type=int, help='Number of backend platforms per circuit. (Default 10)', default=10)
+    parser.add_argument(
+        '--jobs', type=int, help='Number of worker processes. (Default 1)', default=1)
+    parser.add_argument(
+        '--db', type=str, help='Database file. (Default {})'.format(DB_PATH), default=DB_PATH)
+
+    args = parser.parse_args()
+
+    if args.command == "warm":
+        import BatchQuery
+
+        files = BatchQuery.expandInputs(args.inputs, args.manifest)
+        if not files:
+            parser.error("No QASM files given")
+
+        count = warm(files, args.kinds, args.n, args.jobs, args.db)
+        print("Stored {} new rows for {} circuits".format(count, len(files)))
+    elif args.command == "prune":
+        conn = _connect(args.db)
+        with conn:
+            deleted = conn.execute("DELETE FROM features WHERE version != ?",
+                                   (SCHEMA_VERSION,)).rowcount
+        conn.execute("VACUUM")
+        print("Removed {} rows".format(deleted))
+    else:
+        print(json.dumps(getStats(args.db), indent=1))
+
+
+if __name__ == "__main__":
+    main()
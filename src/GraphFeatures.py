@@ -0,0 +1,251 @@
+#Graph features of machine coupling maps and circuit interaction graphs.
+#Gives the same values as the networkx functions QUtil.getGraphMetrics used
+#to call, computed from one CSR adjacency per graph: shortest paths by BFS
+#in scipy.sparse.csgraph, and node connectivity by max flow only for the
+#node pairs that degree bounds and biconnected components leave undecided.
+#Features are cached per graph, so a coupling map, or a circuit scored on
+#several backends, is measured once.
+from collections import OrderedDict
+from statistics import mean
+import numpy as np
+import threading
+
+#Cached graphs, machine graphs plus recently scored circuits
+MAX_ENTRIES = 1024
+
+HITS = 0
+MISSES = 0
+
+_CACHE = OrderedDict()
+_LOCK = threading.RLock()
+
+
+def getAdjacency(nodes: list, edges: list, directed: bool):
+    """0/1 int32 CSR adjacency with rows and columns in node order"""
+    from scipy.sparse import csr_matrix
+
+    ids = {v: i for i, v in enumerate(nodes)}
+    rows = [ids[u] for u, v in edges]
+    cols = [ids[v] for u, v in edges]
+    if not directed:
+        rows, cols = rows + cols, cols + rows
+
+    n = len(nodes)
+    A = csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(n, n))
+    A.sum_duplicates()
+    A.data[:] = 1
+
+    return A
+
+
+def getDensity(A, directed: bool) -> float:
+    n = A.shape[0]
+    m = A.nnz if directed else A.nnz//2
+    if m == 0 or n <= 1:
+        return 0
+
+    d = m/(n*(n - 1))
+    if not directed:
+        d *= 2
+    return d
+
+
+def getAvgNeighborDegree(A) -> float:
+    """Mean over nodes of the average out degree of their successors"""
+    if A.shape[0] == 0:
+        return 0
+
+    degree = np.diff(A.indptr).astype(np.int64)
+    nbrDegree = A @ degree
+    avg = np.where(degree == 0, 0.0, nbrDegree/np.maximum(degree, 1))
+
+    return mean(avg.tolist())
+
+
+def getAvgClustering(A, directed: bool) -> float:
+    """Average (directed) clustering coefficient, summed in node order"""
+    n = A.shape[0]
+    if n == 0:
+        return 0
+
+    A = A.astype(np.int64)
+    if directed:
+        #Fagiolo's directed triangles, (A + A^T)^3 on the diagonal
+        S = A + A.T
+        triangles = np.asarray((S @ S).multiply(S).sum(axis=1)).ravel()
+        total = np.diff(A.indptr) + np.diff(A.T.tocsr().indptr)
+        reciprocal = np.asarray(A.multiply(A.T).sum(axis=1)).ravel()
+        pairs = (total*(total - 1) - 2*reciprocal)*2
+    else:
+        #Twice the triangles through each node, A^3 on the diagonal
+        triangles = np.asarray((A @ A).multiply(A).sum(axis=1)).ravel()
+        degree = np.diff(A.indptr)
+        pairs = degree*(degree - 1)
+
+    clustering = np.zeros(n)
+    hasTriangle = triangles != 0
+    clustering[hasTriangle] = triangles[hasTriangle]/pairs[hasTriangle]
+
+    return sum(clustering.tolist())/n
+
+
+def getAvgShortestPath(A, directed: bool, dist=None) -> float:
+    """Mean hop distance over reachable ordered pairs, graph must be connected"""
+    from scipy.sparse.csgraph import connected_components, shortest_path
+
+    n = A.shape[0]
+    if n == 0:
+        raise ValueError("Null graph has no paths")
+    if n == 1:
+        return 0
+
+    #Directed graphs only need to be weakly connected, as in networkx
+    if connected_components(A, directed=directed, connection='weak',
+                            return_labels=False) > 1:
+        raise ValueError("Graph is not connected")
+
+    if dist is None:
+        dist = shortest_path(A, directed=directed, unweighted=True)
+    total = int(dist[np.isfinite(dist)].sum())
+
+    return total/(n*(n - 1))
+
+
+def _splitGraph(A):
+    """Node split flow network, node i enters at i and leaves at n + i"""
+    from scipy.sparse import csr_matrix
+
+    n = A.shape[0]
+    rows, cols = A.nonzero()
+    rows = np.concatenate([np.arange(n), rows + n])
+    cols = np.concatenate([np.arange(n) + n, cols])
+
+    return csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(2*n, 2*n))
+
+
+def _getBlockPairs(A) -> np.ndarray:
+    """Node pairs sharing a biconnected component of 3 or more nodes"""
+    import networkx
+
+    n = A.shape[0]
+    G = networkx.Graph()
+    G.add_nodes_from(range(n))
+    G.add_edges_from(zip(*A.nonzero()))
+
+    shared = np.zeros((n, n), dtype=bool)
+    for block in networkx.biconnected_components(G):
+        if len(block) > 2:
+            block = list(block)
+            shared[np.ix_(block, block)] = True
+
+    return shared
+
+
+def getAvgConnectivity(A, directed: bool, reachable=None) -> float:
+    """
+    Average local node connectivity over all (ordered if directed) node pairs.
+    A pair's connectivity is at most min(out degree, in degree). In undirected
+    or symmetric graphs it is 1 for reachable pairs a cut node separates and
+    at least 2 for pairs sharing a biconnected component, so max flow only
+    runs for pairs in a common block whose degree bound is 3 or more.
+    """
+    from scipy.sparse.csgraph import maximum_flow
+
+    n = A.shape[0]
+    if n < 2:
+        return 0
+
+    if reachable is None:
+        reachable = _getReachable(A, directed)
+
+    outDegree = np.diff(A.indptr)
+    inDegree = np.bincount(A.indices, minlength=n)
+    bound = np.minimum.outer(outDegree, inDegree)
+    bound[~reachable] = 0
+
+    #Coupling maps are mostly symmetric, then (s, t) and (t, s) are equal
+    symmetric = not directed or (A != A.T).nnz == 0
+    pairs = np.ones((n, n), dtype=bool)
+    pairs = np.triu(pairs, 1) if symmetric else pairs & ~np.eye(n, dtype=bool)
+
+    known = bound <= 1
+    if symmetric:
+        shared = _getBlockPairs(A)
+        bound[~shared & (bound > 1)] = 1
+        known = (bound <= 1) | (bound == 2)
+
+    total = int(bound[pairs & known].sum())
+    split = None
+    for s, t in zip(*np.nonzero(pairs & ~known)):
+        if split is None:
+            split = _splitGraph(A)
+        total += int(maximum_flow(split, n + s, t).flow_value)
+
+    if symmetric and directed:
+        total *= 2
+    return total/(n*(n - 1) if directed else n*(n - 1)//2)
+
+
+def _getReachable(A, directed: bool, dist=None) -> np.ndarray:
+    from scipy.sparse.csgraph import connected_components, shortest_path
+
+    if directed:
+        if dist is None:
+            dist = shortest_path(A, directed=True, unweighted=True)
+        return np.isfinite(dist)
+
+    _, labels = connected_components(A, directed=False)
+    return labels[:, None] == labels[None, :]
+
+
+def computeMetrics(nodes: list, edges: list, directed: bool, shortestPath=True) -> dict:
+    """Unlabeled graph metrics, see getGraphMetrics()"""
+    from scipy.sparse.csgraph import shortest_path
+
+    A = getAdjacency(nodes, edges, directed)
+
+    #One BFS from every node serves reachability and path lengths
+    dist = None
+    if shortestPath or directed:
+        dist = shortest_path(A, directed=directed, unweighted=True)
+
+    output = {}
+    output["GraphDensity"] = getDensity(A, directed)
+    output["AvgConnectivity"] = getAvgConnectivity(
+        A, directed, _getReachable(A, directed, dist))
+    output["AvgNeighborDegree"] = getAvgNeighborDegree(A)
+    output["AvgClustering"] = getAvgClustering(A, directed)
+    output["AvgShortestPath"] = getAvgShortestPath(A, directed, dist) \
+        if shortestPath else 0
+
+    return output
+
+
+def getGraphMetrics(nodes: list, edges: list, directed: bool, label: str) -> dict:
+    """
+    {label}GraphDensity, AvgConnectivity, AvgNeighborDegree, AvgClustering
+    and AvgShortestPath of a graph given in networkx node and edge order.
+    Shortest paths are not collected for CX graphs, which may be disconnected.
+    Raises ValueError for the path length of a null or disconnected graph.
+    """
+    global HITS, MISSES
+
+    shortestPath = label != "CX"
+    key = (tuple(nodes), tuple(edges), directed, shortestPath)
+    with _LOCK:
+        if key in _CACHE:
+            HITS += 1
+            _CACHE.move_to_end(key)
+            metrics = _CACHE[key]
+        else:
+            MISSES += 1
+            metrics = computeMetrics(nodes, edges, directed, shortestPath)
+            _CACHE[key] = metrics
+            while len(_CACHE) > MAX_ENTRIES:
+                _CACHE.popitem(last=False)
+
+    return {"{}{}".format(label, k): v for k, v in metrics.items()}
+
+
+def getStats() -> dict:
+    return {"hits": HITS, "misses": MISSES, "entries": len(_CACHE)}
@@ -0,0 +1,225 @@
+#Ideal (noise free) output distribution of a circuit, computed once.
+#Exact statevector probabilities are used when the circuit is narrow enough,
+#exact stabilizer probabilities for wider Clifford circuits, and sampling
+#otherwise. Results are keyed by the canonical circuit hash, held in memory
+#and on disk, and formatted like Result.get_counts() keys.
+#
+#Every method returns outcomes mapped to their probability. Exact methods
+#keep every outcome above PROB_TOLERANCE, however unlikely: truncating at the
+#shot resolution would empty the distribution of near uniform circuits on
+#more than log2(SAMPLE_SHOTS) qubits. Sampled entries are tagged in the cache
+#and computed again once an exact method applies to the circuit.
+from os.path import exists, join
+import numpy as np
+import json
+import os
+
+import CircuitHash
+
+CACHE_DIR = "./ideal_cache/"
+
+#Widest circuit simulated as a full statevector (2^n amplitudes)
+STATEVECTOR_MAX_QUBITS = 20
+
+#Largest Clifford outcome support enumerated exactly (log2 of outcome count)
+STABILIZER_MAX_OUTCOMES = 16
+
+#Shots when sampling, execute()'s default
+SAMPLE_SHOTS = 1024
+
+#Probabilities below this are numerical noise, not outcomes
+PROB_TOLERANCE = 1e-12
+
+#Entries of other versions are computed again
+CACHE_VERSION = 3
+
+HITS = 0
+MISSES = 0
+
+_CACHE = {}
+
+
+def _splitMeasurements(qc):
+    """
+    Unitary part of qc and its final measurements as [(qubit, clbit)], or
+    None if qc measures mid circuit, resets or uses classical control.
+    """
+    from qiskit import QuantumCircuit
+
+    unitary = QuantumCircuit(*qc.qregs)
+    measures = []
+    measured = set()
+    for instruction, qargs, cargs in qc._data:
+        if instruction.name == "barrier":
+            continue
+
+        if instruction.name == "measure":
+            if qargs[0]._index in measured or instruction.condition is not None:
+                return None, None
+            measures.append((qargs[0]._index, cargs[0]))
+            measured.add(qargs[0]._index)
+            continue
+
+        if instruction.condition is not None or cargs or instruction.name == "reset" \
+                or any(q._index in measured for q in qargs):
+            return None, None
+
+        unitary.append(instruction, qargs, cargs)
+
+    return unitary, measures
+
+
+def _formatCounts(qc, measures, probs: dict) -> dict:
+    """Outcome index over measured qubits -> get_counts() style key"""
+    regs = {reg.name: i for i, reg in enumerate(qc.cregs)}
+    counts = {}
+    for outcome, p in probs.items():
+        bits = [['0']*reg.size for reg in qc.cregs]
+        for j, (q, c) in enumerate(measures):
+            bits[regs[c._register.name]][c._index] = str((outcome >> j) & 1)
+
+        #Registers print last first, each with its highest bit first
+        key = ' '.join(''.join(reversed(b)) for b in reversed(bits))
+        counts[key] = counts.get(key, 0) + p
+
+    return counts
+
+
+def _statevectorProbs(unitary, measures) -> dict:
+    from qiskit.quantum_info import Statevector
+
+    probs = Statevector(unitary).probabilities([q for q, c in measures])
+    nonzero = np.flatnonzero(probs > PROB_TOLERANCE)
+
+    return dict(zip(nonzero.tolist(), probs[nonzero].tolist()))
+
+
+def _gf2Rank(M) -> int:
+    M = M.copy()
+    rank = 0
+    for col in range(M.shape[1]):
+        pivot = np.flatnonzero(M[rank:, col])
+        if len(pivot) == 0:
+            continue
+
+        pivot = rank + pivot[0]
+        M[[rank, pivot]] = M[[pivot, rank]]
+        rows = np.flatnonzero(M[:, col])
+        rows = rows[rows != rank]
+        M[rows] ^= M[rank]
+
+        rank += 1
+        if rank == M.shape[0]:
+            break
+
+    return rank
+
+
+def _stabilizerProbs(unitary, measures):
+    """Exact Clifford distribution, None if not Clifford or too many outcomes"""
+    from qiskit.quantum_info import Clifford, StabilizerState
+    from qiskit.exceptions import QiskitError
+
+    try:
+        clifford = Clifford(unitary)
+    except QiskitError:
+        return None
+
+    #The outcomes are uniform over 2^d strings, d = |Q| - dim(S ∩ <Z_Q>)
+    n = unitary.num_qubits
+    qubits = [q for q, c in measures]
+    other = np.ones(n, dtype=bool)
+    other[qubits] = False
+    X = clifford.stabilizer.X
+    Z = clifford.stabilizer.Z
+    d = len(qubits) - n + _gf2Rank(np.hstack([X, Z[:, other]]))
+    if d > STABILIZER_MAX_OUTCOMES:
+        return None
+
+    probs = StabilizerState(clifford).probabilities_dict(qubits)
+    return {int(k, 2): p for k, p in probs.items() if p > PROB_TOLERANCE}
+
+
+def _sampleCounts(qc, maxJobs) -> dict:
+    from qiskit import Aer, execute
+
+    result = execute(qc, backend=Aer.get_backend('qasm_simulator'),
+                     shots=SAMPLE_SHOTS, max_parallel_threads=maxJobs).result()
+    return {k: v/SAMPLE_SHOTS for k, v in result.get_counts().items()}
+
+
+def _exactIdeal(qc):
+    """Exact distribution of qc and its method, (None, None) if not feasible"""
+    unitary, measures = _splitMeasurements(qc)
+
+    if unitary is not None and measures:
+        if qc.num_qubits <= STATEVECTOR_MAX_QUBITS:
+            probs = _statevectorProbs(unitary, measures)
+            return _formatCounts(qc, measures, probs), "statevector"
+
+        probs = _stabilizerProbs(unitary, measures)
+        if probs is not None:
+            return _formatCounts(qc, measures, probs), "stabilizer"
+
+    return None, None
+
+
+def computeIdeal(qc, maxJobs=0):
+    """Ideal distribution of qc and the method used (statevector|stabilizer|sampled)"""
+    probs, method = _exactIdeal(qc)
+    if probs is not None:
+        return probs, method
+
+    return _sampleCounts(qc, maxJobs), "sampled"
+
+
+def _writeEntry(path, counts, method) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmpPath, 'w') as f:
+        json.dump({"version": CACHE_VERSION, "method": method, "counts": counts}, f)
+    os.replace(tmpPath, path)
+
+
+def getIdealCounts(qc, maxJobs=0, cacheDir=CACHE_DIR) -> dict:
+    """Ideal outcomes of qc and their probabilities, see the module header"""
+    global HITS, MISSES
+
+    key = CircuitHash.getCircuitHash(qc)
+    if key in _CACHE:
+        HITS += 1
+        return _CACHE[key]
+
+    path = join(cacheDir, key[:2], key + ".json")
+    counts = None
+    if exists(path):
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if entry.get("version") == CACHE_VERSION:
+                counts, method = entry["counts"], entry["method"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    #Samples were only kept because no exact method applied at the time
+    if counts is not None and method == "sampled":
+        exact, method = _exactIdeal(qc)
+        if exact is not None:
+            counts = exact
+            _writeEntry(path, counts, method)
+
+    if counts is not None:
+        HITS += 1
+        _CACHE[key] = counts
+        return counts
+
+    MISSES += 1
+    counts, method = computeIdeal(qc, maxJobs)
+    _CACHE[key] = counts
+    _writeEntry(path, counts, method)
+
+    return counts
+
+
+def getStats() -> dict:
+    return {"hits": HITS, "misses": MISSES, "entries": len(_CACHE)}
@@ -0,0 +1,347 @@
+#Noise-aware initial layout search scored by vectorized ESP.
+#A circuit unrolled to the backend basis gates (without a coupling map, so
+#qubits stay logical) is reduced to a histogram over (gate, qubit, qubit).
+#The log ESP of a layout is then a gather from per-qubit and per-pair log
+#success tables, so whole arrays of candidate layouts are scored at once.
+#Candidates are exact placements of the circuit's interaction graph on the
+#coupling map where VF2 finds one within MAX_EXACT_TIME, else greedy
+#placements from every physical qubit, and the best are refined by moving or
+#exchanging single qubits.
+#Pairs that are not coupled are charged three two-qubit gates (one SWAP)
+#per edge of their most reliable path, an estimate of routing that
+#transpile() will replace with actual SWAPs.
+from collections import OrderedDict
+import numpy as np
+import threading
+import time
+
+import ESPEngine
+import TranspileCache
+import CircuitHash
+
+#Exact placements scored before falling back to greedy candidates only
+MAX_CANDIDATES = 5000
+
+#Larger interaction graphs are placed greedily, VF2 may not finish on them
+MAX_EXACT_QUBITS = 16
+
+#Seconds VF2 may search for exact placements, it can take exponential time
+#on interaction graphs with no embedding (e.g. a triangle on a grid)
+MAX_EXACT_TIME = 1.0
+
+#Layouts refined by local search, and its rounds per layout
+REFINE_TOP = 8
+MAX_ROUNDS = 50
+
+#Two-qubit gates spent moving a qubit across one coupling
+SWAP_GATES = 3
+
+#Cached best layouts, by circuit and backend calibration
+MAX_ENTRIES = 1024
+
+SCORED = 0
+SEARCH_TIME = 0
+
+_CACHE = OrderedDict()
+_COSTS = {}
+_LOCK = threading.RLock()
+
+
+def getCircuitHistogram(qc, profile):
+    """
+    Gate ids, qubit pairs and counts of qc unrolled to profile's basis gates,
+    split into single-qubit (and readout) entries and two-qubit entries.
+    """
+    unroll_qc = TranspileCache.getTranspiled(
+        qc, basisGates=profile.basisGates, optimizationLevel=0)
+
+    n = unroll_qc.num_qubits
+    index, counts = ESPEngine.getHistogram(unroll_qc, profile.gateIds, n)
+    gates, pairs = np.divmod(index, n*n)
+    q0, q1 = np.divmod(pairs, n)
+
+    single = q0 == q1
+    return {"numQubits": n,
+            "single": (gates[single], q0[single], counts[single]),
+            "pair": (gates[~single], q0[~single], q1[~single], counts[~single])}
+
+
+def getPairCosts(profile, gates) -> dict:
+    """
+    -log success of each two-qubit gate in gates between any two physical
+    qubits, coupled pairs at their own cost and others routed.
+    """
+    from scipy.sparse.csgraph import shortest_path
+
+    costs = _COSTS.setdefault(profile.key, {})
+    n = profile.numQubits
+    logTable = ESPEngine.getLogTable(profile).reshape(-1, n, n)
+
+    coupled = np.zeros((n, n), dtype=bool)
+    for a, b in profile.couplingMap or []:
+        coupled[a, b] = coupled[b, a] = True
+
+    for gate in gates:
+        gate = int(gate)
+        if gate in costs:
+            continue
+
+        #Gate direction is fixed by single qubit gates, so use the better one
+        cost = -np.maximum(logTable[gate], logTable[gate].T)
+        cost[~coupled] = np.inf
+
+        #Zero weights would read as missing edges
+        weights = np.where(coupled, np.maximum(cost, 1e-12), 0)
+        routed = SWAP_GATES*shortest_path(weights, directed=False)
+
+        cost = np.where(coupled, cost, routed)
+        np.fill_diagonal(cost, np.inf)
+        costs[gate] = cost
+
+    return costs
+
+
+def scoreLayouts(layouts: np.ndarray, histogram: dict, profile) -> np.ndarray:
+    """Estimated log ESP of each row of layouts (logical -> physical qubit)"""
+    global SCORED
+
+    n = profile.numQubits
+    logTable = ESPEngine.getLogTable(profile).reshape(-1, n, n)
+
+    gates, q, counts = histogram["single"]
+    scores = logTable[gates[None, :], layouts[:, q], layouts[:, q]] @ counts
+
+    gates, q0, q1, counts = histogram["pair"]
+    costs = getPairCosts(profile, np.unique(gates))
+    for gate in np.unique(gates):
+        select = gates == gate
+        cost = costs[int(gate)][layouts[:, q0[select]], layouts[:, q1[select]]]
+        scores = scores - cost @ counts[select]
+
+    SCORED += len(layouts)
+    #Unreachable pairs give -inf, not nan
+    return np.nan_to_num(scores, nan=-np.inf)
+
+
+def _getInteractions(histogram) -> dict:
+    """Two-qubit gate counts per logical qubit pair"""
+    weights = {}
+    _, q0, q1, counts = histogram["pair"]
+    for a, b, c in zip(q0.tolist(), q1.tolist(), counts.tolist()):
+        key = (min(a, b), max(a, b))
+        weights[key] = weights.get(key, 0) + c
+
+    return weights
+
+
+def _getSingleScores(histogram, profile) -> np.ndarray:
+    """Log success of each logical qubit's single qubit gates on each physical qubit"""
+    n = profile.numQubits
+    logTable = ESPEngine.getLogTable(profile).reshape(-1, n, n)
+    diagonal = np.arange(n)
+
+    scores = np.zeros((histogram["numQubits"], n))
+    for gate, q, count in zip(*histogram["single"]):
+        scores[q] += count*logTable[gate, diagonal, diagonal]
+
+    return scores
+
+
+def _placeRemaining(layout: np.ndarray, single: np.ndarray) -> np.ndarray:
+    """Put unplaced (-1) logical qubits on the best free physical qubits"""
+    free = np.ones(single.shape[1], dtype=bool)
+    free[layout[layout >= 0]] = False
+
+    for q in np.nonzero(layout < 0)[0]:
+        candidates = np.nonzero(free)[0]
+        p = int(candidates[np.argmax(single[q, candidates])])
+        layout[q] = p
+        free[p] = False
+
+    return layout
+
+
+class _SearchTimeout(Exception):
+    pass
+
+
+def getExactLayouts(histogram, profile) -> list:
+    """
+    Placements where every interacting pair of qubits is coupled, those found
+    within MAX_EXACT_TIME seconds.
+    """
+    import networkx
+    from networkx.algorithms import isomorphism
+
+    deadline = time.perf_counter() + MAX_EXACT_TIME
+
+    class Matcher(isomorphism.GraphMatcher):
+        #Called for every candidate pair, so the search cannot run past it
+        def syntactic_feasibility(self, G1_node, G2_node):
+            if time.perf_counter() > deadline:
+                raise _SearchTimeout
+            return super().syntactic_feasibility(G1_node, G2_node)
+
+    interactions = _getInteractions(histogram)
+    if not interactions:
+        return []
+
+    H = networkx.Graph()
+    H.add_edges_from(interactions)
+    G = networkx.Graph()
+    G.add_edges_from(profile.couplingMap or [])
+
+    if H.number_of_nodes() > MAX_EXACT_QUBITS or H.number_of_edges() > G.number_of_edges() \
+            or max(dict(H.degree).values()) > max(dict(G.degree).values(), default=0):
+        return []
+
+    single = _getSingleScores(histogram, profile)
+    layouts = []
+    matcher = Matcher(G, H)
+    try:
+        for mapping in matcher.subgraph_monomorphisms_iter():
+            layout = np.full(histogram["numQubits"], -1, dtype=np.int64)
+            for p, q in mapping.items():
+                layout[q] = p
+
+            layouts.append(_placeRemaining(layout, single))
+            if len(layouts) >= MAX_CANDIDATES:
+                break
+    except _SearchTimeout:
+        pass
+
+    return layouts
+
+
+def getGreedyLayouts(histogram, profile) -> list:
+    """
+    One placement per physical start qubit, adding logical qubits in order of
+    interaction and putting each where it is cheapest to its placed partners.
+    """
+    n = histogram["numQubits"]
+    interactions = _getInteractions(histogram)
+    single = _getSingleScores(histogram, profile)
+
+    gates = np.unique(histogram["pair"][0])
+    costs = getPairCosts(profile, gates)
+    cost = np.mean([costs[int(g)] for g in gates], axis=0) if len(gates) \
+        else np.zeros((profile.numQubits, profile.numQubits))
+
+    weights = np.zeros((n, n))
+    for (a, b), c in interactions.items():
+        weights[a, b] = weights[b, a] = c
+
+    #Busiest qubit first, then always the qubit most tied to placed ones
+    first = int(np.argmax(weights.sum(axis=1)))
+
+    layouts = []
+    for start in range(profile.numQubits):
+        layout = np.full(n, -1, dtype=np.int64)
+        free = np.ones(profile.numQubits, dtype=bool)
+        layout[first] = start
+        free[start] = False
+
+        for _ in range(n - 1):
+            placed = layout >= 0
+            ties = np.where(placed, -1, weights[:, placed].sum(axis=1))
+            q = int(np.argmax(ties))
+
+            partners = np.nonzero(placed & (weights[q] > 0))[0]
+            score = single[q] - weights[q, partners] @ cost[layout[partners]]
+            candidates = np.nonzero(free)[0]
+            p = int(candidates[np.argmax(score[candidates])])
+            layout[q] = p
+            free[p] = False
+
+        layouts.append(layout)
+
+    return layouts
+
+
+def _getNeighbors(layout: np.ndarray, numPhysical: int) -> np.ndarray:
+    """Every layout one logical qubit move (or exchange) away from layout"""
+    n = len(layout)
+    owner = np.full(numPhysical, -1, dtype=np.int64)
+    owner[layout] = np.arange(n)
+
+    q, p = np.meshgrid(np.arange(n), np.arange(numPhysical), indexing='ij')
+    q, p = q.ravel(), p.ravel()
+    keep = layout[q] != p
+    q, p = q[keep], p[keep]
+
+    neighbors = np.repeat(layout[None, :], len(q), axis=0)
+    rows = np.arange(len(q))
+    other = owner[p]
+
+    #A qubit already on p takes the moved qubit's old place
+    exchange = other >= 0
+    neighbors[rows[exchange], other[exchange]] = layout[q[exchange]]
+    neighbors[rows, q] = p
+
+    return neighbors
+
+
+def refine(layout: np.ndarray, score: float, histogram, profile):
+    """Hill climb over single qubit moves, returns the best layout and score"""
+    for _ in range(MAX_ROUNDS):
+        neighbors = _getNeighbors(layout, profile.numQubits)
+        if len(neighbors) == 0:
+            break
+
+        scores = scoreLayouts(neighbors, histogram, profile)
+        best = int(np.argmax(scores))
+        if scores[best] <= score:
+            break
+
+        layout, score = neighbors[best], float(scores[best])
+
+    return layout, score
+
+
+def searchLayout(qc, profile) -> dict:
+    """Best layout found for qc on profile, its estimated log ESP and ESP"""
+    global SEARCH_TIME
+
+    timeBegin = time.time_ns()
+    histogram = getCircuitHistogram(qc, profile)
+
+    layouts = getExactLayouts(histogram, profile)
+    exact = len(layouts) > 0
+    if not exact:
+        layouts = getGreedyLayouts(histogram, profile)
+
+    layouts = np.unique(np.asarray(layouts, dtype=np.int64), axis=0)
+    scores = scoreLayouts(layouts, histogram, profile)
+
+    best = None
+    for i in np.argsort(scores)[::-1][:REFINE_TOP]:
+        layout, score = refine(layouts[i], float(scores[i]), histogram, profile)
+        if best is None or score > best[1]:
+            best = (layout, score)
+
+    SEARCH_TIME += time.time_ns() - timeBegin
+
+    return {"layout": [int(p) for p in best[0]], "logESP": best[1],
+            "ESP": float(np.exp(best[1])), "exact": exact, "candidates": len(layouts)}
+
+
+def getBestLayout(qc, profile) -> dict:
+    """searchLayout() memoized per circuit and backend calibration"""
+    key = (CircuitHash.getCircuitHash(qc), profile.key)
+    with _LOCK:
+        if key in _CACHE:
+            _CACHE.move_to_end(key)
+            return dict(_CACHE[key])
+
+    result = searchLayout(qc, profile)
+
+    with _LOCK:
+        _CACHE[key] = result
+        while len(_CACHE) > MAX_ENTRIES:
+            _CACHE.popitem(last=False)
+
+    return dict(result)
+
+
+def getStats() -> dict:
+    return {"scored": SCORED, "searchTime": SEARCH_TIME/(10**9), "entries": len(_CACHE)}
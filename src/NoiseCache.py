@@ -0,0 +1,88 @@
+#Memoized NoiseModel construction shared by every mode in a process.
+#Models are keyed by backend name plus calibration timestamp and evicted
+#least recently used first once a count or size cap is exceeded.
+from collections import OrderedDict
+import threading
+import pickle
+
+#Count cap, large enough to hold every fake backend by default
+MAX_ENTRIES = 64
+
+#Optional cap on the summed pickled size of cached models (bytes)
+MAX_BYTES = None
+
+HITS = 0
+MISSES = 0
+
+_CACHE = OrderedDict()
+_SIZES = {}
+
+#Guards the cache when queries share it across threads (QuarryServer.py)
+_LOCK = threading.RLock()
+
+
+def _evict() -> None:
+    #Always keep the most recent model, even if it alone is over the cap
+    while len(_CACHE) > 1:
+        overCount = len(_CACHE) > MAX_ENTRIES
+        overSize = MAX_BYTES is not None and sum(_SIZES.values()) > MAX_BYTES
+        if not (overCount or overSize):
+            break
+
+        key, _ = _CACHE.popitem(last=False)
+        _SIZES.pop(key, None)
+
+
+def getNoiseModel(profile):
+    """Noise model for a backend profile, built at most once while cached"""
+    global HITS, MISSES
+
+    with _LOCK:
+        key = profile.key
+        if key in _CACHE:
+            HITS += 1
+            _CACHE.move_to_end(key)
+            return _CACHE[key]
+
+        MISSES += 1
+        #Imported here since importing Aer is slow and most modes never need it
+        from qiskit.providers.aer.noise import NoiseModel
+        noise = NoiseModel.from_backend(profile.getNoiseBackend())
+        _CACHE[key] = noise
+
+        if MAX_BYTES is not None:
+            _SIZES[key] = len(pickle.dumps(noise))
+
+        _evict()
+        return noise
+
+
+def setLimits(maxEntries=None, maxBytes=None) -> None:
+    global MAX_ENTRIES, MAX_BYTES
+
+    if maxEntries is not None:
+        MAX_ENTRIES = maxEntries
+    MAX_BYTES = maxBytes
+
+    with _LOCK:
+        #Sizes are only tracked while a size cap is set
+        if MAX_BYTES is not None:
+            for key in _CACHE:
+                if key not in _SIZES:
+                    _SIZES[key] = len(pickle.dumps(_CACHE[key]))
+
+        _evict()
+
+
+def getStats() -> dict:
+    return {"hits": HITS, "misses": MISSES, "entries": len(_CACHE)}
+
+
+def clear() -> None:
+    global HITS, MISSES
+
+    with _LOCK:
+        _CACHE.clear()
+        _SIZES.clear()
+        HITS = 0
+        MISSES = 0
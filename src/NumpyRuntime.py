@@ -0,0 +1,292 @@
+#TensorFlow free inference for the Dense/BatchNormalization predictors.
+#Export folds each BatchNormalization (and the MinMaxScaler) into the next
+#Dense layer and writes every network of a predictor into one weights file.
+#The runtime memory-maps that file and only needs NumPy.
+#
+#File layout: MAGIC, uint64 header length, JSON header, float32 data.
+#The header records the mtime and size of the checkpoints and scaler it was
+#exported from, an export older than its sources is not loaded.
+from os.path import exists, isdir, join
+import numpy as np
+import argparse
+import json
+import sys
+import os
+
+MAGIC = b"QRYNN001"
+ALIGN = 64
+
+WEIGHTS_PATHS = {
+    "v1": "./models_V1/weights.qnn",
+    "v2": "./models_V2/weights.qnn",
+    "swap": "./models_V2_swap/weights.qnn",
+}
+
+_ACTIVATIONS = {
+    "relu": lambda x: np.maximum(x, 0),
+    "sigmoid": lambda x: 1/(1 + np.exp(-x)),
+    "linear": lambda x: x,
+}
+
+
+class NumpyModel:
+    """Exported predictor, mirrors the queryModelBatch API of the Keras ones"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a Quarry weights file".format(path))
+            headerLen = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(headerLen))
+
+        data = np.memmap(path, dtype=np.float32, mode='r',
+                         offset=header["dataOffset"])
+
+        def view(spec):
+            offset, shape = spec
+            return data[offset:offset + int(np.prod(shape))].reshape(shape)
+
+        def dense(layer):
+            return view(layer["W"]), view(layer["b"]), _ACTIVATIONS[layer["activation"]]
+
+        self.path = path
+        self.sources = header.get("sources")
+        self.features = header["features"]
+        self.out_columns = header["outColumns"]
+        self.networks = []
+        for net in header["networks"]:
+            layers = [dense(l) for l in net["layers"]]
+            heads = {k: dense(l) for k, l in net["heads"].items()}
+            self.networks.append((layers, heads))
+
+    def queryModelBatch(self, X) -> dict:
+        """Predict every head for all rows of X, raw (unscaled) features"""
+        if hasattr(X, "columns"):
+            X = X[self.features]
+        X = np.asarray(X, dtype=np.float32)
+
+        output = {}
+        for layers, heads in self.networks:
+            h = X
+            for W, b, activation in layers:
+                h = activation(h @ W + b)
+
+            for out, (W, b, activation) in heads.items():
+                output[out] = activation(h @ W + b)[:, 0]
+
+        return output
+
+
+    def getStaleSources(self) -> list:
+        """Source files changed since the export, all of them if unrecorded"""
+        if self.sources is None:
+            return ["(no sources recorded)"]
+
+        return [path for path, fingerprint in self.sources.items()
+                if getFingerprint(path) != fingerprint]
+
+
+def getFingerprint(path: str):
+    """[latest mtime (ns), total size] of a file or checkpoint directory, None if missing"""
+    if not exists(path):
+        return None
+
+    files = [path]
+    if isdir(path):
+        files = [join(root, f) for root, _, names in os.walk(path) for f in names]
+
+    stats = [os.stat(f) for f in files]
+    return [max((st.st_mtime_ns for st in stats), default=0), sum(st.st_size for st in stats)]
+
+
+def loadPredictor(name: str):
+    """Exported predictor by name (v1|v2|swap), None if not exported or stale"""
+    if not exists(WEIGHTS_PATHS[name]):
+        return None
+
+    predictor = NumpyModel(WEIGHTS_PATHS[name])
+
+    #Retrained models or a re-fit scaler make the export wrong, use Keras
+    stale = predictor.getStaleSources()
+    if stale:
+        sys.stderr.write("{} is out of date ({}), using Keras. Re-export with NumpyRuntime.py\n".format(
+            WEIGHTS_PATHS[name], ", ".join(stale)))
+        return None
+
+    return predictor
+
+
+def _activationName(layer) -> str:
+    #Models pass a ReLU layer as activation, so check class names as well
+    act = layer.activation
+    name = (getattr(act, "__name__", None) or type(act).__name__).lower()
+    if "leaky" in name or getattr(act, "max_value", None) is not None \
+            or getattr(act, "negative_slope", 0) or getattr(act, "threshold", 0):
+        raise ValueError("Unsupported activation {} in {}".format(name, layer.name))
+
+    for known in _ACTIVATIONS:
+        if known in name:
+            return known
+
+    raise ValueError("Unsupported activation {} in {}".format(name, layer.name))
+
+
+def foldNetwork(model, scaleIn, shiftIn) -> dict:
+    """
+    Dense layers of a Keras model with every BatchNormalization, and the
+    input scaling x*scaleIn + shiftIn, folded into the following Dense.
+    """
+    outputNames = set(model.output_names)
+    pending = (np.asarray(scaleIn, np.float64), np.asarray(shiftIn, np.float64))
+
+    network = {"layers": [], "heads": {}}
+    for layer in model.layers:
+        kind = type(layer).__name__
+
+        if kind == "BatchNormalization":
+            gamma, beta, mean, var = [w.astype(np.float64) for w in layer.get_weights()]
+            scale = gamma/np.sqrt(var + layer.epsilon)
+            pending = (scale, beta - mean*scale)
+
+        elif kind == "Dense":
+            W, b = [w.astype(np.float64) for w in layer.get_weights()]
+            scale, shift = pending
+            folded = {"W": scale[:, None]*W, "b": shift @ W + b,
+                      "activation": _activationName(layer)}
+
+            #Heads of a multi-output model all read the same trunk output
+            if layer.name in outputNames:
+                network["heads"][layer.name] = folded
+            else:
+                network["layers"].append(folded)
+                pending = (np.ones(W.shape[1]), np.zeros(W.shape[1]))
+
+        elif kind != "InputLayer":
+            raise ValueError("Unsupported layer {} ({})".format(layer.name, kind))
+
+    return network
+
+
+def exportWeights(path: str, networks: list, scaler, outColumns: list, sources=()) -> None:
+    """
+    Write folded networks and the scaler feature order to one file, with the
+    fingerprints of the source paths (missing ones included as None).
+    """
+    arrays = []
+    offset = 0
+
+    def add(a):
+        nonlocal offset
+        a = np.ascontiguousarray(a, dtype=np.float32)
+        arrays.append(a)
+        spec = [offset, list(a.shape)]
+        offset += a.size
+        return spec
+
+    header = {"features": list(scaler.feature_names_in_),
+              "outColumns": list(outColumns), "networks": [],
+              "sources": {p: getFingerprint(p) for p in sources}}
+    for net in networks:
+        entry = {"layers": [], "heads": {}}
+        for l in net["layers"]:
+            entry["layers"].append(
+                {"W": add(l["W"]), "b": add(l["b"]), "activation": l["activation"]})
+        for k, l in net["heads"].items():
+            entry["heads"][k] = {"W": add(l["W"]), "b": add(l["b"]),
+                                 "activation": l["activation"]}
+        header["networks"].append(entry)
+
+    #dataOffset depends on the header length, iterate until it settles
+    header["dataOffset"] = 0
+    while True:
+        encoded = json.dumps(header).encode()
+        dataOffset = -(-(len(MAGIC) + 8 + len(encoded))//ALIGN)*ALIGN
+        if dataOffset == header["dataOffset"]:
+            break
+        header["dataOffset"] = dataOffset
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(encoded).to_bytes(8, 'little'))
+        f.write(encoded)
+        f.write(b'\0'*(dataOffset - len(MAGIC) - 8 - len(encoded)))
+        for a in arrays:
+            f.write(a.tobytes())
+
+
+def _exportPredictor(name: str, samples: int, tolerance: float) -> None:
+    #Only the export step needs TensorFlow
+    import pandas as pd
+    import PredictorV1
+    import PredictorV2
+    import SwapPredictor
+
+    if name == "v1":
+        predictor = PredictorV1
+        predictor.load_models()
+        models = {out: predictor.out_columns[out] for out in predictor.out_columns}
+        sources = [predictor.checkpoint_path.format(out) for out in models]
+    elif name == "v2":
+        predictor = PredictorV2
+        predictor.load_models()
+        #A fused checkpoint appearing or disappearing also invalidates the export
+        sources = [predictor.fused_checkpoint_path]
+        if predictor.FUSED_MODEL is not None:
+            models = {None: predictor.FUSED_MODEL}
+        else:
+            models = {out: predictor.out_columns[out] for out in predictor.out_columns}
+            sources += [predictor.checkpoint_path.format(out) for out in models]
+    else:
+        predictor = SwapPredictor
+        predictor.load()
+        models = {"Swaps": predictor.MODEL}
+        sources = [predictor.checkpoint_path.format("Swaps")]
+    sources.append(predictor.scaler_path)
+
+    scaler = predictor.SCALER
+    networks = []
+    for out, model in models.items():
+        net = foldNetwork(model, scaler.scale_, scaler.min_)
+
+        #Single output models are keyed by the metric they predict
+        if out is not None:
+            net["heads"] = {out: h for h in net["heads"].values()}
+        networks.append(net)
+
+    exportWeights(WEIGHTS_PATHS[name], networks, scaler, list(predictor.out_columns), sources)
+
+    #Compare against Keras on random inputs spanning the scaler range
+    rng = np.random.default_rng(0)
+    X = scaler.inverse_transform(
+        rng.random((samples, len(scaler.feature_names_in_))))
+    X = pd.DataFrame(X, columns=scaler.feature_names_in_)
+
+    expected = predictor.queryModelBatch(X)
+    actual = NumpyModel(WEIGHTS_PATHS[name]).queryModelBatch(X)
+    for out in expected.columns:
+        err = np.max(np.abs(expected[out].to_numpy() - actual[out]))
+        print("{:10}{:>12.3e}".format(out, err))
+        if err > tolerance:
+            raise RuntimeError(
+                "Exported {} head {} differs from Keras by {}".format(name, out, err))
+
+    print("Exported", name, "to", WEIGHTS_PATHS[name])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export Keras predictors for TensorFlow free inference.")
+    parser.add_argument(
+        'predictors', nargs='*', default=list(WEIGHTS_PATHS), help='Predictors to export (v1|v2|swap)')
+    parser.add_argument(
+        '--samples', type=int, help='Random rows used to check the export. (Default 256)', default=256)
+    parser.add_argument(
+        '--tol', type=float, help='Max absolute difference to Keras. (Default 1e-3)', default=1e-3)
+    args = parser.parse_args()
+
+    for name in args.predictors:
+        _exportPredictor(name, args.samples, args.tol)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+#Batched Keras inference shared by PredictorV1, PredictorV2 and SwapPredictor.
+#Each model is traced once into a graph function for any batch size, and a
+#feature matrix is scaled once and passed through every model in one call.
+import tensorflow as tf
+import pandas as pd
+
+
+def trace_predict(model):
+    """Compile model into a graph function reused for any batch size"""
+    input_size = model.input_shape[-1]
+
+    @tf.function(input_signature=[tf.TensorSpec([None, input_size], tf.float32)])
+    def predict(X):
+        return model(X, training=False)
+
+    return predict
+
+
+def scale_input(scaler, X: pd.DataFrame):
+    X = X[scaler.feature_names_in_]
+    return scaler.transform(X)
+
+
+def query_batch(X: pd.DataFrame, scaler, predict_fns: dict) -> pd.DataFrame:
+    """
+    Outputs of every traced model in predict_fns for all rows of X. Single
+    output models are named by their key, multi-head models by their heads.
+    """
+    X_scale = tf.constant(scale_input(scaler, X), dtype=tf.float32)
+
+    output = {}
+    for out, predict in predict_fns.items():
+        Y = predict(X_scale)
+        if isinstance(Y, dict):
+            for head, y in Y.items():
+                output[head] = y.numpy()[:, 0]
+        else:
+            output[out] = Y.numpy()[:, 0]
+
+    return pd.DataFrame(output, index=X.index)
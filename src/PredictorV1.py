@@ -2,18 +2,16 @@
 
 # TensorFlow and tf.keras
 import tensorflow as tf
-from sklearn import preprocessing
 from keras.models import Sequential, save_model, load_model
 from keras.layers import Dense, BatchNormalization
 from keras.activations import sigmoid
-from sklearn.model_selection import train_test_split
 import joblib
 
 # Commonly used modules
 import pandas as pd
 
-from os import listdir
-from os.path import isfile, join
+import DatasetStore
+import PredictorBatch
 
 out_columns = {'PST': None, 'TVD': None, 'Entropy': None, 'Swaps': None}
 out_columns_sig = ['PST', 'TVD']
@@ -28,9 +26,16 @@ scaler_path = "./models_V1/scaler.save"
 #    for out in out_columns:
 #        plot_model(out_columns[out], to_file=img_path.format(out), show_shapes=True)
 
+SCALER = None
+PREDICT_FNS = {}
+
+
 def load_models():
+    global SCALER
+    SCALER = joblib.load(scaler_path)
     for out in out_columns:
         out_columns[out] = load_model(checkpoint_path.format(out))
+        PREDICT_FNS[out] = PredictorBatch.trace_predict(out_columns[out])
 
 
 def create_model(input_size, output_size):
@@ -85,61 +90,53 @@ def queryModel(X: pd.DataFrame, out_column: str):
         # Raise error?
         return None
 
-    min_max_scaler = joblib.load(scaler_path)
-    X = X[min_max_scaler.feature_names_in_]
-    X_scale = min_max_scaler.transform(X)
-
     model = out_columns[out_column]
 
-    return model(X_scale)
+    return model(scale_input(X))
 
 
-def main():
+def scale_input(X: pd.DataFrame):
+    return PredictorBatch.scale_input(SCALER, X)
 
-    files = [join(dataset_path, f) for f in listdir(
-        dataset_path) if isfile(join(dataset_path, f))]
 
-    dfs = [pd.read_csv(f) for f in files]
-    df = pd.concat(dfs)
+def queryModelBatch(X: pd.DataFrame) -> pd.DataFrame:
+    """Predict every output column for all rows of X, one pass per model"""
+    return PredictorBatch.query_batch(X, SCALER, PREDICT_FNS)
 
-    X = df.drop(columns=out_columns.keys())
-    Y = df[out_columns.keys()]
+
+def main():
+
+    dataset = DatasetStore.openDataset(dataset_path)
+    x_columns = [c for c in dataset.columns if c not in out_columns]
 
     # Scaling
-    min_max_scaler = preprocessing.MinMaxScaler()
-    X_scale = min_max_scaler.fit_transform(X)
+    min_max_scaler = DatasetStore.fitScaler(dataset, x_columns)
 
     joblib.dump(min_max_scaler, scaler_path)
 
-    X_train, X_val_and_test, Y_train, Y_val_and_test = train_test_split(
-        X_scale, Y, test_size=0.3)
-    X_val, X_test, Y_val, Y_test = train_test_split(
-        X_val_and_test, Y_val_and_test, test_size=0.5)
+    rows_train, rows_val, rows_test = DatasetStore.splitRows(dataset.numRows)
 
     # Baseline model
     for out_column in out_columns.keys():
-        Y_out = Y[[out_column]]
-        Y_train_out = Y_train[[out_column]]
-        Y_test_out = Y_test[[out_column]]
-        Y_val_out = Y_val[[out_column]]
+        train = DatasetStore.getKerasSequence(
+            dataset, rows_train, x_columns, [out_column], 32, min_max_scaler)
+        val = DatasetStore.getKerasSequence(
+            dataset, rows_val, x_columns, [out_column], 32, min_max_scaler, shuffle=False)
 
         if out_column in out_columns_sig:
-            model = create_model_sigmoid(len(X.columns), 1)
+            model = create_model_sigmoid(len(x_columns), 1)
         else:
-            model = create_model(len(X.columns), 1)
+            model = create_model(len(x_columns), 1)
 
         optimizer = tf.keras.optimizers.Adam(learning_rate=0.005, decay=5e-4)
         model.compile(optimizer=optimizer,
                       loss='mean_absolute_error',
                       metrics=['MSE'])
 
-        hist = model.fit(X_train, Y_train_out,
-                         batch_size=32, epochs=200,
-                         validation_data=(X_val, Y_val_out))
+        hist = model.fit(train, epochs=200, validation_data=val)
 
         save_model(model=model, filepath=checkpoint_path.format(out_column))
         #plot_model(out_columns[out_column], to_file=img_path.format(out_column), show_shapes=True)
 
-
 if __name__ == "__main__":
     main()
@@ -2,34 +2,88 @@
 
 # TensorFlow and tf.keras
 import tensorflow as tf
-from sklearn import preprocessing
-from keras.models import Sequential, save_model, load_model
-from keras.layers import Dense, BatchNormalization
-from sklearn.model_selection import train_test_split
+from keras.models import Sequential, Model, save_model, load_model
+from keras.layers import Dense, BatchNormalization, Input
 from keras.activations import sigmoid
 import joblib
+import argparse
 
 # Commonly used modules
 import pandas as pd
+import numpy as np
 
-from os import listdir
-from os.path import isfile, join
+from os.path import exists
+
+import EvalMetrics as EM
+import DatasetStore
+import PredictorBatch
 
 out_columns = {'PST': None, 'TVD': None, 'Entropy': None, 'Swaps': None, 'L2': None, 'Hellinger': None}
 out_columns_sig = ['PST', 'TVD', 'L2']
 dataset_path = "./dataSets_V2/dataSets_Noise"
 img_path = "./models_V2/img/checkpoint_{}.png"
 checkpoint_path = "./models_V2/checkpoint_{}"
+fused_checkpoint_path = "./models_V2/checkpoint_fused"
 scaler_path = "./models_V2/scaler.save"
+fitness_column = 'Fitness'
 
 #def plot_models():
 #    load_models()
 #    for out in out_columns:
 #        plot_model(out_columns[out], to_file=img_path.format(out), show_shapes=True)
 
+SCALER = None
+PREDICT_FNS = {}
+FUSED_MODEL = None
+FUSED_PREDICT_FN = None
+
+
 def load_models():
+    global SCALER, FUSED_MODEL, FUSED_PREDICT_FN
+    SCALER = joblib.load(scaler_path)
+
+    #Reloads start clean, a removed fused checkpoint must not linger
+    FUSED_MODEL = None
+    FUSED_PREDICT_FN = None
+    PREDICT_FNS.clear()
+    for out in out_columns:
+        out_columns[out] = None
+
+    #One multi-head artifact replaces the per-metric checkpoints when present
+    if exists(fused_checkpoint_path):
+        FUSED_MODEL = load_model(fused_checkpoint_path)
+        FUSED_PREDICT_FN = PredictorBatch.trace_predict(FUSED_MODEL)
+        return
+
     for out in out_columns:
         out_columns[out] = load_model(checkpoint_path.format(out))
+        PREDICT_FNS[out] = PredictorBatch.trace_predict(out_columns[out])
+
+
+def create_fused_model(input_size, heads):
+    """Shared trunk of the per-metric models with one output head per metric"""
+    relu = tf.keras.layers.ReLU()
+
+    inputs = Input(shape=(input_size,))
+    x = Dense(512, activation=relu)(inputs)
+    x = BatchNormalization()(x)
+
+    x = Dense(256, activation=relu)(x)
+    x = BatchNormalization()(x)
+
+    x = Dense(256, activation=relu)(x)
+    x = BatchNormalization()(x)
+
+    x = Dense(128, activation=sigmoid)(x)
+    x = BatchNormalization()(x)
+
+    outputs = {}
+    for out in heads:
+        activation = sigmoid if out in out_columns_sig else relu
+        outputs[out] = Dense(1, activation=activation, name=out)(x)
+
+    return Model(inputs=inputs, outputs=outputs)
+
 
 def create_model(input_size, output_size):
     leaky_relu = tf.keras.layers.LeakyReLU(alpha=0.01)
@@ -82,59 +136,117 @@ def queryModel(X: pd.DataFrame, out_column: str):
         # Raise error?
         return None
 
-    min_max_scaler = joblib.load(scaler_path)
-    X = X[min_max_scaler.feature_names_in_]
-    X_scale = min_max_scaler.transform(X)
+    if FUSED_MODEL is not None:
+        return FUSED_MODEL(scale_input(X))[out_column]
 
     model = out_columns[out_column]
 
-    return model(X_scale)
+    return model(scale_input(X))
 
-def main():
 
-    files = [join(dataset_path, f) for f in listdir(
-        dataset_path) if isfile(join(dataset_path, f))]
+def scale_input(X: pd.DataFrame):
+    return PredictorBatch.scale_input(SCALER, X)
+
 
-    dfs = [pd.read_csv(f) for f in files]
-    df = pd.concat(dfs)
+def queryModelBatch(X: pd.DataFrame) -> pd.DataFrame:
+    """Predict every output column for all rows of X, one pass per model"""
+    #May include a Fitness head next to the metric heads
+    if FUSED_PREDICT_FN is not None:
+        return PredictorBatch.query_batch(X, SCALER, {"fused": FUSED_PREDICT_FN})
 
-    X = df.drop(columns=out_columns)
-    Y = df[out_columns]
+    return PredictorBatch.query_batch(X, SCALER, PREDICT_FNS)
 
+def load_dataset():
+    dataset = DatasetStore.openDataset(dataset_path)
+    x_columns = [c for c in dataset.columns if c not in out_columns]
+
+    return dataset, x_columns
+
+
+def fit_scaler(dataset, x_columns):
     # Scaling
-    min_max_scaler = preprocessing.MinMaxScaler()
-    X_scale = min_max_scaler.fit_transform(X)
+    min_max_scaler = DatasetStore.fitScaler(dataset, x_columns)
 
     joblib.dump(min_max_scaler, scaler_path)
 
-    X_train, X_val_and_test, Y_train, Y_val_and_test = train_test_split(
-        X_scale, Y, test_size=0.3)
-    X_val, X_test, Y_val, Y_test = train_test_split(
-        X_val_and_test, Y_val_and_test, test_size=0.5)
+    return min_max_scaler
+
+
+def main():
+
+    dataset, x_columns = load_dataset()
+
+    min_max_scaler = fit_scaler(dataset, x_columns)
+
+    rows_train, rows_val, rows_test = DatasetStore.splitRows(dataset.numRows)
 
     # Baseline model
     for out_column in out_columns:
-        Y_out = Y[[out_column]]
-        Y_train_out = Y_train[[out_column]]
-        Y_test_out = Y_test[[out_column]]
-        Y_val_out = Y_val[[out_column]]
+        train = DatasetStore.getKerasSequence(
+            dataset, rows_train, x_columns, [out_column], 32, min_max_scaler)
+        val = DatasetStore.getKerasSequence(
+            dataset, rows_val, x_columns, [out_column], 32, min_max_scaler, shuffle=False)
 
         if out_column in out_columns_sig:
-            model = create_model_sigmoid(len(X.columns), 1)
+            model = create_model_sigmoid(len(x_columns), 1)
         else:
-            model = create_model(len(X.columns), 1)
+            model = create_model(len(x_columns), 1)
 
         optimizer = tf.keras.optimizers.Adam(learning_rate=0.005, decay=5e-4)
         model.compile(optimizer=optimizer,
                       loss='mean_absolute_error',
                       metrics=['MSE'])
 
-        hist = model.fit(X_train, Y_train_out,
-                         batch_size=32, epochs=200,
-                         validation_data=(X_val, Y_val_out))
+        hist = model.fit(train, epochs=200, validation_data=val)
 
         save_model(model=model, filepath=checkpoint_path.format(out_column))
         #plot_model(out_columns[out_column], to_file=img_path.format(out_column), show_shapes=True)
 
+
+def main_fused(with_fitness=False):
+    """Train all metrics (and optionally fitness) as one multi-head model"""
+
+    dataset, x_columns = load_dataset()
+
+    heads = list(out_columns)
+    derived = {}
+    if with_fitness:
+        #Computed per batch from the stored metrics, the same fitness
+        #non-fused P2 reports, which has no L2 or Hellinger heads
+        fitness = np.vectorize(
+            lambda PST, TVD, Entropy, Swaps: EM.fitness(PST, TVD, Entropy, Swaps, 1, 1))
+        derived[fitness_column] = (['PST', 'TVD', 'Entropy', 'Swaps'], fitness)
+        heads.append(fitness_column)
+
+    min_max_scaler = fit_scaler(dataset, x_columns)
+
+    rows_train, rows_val, rows_test = DatasetStore.splitRows(dataset.numRows)
+    train = DatasetStore.getKerasSequence(
+        dataset, rows_train, x_columns, heads, 32, min_max_scaler, yDict=True, derived=derived)
+    val = DatasetStore.getKerasSequence(
+        dataset, rows_val, x_columns, heads, 32, min_max_scaler, shuffle=False, yDict=True, derived=derived)
+
+    model = create_fused_model(len(x_columns), heads)
+
+    optimizer = tf.keras.optimizers.Adam(learning_rate=0.005, decay=5e-4)
+    model.compile(optimizer=optimizer,
+                  loss='mean_absolute_error',
+                  metrics=['MSE'])
+
+    hist = model.fit(train, epochs=200, validation_data=val)
+
+    save_model(model=model, filepath=fused_checkpoint_path)
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Train the V2 predictor models.")
+    parser.add_argument(
+        '--fused', action='store_true', help='Train one multi-head model instead of one model per metric.')
+    parser.add_argument(
+        '--fitness', action='store_true', help='Add a head predicting fitness directly (with --fused).')
+    args = parser.parse_args()
+
+    if args.fused:
+        main_fused(args.fitness)
+    else:
+        main()
@@ -1,26 +1,30 @@
-from typing import Dict
+from __future__ import annotations
+from typing import Dict, TYPE_CHECKING
 from numpy import average
-from qiskit import Aer, execute, transpile, transpiler, QuantumCircuit
-from qiskit.providers.aer.noise import NoiseModel
-from pandas import DataFrame
+from qiskit import Aer, execute, transpiler, QuantumCircuit
 from MachineID import MachineDict
-from statistics import mean
 import EvalMetrics as EM
+import CircuitFeatures
+import ESPEngine
+import GraphFeatures
+import NoiseCache
+import TranspileCache
+import IdealCache
 import datetime
 import networkx
 import os
 import inspect
 import sys
-import matplotlib.pyplot as plt
+
+#Heavy dependencies (Aer, pandas, matplotlib, fake backends, QASMBench) are
+#imported where they are used so cheap query modes start quickly
+if TYPE_CHECKING:
+    from qiskit.providers.aer.noise import NoiseModel
+    from pandas import DataFrame
 
 currentdir = os.path.dirname(os.path.abspath(
     inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
-sys.path.insert(0, parentdir)
-
-#Mockup backends
-import qiskit.test.mock.backends as BE
-import qasm.QASMBench.metrics.OpenQASMetric as QB
 
 #TODO: Should add qc.num_qubits to data collection. Width is qubits + clbits
 
@@ -34,8 +38,25 @@ FAULT_CIRCUITS = ['./qasm/QASMBench/small/ipea_n2/ipea_n2.qasm',
                   './qasm/QASMBench/medium/vqe_uccsd_n8/vqe_uccsd_n8.qasm ']
 
 
+def getBackendsModule():
+    """Mockup backends, imported on first use"""
+    import qiskit.test.mock.backends as BE
+    return BE
+
+
+def getQASMetricModule():
+    """QASMBench metrics, the submodule lives outside of src/"""
+    if parentdir not in sys.path:
+        sys.path.insert(0, parentdir)
+
+    import qasm.QASMBench.metrics.OpenQASMetric as QB
+    return QB
+
+
 def drawWeightedGraph(G: networkx.Graph) -> None:
     """Visualize weighted Networkx graph"""
+    import matplotlib.pyplot as plt
+
     pos = networkx.spring_layout(G)
     networkx.draw(G, pos, with_labels=True)
     labels = networkx.get_edge_attributes(G, 'weight')
@@ -60,51 +81,27 @@ def getCxGraph(qc: QuantumCircuit) -> networkx.Graph:
 
 def getGraphMetrics(G: networkx.Graph, label: str) -> dict:
     """Calculate metrics from Networkx graph"""
-    output = {}
-    output["{}GraphDensity".format(label)] = networkx.density(G)
-    output["{}AvgConnectivity".format(
-        label)] = networkx.average_node_connectivity(G)
-
-    #If average neighbor degree list is empty, set mean to 0
-    avgNeighborDegreeList = list(networkx.average_neighbor_degree(G).values())
-    if len(avgNeighborDegreeList) != 0:
-        output["{}AvgNeighborDegree".format(
-            label)] = mean(avgNeighborDegreeList)
-    else:
-        output["{}AvgNeighborDegree".format(label)] = 0
-
-    try:
-        output["{}AvgClustering".format(label)] = networkx.average_clustering(G)
-    except ZeroDivisionError:
-        output["{}AvgClustering".format(label)] = 0 
-
-    #CX graph may not be connected.
-    #isConnected() feature not supported for Graph()?
-    if label != "CX":
-        output["{}AvgShortestPath".format(
-            label)] = networkx.average_shortest_path_length(G)
-
-    #Not collecting CX shortest path data for now.
-    else:
-        output["{}AvgShortestPath".format(
-            label)] = 0
-
-    return output
+    return GraphFeatures.getGraphMetrics(
+        list(G.nodes), list(G.edges), G.is_directed(), label)
 
 
 def getCxGraphMetrics(G: networkx.Graph) -> dict:
     """Calculate graph metrics and weight metrics"""
-    output = getGraphMetrics(G, 'CX')
+    return getCxEdgeMetrics(list(G.nodes), list(G.edges))
+
+
+def getCxEdgeMetrics(nodes: list, edges: list) -> dict:
+    """getCxGraphMetrics() of a CX graph given as G.nodes and G.edges"""
+    output = GraphFeatures.getGraphMetrics(nodes, edges, False, 'CX')
 
     #Single element edge lists have a different data format.
-    if len(G.edges) == 1:
+    if len(edges) == 1:
         output['CXAverageDegree'] = 1
     else:
-        output['CXAverageDegree'] = getAverageDegree(G.edges)
+        output['CXAverageDegree'] = getAverageDegree(edges)
 
-    weights = []
-    for e in G.edges:
-        weights.append(G[e[0]][e[1]]['weight'])
+    #Weights are Qubit number distances
+    weights = [abs(u - v) for u, v in edges]
 
     if weights:
         output['CXAverageWeight'] = average(weights)
@@ -155,43 +152,21 @@ def getAvgGateSuccess(noise: NoiseModel) -> dict:
     return gateSuccess
 
 
-def getESP(qc: QuantumCircuit, noise: NoiseModel) -> float:
+def getESP(qc: QuantumCircuit, profile) -> float:
     """
     Estimated Success Probability
     https://dl.acm.org/doi/abs/10.1145/3386162
     """
-    esp = 1
-
-    for instruction, qargs, cargs in qc._data:
-        if instruction.name not in noise._noise_instructions:
-            continue
-
-        if len(qargs) > 1:
-            qb = ((qargs[0]._index), (qargs[1]._index))
-        else:
-            qb = (qargs[0]._index, )
-
-        if instruction.name == 'measure':
-            m0e = (noise._local_readout_errors[qb].probabilities[0][0])
-            m1e = (noise._local_readout_errors[qb].probabilities[1][1])
-            sr = (m0e + m1e)/2
-        else:
-            #Assume that highest probability is for success
-            sr = max(
-                noise._local_quantum_errors[instruction.name][qb].probabilities)
-        esp *= sr
+    return ESPEngine.getESP(qc, profile)
 
-    return esp
 
-
-def getV1Input(qc: QuantumCircuit, backend) -> DataFrame:
+def getV1Input(qc: QuantumCircuit, profile) -> DataFrame:
     """Returns parameters that can be passed to the V1 Predictor model"""
-    basisGates = backend.configuration().basis_gates
-    name = backend.configuration().backend_name
-    coupling_map = backend.configuration().coupling_map
-    numQubit = backend.configuration().n_qubits
+    from pandas import DataFrame
+    basisGates = profile.basisGates
 
-    out_qc = transpile(qc, basis_gates=basisGates, optimization_level=0)
+    out_qc = TranspileCache.getTranspiled(
+        qc, basisGates=basisGates, optimizationLevel=0)
 
     output = getGateCounts(out_qc, basisGates)
 
@@ -199,91 +174,87 @@ def getV1Input(qc: QuantumCircuit, backend) -> DataFrame:
         if gate not in output:
             output[gate] = -1
 
-    output["Machine"] = MachineDict[name]
-    output["AvgDegree"] = getAverageDegree(coupling_map)
-    output["NumQubit"] = numQubit
+    output["Machine"] = MachineDict[profile.name]
+    output["AvgDegree"] = profile.avgDegree
+    output["NumQubit"] = profile.numQubits
 
     return DataFrame(output, index=[0])
 
 
-def getV2Input(qc: QuantumCircuit, backend) -> DataFrame:
-    basisGates = backend.configuration().basis_gates
-    coupling_map = backend.configuration().coupling_map
-    numQubit = backend.configuration().n_qubits
-    name = backend.configuration().backend_name
-    noise = NoiseModel.from_backend(backend)
+def getV2Input(qc: QuantumCircuit, profile) -> DataFrame:
+    from pandas import DataFrame
+
+    basisGates = profile.basisGates
 
     #Counting gates prior to mapping to topology
-    out_qc = transpile(qc, basis_gates=basisGates, optimization_level=0)
+    out_qc = TranspileCache.getTranspiled(
+        qc, basisGates=basisGates, optimizationLevel=0)
 
-    output = getGateCounts(out_qc, basisGates)
+    features = CircuitFeatures.extract(out_qc, basisGates)
+    output = features["gateCounts"]
 
     for gate in GLOBAL_BASIS_GATES:
         if gate not in output:
             output[gate] = -1
 
     #Avg Error Metrics
-    output["measureSuccess"] = getAvgMeasurementSuccess(noise)
-    output = {**output, **(getAvgGateSuccess(noise))}
+    output["measureSuccess"] = profile.measureSuccess
+    output = {**output, **(profile.gateSuccess)}
 
     #Topology Metrics
-    graph = networkx.DiGraph()
-    graph.add_edges_from(coupling_map)
+    output["Machine"] = MachineDict[profile.name]
+    output["AvgDegree"] = profile.avgDegree
 
-    output["Machine"] = MachineDict[name]
-    output["AvgDegree"] = getAverageDegree(coupling_map)
-
-    output = {**output, **(getGraphMetrics(graph, ''))}
+    output = {**output, **(profile.getTopologyMetrics(''))}
 
     #Circuit Metrics
-    output["NumQubit"] = numQubit
-    output["Depth"] = out_qc.depth()
+    output["NumQubit"] = profile.numQubits
+    output["Depth"] = features["depth"]
 
-    QB_metric = QB.QASMetric(out_qc.qasm())
-    output = {**output, **(QB_metric.evaluate_qasm())}
+    #Backends sharing basis gates share out_qc, keyed as in the transpile cache
+    key = TranspileCache.getKey(qc, basisGates=basisGates, optimizationLevel=0)
+    output = {**output, **(CircuitFeatures.getQASMetrics(out_qc, key))}
 
     return DataFrame(output, index=[0])
 
 
-def getSWAPInput(qc: QuantumCircuit, backend) -> DataFrame:
-    basisGates = backend.configuration().basis_gates
-    coupling_map = backend.configuration().coupling_map
-    numQubit = backend.configuration().n_qubits
-    name = backend.configuration().backend_name
-    noise = NoiseModel.from_backend(backend)
+def getSWAPInput(qc: QuantumCircuit, profile) -> DataFrame:
+    from pandas import DataFrame
+
+    basisGates = profile.basisGates
 
     #Counting gates prior to mapping to topology
-    out_qc = transpile(qc, basis_gates=basisGates, optimization_level=0)
+    out_qc = TranspileCache.getTranspiled(
+        qc, basisGates=basisGates, optimizationLevel=0)
 
-    output = getGateCounts(out_qc, basisGates)
+    features = CircuitFeatures.extract(out_qc, basisGates)
+    output = features["gateCounts"]
 
     for gate in GLOBAL_BASIS_GATES:
         if gate not in output:
             output[gate] = -1
 
     #Avg Error Metrics
-    output["measureSuccess"] = getAvgMeasurementSuccess(noise)
-    output = {**output, **(getAvgGateSuccess(noise))}
+    output["measureSuccess"] = profile.measureSuccess
+    output = {**output, **(profile.gateSuccess)}
 
     #Topology Metrics
-    graph = networkx.DiGraph()
-    graph.add_edges_from(coupling_map)
-
-    output["Machine"] = MachineDict[name]
-    output["QCAvgDegree"] = getAverageDegree(coupling_map)
+    output["Machine"] = MachineDict[profile.name]
+    output["QCAvgDegree"] = profile.avgDegree
 
     #Machine topology metrics
-    output = {**output, **(getGraphMetrics(graph, 'QC'))}
+    output = {**output, **(profile.getTopologyMetrics('QC'))}
 
     #CX Graph metrics
-    output = {**output, **(getCxGraphMetrics(getCxGraph(qc)))}
+    output = {**output, **(getCxEdgeMetrics(*CircuitFeatures.getCxEdges(qc)))}
 
     #Circuit Metrics
-    output["NumQubit"] = numQubit
-    output["Depth"] = out_qc.depth()
+    output["NumQubit"] = profile.numQubits
+    output["Depth"] = features["depth"]
 
-    QB_metric = QB.QASMetric(out_qc.qasm())
-    output = {**output, **(QB_metric.evaluate_qasm())}
+    #Backends sharing basis gates share out_qc, keyed as in the transpile cache
+    key = TranspileCache.getKey(qc, basisGates=basisGates, optimizationLevel=0)
+    output = {**output, **(CircuitFeatures.getQASMetrics(out_qc, key))}
 
     return DataFrame(output, index=[0])
 
@@ -344,26 +315,28 @@ def getGateCounts(qc, basisGates):
     return gateCounts
 
 
-def getSwapCount(qc, backend, optimizationLevel) -> int:
+def getSwapCount(qc, profile, optimizationLevel, initialLayout=None) -> int:
     '''Get count of SWAP operations added for circuit on given backend.'''
-    basisGates = backend.configuration().basis_gates
+    basisGates = profile.basisGates
     if "swap" not in basisGates:
         basisGates = basisGates + ["swap"]
 
     try:
-        swap_qc = transpile(qc, basis_gates=basisGates,
-                            optimization_level=optimizationLevel, backend=backend)
+        #Higher optimization levels use calibration data for layout
+        swap_qc = TranspileCache.getTranspiled(qc, basisGates=basisGates,
+                                               optimizationLevel=optimizationLevel, profile=profile,
+                                               initialLayout=initialLayout)
     except transpiler.exceptions.TranspilerError:
         return None
 
     return getGateCounts(swap_qc, basisGates)['swap']
 
 
-def simCircuit(qc, backend, optimizationLevel):
+def simCircuit(qc, profile, optimizationLevel, initialLayout=None):
     '''Run circuit on simulated backend and collect result metrics'''
 
     outDict = {}
-    swaps = getSwapCount(qc, backend, optimizationLevel)
+    swaps = getSwapCount(qc, profile, optimizationLevel, initialLayout)
 
     #Transpiler threw an error and we couldn't route circuit
     if swaps == None:
@@ -371,39 +344,34 @@ def simCircuit(qc, backend, optimizationLevel):
 
     outDict["Swaps"] = swaps
 
-    ideal_result = execute(
-        qc, backend=Aer.get_backend('qasm_simulator'), max_parallel_threads=MAX_JOBS).result()
-    noisy_result = execute(qc, backend=backend,
-                           max_parallel_threads=MAX_JOBS, optimization_level=optimizationLevel).result()
-
-    outDict["PST"] = EM.computePST(correct_answer=ideal_result.get_counts(
-    ).keys(), dict_in=noisy_result.get_counts())
-
-    outDict["TVD"] = EM.computeTVD(dict_ideal=ideal_result.get_counts(
-    ), dict_in=noisy_result.get_counts())
-
-    outDict["Entropy"] = EM.computeEntropy(dict_in=noisy_result.get_counts())
+    #Backend independent, computed once per circuit and exact when feasible
+    ideal_counts = IdealCache.getIdealCounts(qc, MAX_JOBS)
 
-    outDict["L2"] = EM.computeL2(
-        noisy_result.get_counts(), ideal_result.get_counts())
-    outDict["Hellinger"] = EM.computeHellinger(
-        noisy_result.get_counts(), ideal_result.get_counts())
+    #Map to the device here and simulate with the shared cached noise model
+    #rather than letting the fake backend build its own
+    noisy_qc = TranspileCache.getTranspiled(
+        qc, optimizationLevel=optimizationLevel, profile=profile,
+        initialLayout=initialLayout)
+    noisy_result = Aer.get_backend('qasm_simulator').run(
+        noisy_qc, noise_model=NoiseCache.getNoiseModel(profile),
+        max_parallel_threads=MAX_JOBS).result()
 
-    outDict["Fitness"] = EM.fitness(outDict["PST"], outDict["TVD"], outDict["Entropy"],
-                                    outDict["Swaps"], outDict["Hellinger"], outDict["L2"])
+    #Every metric from one alignment of the two count dicts
+    outDict.update(EM.computeMetrics(ideal_counts,
+                                     noisy_result.get_counts(), swaps))
 
     return outDict
 
 
-def extractBackends():
+def extractBackends(withNames=False):
     backends = []
-    import inspect
+    BE = getBackendsModule()
     for name, obj in inspect.getmembers(BE):
         if "Legacy" not in name \
                 and "Alternative" not in name \
                 and "V2" not in name \
                 and "Fake" in name:
-            backends.append(obj())
+            backends.append((name, obj()) if withNames else obj())
 
     return backends
 
@@ -413,18 +381,4 @@ def getGlobalBasisGates():
     for be in extractBackends():
         tmp_gates += be.configuration().basis_gates
 
-    return list(set(tmp_gates))
-
-
-def getFakeBackends(qc, n):
-    #Filter out backends with too few qubits for circuit
-    lb = qc.num_qubits
-    backends = list(
-        filter(lambda backend: backend.configuration().n_qubits >= lb, extractBackends()))
-
-    #Sort backends by qubit count
-    backends = list(sorted(backends, key=lambda i: i.configuration().n_qubits))
-
-    #Return first n backends
-    backends = backends[:n]
-    return backends
+    return sorted(set(tmp_gates))
@@ -0,0 +1,105 @@
+#On-disk cache of parsed QASM files.
+#Circuits are stored as QPY files named by the content hash of the QASM
+#source (and qiskit version), so copies of a file share one entry. A small
+#index per source path records its size, mtime and content hash: unchanged
+#files load straight from QPY, touched files are re-hashed, and edited files
+#are parsed again and replace their entry.
+from os.path import abspath, exists, join
+from qiskit import QuantumCircuit, qpy
+import qiskit
+import threading
+import hashlib
+import json
+import os
+
+CACHE_DIR = "./qasm_cache/"
+
+HITS = 0
+MISSES = 0
+
+
+def _getIndexPath(path, cacheDir):
+    pathKey = hashlib.sha256(abspath(path).encode()).hexdigest()
+    return join(cacheDir, "index", pathKey[:2], pathKey + ".json")
+
+
+def _getCircuitPath(contentKey, cacheDir):
+    return join(cacheDir, contentKey[:2], contentKey + ".qpy")
+
+
+def _readIndex(indexPath):
+    try:
+        with open(indexPath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, write, mode='w') -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    #Threads of one process may store the same entry concurrently
+    tmpPath = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmpPath, mode) as f:
+            write(f)
+    except Exception:
+        os.remove(tmpPath)
+        raise
+    os.replace(tmpPath, path)
+
+
+def _load(circuitPath):
+    try:
+        with open(circuitPath, 'rb') as f:
+            return qpy.load(f)[0]
+
+    #Treat unreadable entries as misses, they are rewritten below
+    except Exception:
+        return None
+
+
+def getCircuit(path, cacheDir=CACHE_DIR) -> QuantumCircuit:
+    """QuantumCircuit.from_qasm_file(path), served from QPY while path is unchanged"""
+    global HITS, MISSES
+
+    stat = os.stat(path)
+    indexPath = _getIndexPath(path, cacheDir)
+    index = _readIndex(indexPath)
+
+    #Same size and mtime, trust the recorded content hash without reading
+    if index is not None and index["size"] == stat.st_size \
+            and index["mtime"] == stat.st_mtime_ns and index["qiskit"] == qiskit.__version__:
+        contentKey = index["content"]
+        source = None
+    else:
+        with open(path, 'rb') as f:
+            source = f.read()
+        contentKey = hashlib.sha256(
+            source + qiskit.__version__.encode()).hexdigest()
+
+    circuitPath = _getCircuitPath(contentKey, cacheDir)
+    qc = _load(circuitPath) if exists(circuitPath) else None
+
+    if qc is not None:
+        HITS += 1
+    else:
+        MISSES += 1
+        qc = QuantumCircuit.from_qasm_file(path)
+
+        #Circuits QPY cannot represent are just parsed every time
+        try:
+            _write(circuitPath, lambda f: qpy.dump(qc, f), 'wb')
+        except Exception:
+            return qc
+
+    #Record the hash for the current mtime, also after a touch
+    if source is not None:
+        _write(indexPath, lambda f: json.dump(
+            {"path": abspath(path), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+             "content": contentKey, "qiskit": qiskit.__version__}, f))
+
+    return qc
+
+
+def getStats() -> dict:
+    return {"hits": HITS, "misses": MISSES}
@@ -0,0 +1,305 @@
+#Resident Quarry query server.
+#Backend profiles, noise models, scalers and predictors stay loaded between
+#requests, and the ML modes of concurrent requests share one inference call.
+#
+#  python ./src/QuarryServer.py --port 5758
+#  curl -d '{"file": "./qasm/bellPair.qasm", "mode": "p2", "n": 10}' localhost:5758/query
+#
+#With --socket PATH requests are JSON lines on a Unix socket instead, each
+#holding an "op" (query|reload|status) plus the same fields as the HTTP body.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from qiskit import QuantumCircuit
+import multiprocessing
+import socketserver
+import threading
+import argparse
+import json
+import time
+import sys
+import os
+
+import Est
+import BackendStore
+import NoiseCache
+import TranspileCache
+import QasmCache
+import FeatureStore
+import GraphFeatures
+import CircuitFeatures
+
+HOST = "127.0.0.1"
+PORT = 5758
+
+#How long the batcher waits for more requests before running a model (s)
+BATCH_WINDOW = 0.005
+
+DEFAULT_N = 10
+DEFAULT_JOBS = 1
+
+START_TIME = time.time()
+
+
+class MicroBatcher:
+    """Merges feature rows of concurrent requests into one model call"""
+
+    def __init__(self, window=BATCH_WINDOW):
+        self.window = window
+        self.batches = 0
+        self.requests = 0
+
+        #Held while a model runs, reload() swaps predictors under it
+        self.modelLock = threading.Lock()
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, name, featureDict):
+        """Same result as Est.predictLocal, computed together with other requests"""
+        item = {"name": name, "features": featureDict,
+                "done": threading.Event(), "result": None, "error": None}
+        with self._cond:
+            self._pending.append(item)
+            self._cond.notify()
+
+        item["done"].wait()
+        if item["error"] is not None:
+            raise item["error"]
+
+        return item["result"]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+            #Let requests arriving just behind the first join the batch
+            time.sleep(self.window)
+            with self._cond:
+                pending, self._pending = self._pending, []
+
+            byModel = {}
+            for item in pending:
+                byModel.setdefault(item["name"], []).append(item)
+
+            for name, items in byModel.items():
+                self._predict(name, items)
+
+    def _predict(self, name, items):
+        #Circuit names may repeat across requests, so key rows per request
+        featureDict = {}
+        for i, item in enumerate(items):
+            for file, rows in item["features"].items():
+                featureDict[(i, file)] = rows
+
+        try:
+            with self.modelLock:
+                resultDict, predTime = Est.predictLocal(name, featureDict)
+        except Exception as e:
+            for item in items:
+                item["error"] = e
+                item["done"].set()
+            return
+
+        self.batches += 1
+        self.requests += len(items)
+        for i, item in enumerate(items):
+            result = {file: resultDict[(i, file)] for file in item["features"]}
+            item["result"] = (result, predTime)
+            item["done"].set()
+
+    def reload(self) -> list:
+        """Re-read the checkpoints of every predictor loaded so far"""
+        with self.modelLock:
+            names = list(Est.PREDICTORS)
+            for name in names:
+                Est.getPredictor(name, reload=True)
+
+        return names
+
+
+BATCHER = None
+JOBS = DEFAULT_JOBS
+
+
+def _loadCircuit(request):
+    if "qasm" in request:
+        qc = QuantumCircuit.from_qasm_str(request["qasm"])
+        qc.name = request.get("name", "circuit")
+    elif "file" in request:
+        qc = QasmCache.getCircuit(request["file"])
+        qc.name = request["file"]
+    else:
+        raise ValueError("Request needs a qasm or file field")
+
+    return qc
+
+
+def handleQuery(request) -> dict:
+    """Run a query request, returns one record per (circuit, backend)"""
+    mode = request.get("mode", "").lower()
+    if mode not in Est.MODES:
+        raise ValueError("Unknown mode {}".format(mode))
+
+    qc = _loadCircuit(request)
+    backends = BackendStore.getProfiles(qc, int(request.get("n", DEFAULT_N)))
+
+    resultDict, execTimes = Est.runQuery(
+        qc, backends, mode, int(request.get("jobs", JOBS)), BATCHER.submit)
+
+    return {"mode": mode, "circuit": qc.name,
+            "time": [t/(10**9) for t in execTimes],
+            "results": Est.getRecords(mode, resultDict)}
+
+
+def handleStatus() -> dict:
+    return {"uptime": time.time() - START_TIME,
+            "profiles": len(BackendStore.PROFILES),
+            "predictors": list(Est.PREDICTORS),
+            "batches": BATCHER.batches,
+            "batchedRequests": BATCHER.requests,
+            "noiseCache": NoiseCache.getStats(),
+            "transpileCache": TranspileCache.getStats(),
+            "graphCache": GraphFeatures.getStats(),
+            "qasmMetricCache": CircuitFeatures.getStats(),
+            "qasmCache": QasmCache.getStats(),
+            "featureStore": FeatureStore.getStats()}
+
+
+def handle(op, request):
+    """Dispatch one request, returns (HTTP status, response dict)"""
+    try:
+        if op == "query":
+            return 200, handleQuery(request)
+        elif op == "reload":
+            return 200, {"reloaded": BATCHER.reload()}
+        elif op == "status":
+            return 200, handleStatus()
+
+        return 404, {"error": "Unknown op {}".format(op)}
+
+    except (ValueError, KeyError, OSError) as e:
+        return 400, {"error": str(e)}
+    except Exception as e:
+        sys.stderr.write("Request failed: {!r}\n".format(e))
+        return 500, {"error": repr(e)}
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    def _reply(self, status, response):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(*handle(self.path.strip("/"), {}))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as e:
+            self._reply(400, {"error": str(e)})
+            return
+
+        self._reply(*handle(self.path.strip("/"), request))
+
+    def log_message(self, format, *args):
+        sys.stderr.write("{} {}\n".format(self.address_string(), format % args))
+
+
+class UnixHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        #One JSON request per line, answered in order on the same connection
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line)
+                status, response = handle(request.pop("op", "query"), request)
+            except json.JSONDecodeError as e:
+                status, response = 400, {"error": str(e)}
+
+            response["status"] = status
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def warm(preload, noise) -> None:
+    """Load everything a query would otherwise load on first use"""
+    BackendStore.load()
+
+    for mode in preload:
+        Est.getPredictor(Est.MODE_FEATURES[mode.lower()][1])
+
+    if noise:
+        for profile in BackendStore.PROFILES:
+            NoiseCache.getNoiseModel(profile)
+
+
+def main():
+    global BATCHER, JOBS
+
+    parser = argparse.ArgumentParser(
+        description="Serve Quarry queries from a resident process.")
+    parser.add_argument(
+        '--port', type=int, help='Localhost HTTP port. (Default {})'.format(PORT), default=PORT)
+    parser.add_argument(
+        '--socket', type=str, help='Serve JSON lines on this Unix socket instead of HTTP.', default=None)
+    parser.add_argument(
+        '--preload', type=str, nargs='*', help='ML modes whose predictors are loaded at startup (p1|p2|swap_pred).', default=[])
+    parser.add_argument(
+        '--warm-noise', action='store_true', help='Build the noise model of every backend at startup.')
+    parser.add_argument(
+        '--window', type=float, help='Micro-batch window in seconds. (Default {})'.format(BATCH_WINDOW), default=BATCH_WINDOW)
+    parser.add_argument(
+        '--jobs', type=int, help='Default worker processes per query. (Default 1)', default=DEFAULT_JOBS)
+    parser.add_argument(
+        '--calibrations', type=str, help='Directory of calibration CSVs replacing the ESP, P2 and simulation error data of matching backends. (Default none)', default=None)
+    parser.add_argument(
+        '--noise-cache', type=int, help='Noise models kept in memory. (Default {})'.format(NoiseCache.MAX_ENTRIES), default=NoiseCache.MAX_ENTRIES)
+    parser.add_argument(
+        '--noise-cache-memory', type=int, help='Cap on the pickled size of cached noise models in MB. (Default none)', default=None)
+
+    args = parser.parse_args()
+
+    BackendStore.CALIBRATION_DIR = args.calibrations
+    NoiseCache.setLimits(args.noise_cache, None if args.noise_cache_memory is None
+                         else args.noise_cache_memory*(1024**2))
+    JOBS = args.jobs
+
+    #Requests run on threads, --jobs workers must not be forked from them
+    Est.POOL_CONTEXT = multiprocessing.get_context("spawn")
+    warm(args.preload, args.warm_noise)
+    BATCHER = MicroBatcher(args.window)
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixServer(args.socket, UnixHandler)
+        sys.stderr.write("Quarry serving on {}\n".format(args.socket))
+    else:
+        server = ThreadingHTTPServer((HOST, args.port), HTTPHandler)
+        sys.stderr.write("Quarry serving on http://{}:{}\n".format(HOST, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#Measures Est.py startup cost per query mode.
+#Each mode is run in a fresh interpreter under `python -X importtime` so the
+#import time of every top level package is visible, results are appended to
+#./logs/startup_<timestamp>.csv and modes over --budget fail the run.
+import subprocess
+import statistics
+import argparse
+import time
+import sys
+
+from QUtil import getTS
+
+MODES = ["esp", "simulation", "p1", "p2", "swap_pred", "swap_compile"]
+
+
+def parseImportTime(stderr: str):
+    """Total import time (s) and heaviest top level imports from -X importtime"""
+    entries = []
+    for l in stderr.splitlines():
+        if not l.startswith("import time:") or "imported package" in l:
+            continue
+
+        _, cumulative, name = l[len("import time:"):].split("|")
+        depth = len(name) - len(name.lstrip())
+        entries.append((depth, int(cumulative), name.strip()))
+
+    if not entries:
+        return 0, []
+
+    #Nested imports are indented below the package importing them
+    top = min(e[0] for e in entries)
+    topLevel = sorted([(c, n) for d, c, n in entries if d == top], reverse=True)
+
+    return sum(c for c, n in topLevel)/(10**6), topLevel[:3]
+
+
+def runMode(qasmFile: str, mode: str):
+    cmd = [sys.executable, "-X", "importtime",
+           "./src/Est.py", qasmFile, mode, "--n", "1"]
+
+    timeBegin = time.perf_counter()
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    wallTime = time.perf_counter() - timeBegin
+
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:], file=sys.stderr)
+        raise RuntimeError("{} mode failed".format(mode))
+
+    importTime, heaviest = parseImportTime(proc.stderr)
+    return importTime, wallTime, heaviest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Record Est.py import and startup time per query mode.")
+    parser.add_argument(
+        'file', type=str, nargs='?', help='QASM file to query with. (Default ./qasm/bellPair.qasm)', default="./qasm/bellPair.qasm")
+    parser.add_argument(
+        '--modes', type=str, nargs='+', help='Modes to measure. (Default all)', default=MODES)
+    parser.add_argument(
+        '--runs', type=int, help='Runs per mode, the median is reported. (Default 3)', default=3)
+    parser.add_argument(
+        '--budget', type=float, help='Fail if a mode\'s median import time exceeds this many seconds.', default=None)
+
+    args = parser.parse_args()
+
+    logFile = "./logs/startup_{}.csv".format(getTS())
+    overBudget = []
+
+    print("{:15}{:>12}{:>12}  {}".format(
+        "Mode", "Import(s)", "Wall(s)", "Heaviest imports"))
+    with open(logFile, 'w') as log:
+        log.write("mode,run,import_time,wall_clock\n")
+
+        for mode in args.modes:
+            importTimes = []
+            wallTimes = []
+            for run in range(args.runs):
+                importTime, wallTime, heaviest = runMode(args.file, mode)
+                importTimes.append(importTime)
+                wallTimes.append(wallTime)
+                log.write("{},{},{:.6f},{:.6f}\n".format(
+                    mode, run, importTime, wallTime))
+
+            importTime = statistics.median(importTimes)
+            print("{:15}{:>12.3f}{:>12.3f}  {}".format(mode, importTime, statistics.median(wallTimes),
+                                                      ", ".join("{} {:.2f}s".format(n, c/(10**6)) for c, n in heaviest)))
+
+            if args.budget is not None and importTime > args.budget:
+                overBudget.append(mode)
+
+    if overBudget:
+        print("Over startup budget of {}s: {}".format(
+            args.budget, ", ".join(overBudget)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#Analytical SWAP count estimate, without a model or a transpile.
+#Hop distances and shortest paths of every coupling map are computed once
+#and cached. A circuit's two-qubit gates (wider gates by the ones they
+#decompose into, directives and measurements skipped) are placed greedily, each
+#logical qubit next to the qubits it interacts with most, and the
+#interaction sequence is then routed on that placement: a pair d hops apart
+#costs d - 1 SWAPs, which move the first qubit along a shortest path next to
+#the second, so later gates see the updated placement.
+#
+#  python ./src/SwapEstimator.py ./qasm/SWAP_Benchmarks/ --n 10
+import numpy as np
+import threading
+import argparse
+
+import GraphFeatures
+
+#Physical qubits of highest degree tried as the first placement
+START_QUBITS = 4
+
+_DISTANCES = {}
+_DECOMPOSITIONS = {}
+_LOCK = threading.RLock()
+
+
+def getDistances(couplingMap, numQubits: int, asLists=False):
+    """
+    Hop distance and shortest path predecessor matrices of a coupling map,
+    as arrays or, for indexing one entry at a time, as nested lists.
+    """
+    from scipy.sparse.csgraph import shortest_path
+
+    key = (numQubits, tuple(sorted(map(tuple, couplingMap or []))))
+    with _LOCK:
+        if key not in _DISTANCES:
+            A = GraphFeatures.getAdjacency(
+                list(range(numQubits)), [tuple(e) for e in couplingMap or []], directed=False)
+            #SWAPs work either way round, so directions do not matter
+            dist, pred = shortest_path(
+                A, directed=False, unweighted=True, return_predecessors=True)
+            _DISTANCES[key] = (dist, pred, dist.tolist(), pred.tolist())
+
+    dist, pred, distList, predList = _DISTANCES[key]
+    return (distList, predList) if asLists else (dist, pred)
+
+
+def _getDecomposition(gate) -> list:
+    """
+    Qubit index pairs of the two qubit gates a gate on more qubits decomposes
+    into, e.g. the six CX of ccx. Cached per gate name and width.
+    """
+    from qiskit.circuit import Gate
+
+    key = (gate.name, gate.num_qubits)
+    with _LOCK:
+        if key not in _DECOMPOSITIONS:
+            definition = gate.definition
+            if definition is None:
+                #Without a definition, a chain through its qubits
+                pairs = [(i, i + 1) for i in range(gate.num_qubits - 1)]
+            else:
+                index = {q: i for i, q in enumerate(definition.qubits)}
+                pairs = []
+                for instruction, qargs, cargs in definition._data:
+                    if not isinstance(instruction, Gate) or len(qargs) < 2:
+                        continue
+                    qubits = [index[q] for q in qargs]
+                    if len(qubits) == 2:
+                        pairs.append(tuple(qubits))
+                    else:
+                        pairs += [(qubits[a], qubits[b]) for a, b in _getDecomposition(instruction)]
+            _DECOMPOSITIONS[key] = pairs
+
+    return _DECOMPOSITIONS[key]
+
+
+def getInteractions(qc) -> list:
+    """Qubit pairs of every two qubit gate, in circuit order"""
+    from qiskit.circuit import Gate
+
+    pairs = []
+    for instruction, qargs, cargs in qc._data:
+        #Directives (barrier, snapshot, delay), measure and reset need no coupling
+        if not isinstance(instruction, Gate) or len(qargs) < 2:
+            continue
+
+        qubits = [q._index for q in qargs]
+        if len(qubits) == 2:
+            pairs.append((qubits[0], qubits[1]))
+        else:
+            pairs += [(qubits[a], qubits[b]) for a, b in _getDecomposition(instruction)]
+
+    return pairs
+
+
+def placeGreedy(pairs: list, numLogical: int, dist: np.ndarray) -> np.ndarray:
+    """Layout (logical -> physical) keeping interacting qubits close"""
+    numPhysical = dist.shape[0]
+    a, b = np.asarray(pairs, dtype=np.int64).T
+    weights = np.zeros((numLogical, numLogical))
+    np.add.at(weights, (a, b), 1)
+    np.add.at(weights, (b, a), 1)
+
+    coupled = np.isfinite(dist) & (dist == 1)
+    degree = coupled.sum(axis=1)
+    starts = np.argsort(-degree, kind='stable')[:START_QUBITS]
+
+    best = None
+    for start in starts:
+        layout = np.full(numLogical, -1, dtype=np.int64)
+        free = np.ones(numPhysical, dtype=bool)
+
+        #Busiest qubit first, then always the qubit most tied to placed ones
+        q = int(np.argmax(weights.sum(axis=1)))
+        layout[q] = start
+        free[start] = False
+
+        for _ in range(numLogical - 1):
+            placed = layout >= 0
+            ties = np.where(placed, -1, weights[:, placed].sum(axis=1))
+            q = int(np.argmax(ties))
+
+            partners = np.nonzero(placed & (weights[q] > 0))[0]
+            candidates = np.nonzero(free)[0]
+            cost = weights[q, partners] @ dist[layout[partners]][:, candidates]
+            p = int(candidates[np.argmin(cost)]) if len(partners) else int(candidates[0])
+            layout[q] = p
+            free[p] = False
+
+        total = (weights*dist[layout][:, layout]).sum()
+        if best is None or total < best[1]:
+            best = (layout, total)
+
+    return best[0]
+
+
+def routeSwaps(pairs: list, layout, dist: list, pred: list):
+    """
+    SWAPs needed to run pairs in order from layout, None if unroutable.
+    dist and pred are the nested lists of getDistances(..., asLists=True).
+    """
+    layout = list(map(int, layout))
+    owner = [-1]*len(dist)
+    for q, p in enumerate(layout):
+        owner[p] = q
+
+    swaps = 0
+    for a, b in pairs:
+        pa, pb = layout[a], layout[b]
+        d = dist[pa][pb]
+        if d == float('inf'):
+            return None
+        if d <= 1:
+            continue
+
+        #Walk back from pb to recover the path pa -> pb
+        path = [pb]
+        while path[-1] != pa:
+            path.append(pred[pa][path[-1]])
+        path = path[::-1]
+
+        #Move a along the path until it sits next to b
+        for k in range(len(path) - 2):
+            u, v = path[k], path[k + 1]
+            owner[u], owner[v] = owner[v], owner[u]
+            for p in (u, v):
+                if owner[p] >= 0:
+                    layout[owner[p]] = p
+        swaps += int(d) - 1
+
+    return swaps
+
+
+def estimateSwaps(qc, profile):
+    """Estimated SWAPs to run qc on profile's coupling map, None if it does not fit"""
+    if qc.num_qubits > profile.numQubits:
+        return None
+
+    pairs = getInteractions(qc)
+    if not pairs:
+        return 0
+
+    dist, _ = getDistances(profile.couplingMap, profile.numQubits)
+    layout = placeGreedy(pairs, qc.num_qubits, dist)
+
+    return routeSwaps(pairs, layout, *getDistances(
+        profile.couplingMap, profile.numQubits, asLists=True))
+
+
+def main():
+    import BatchQuery
+    import BackendStore
+    import QasmCache
+    import Est
+    from scipy.stats import spearmanr
+
+    parser = argparse.ArgumentParser(
+        description="Compare estimated SWAP counts against compiled ones.")
+    parser.add_argument(
+        'inputs', type=str, nargs='*', help='QASM files, directories or glob patterns. (Default ./qasm/SWAP_Benchmarks/)',
+        default=["./qasm/SWAP_Benchmarks/"])
+    parser.add_argument(
+        '--n', type=int, help='Number of backend platforms per circuit. (Default 10)', default=10)
+    parser.add_argument(
+        '--jobs', type=int, help='Number of worker processes for compiling. (Default 1)', default=1)
+
+    args = parser.parse_args()
+
+    BackendStore.load()
+
+    estTime = 0
+    actTime = 0
+    errors = []
+    correlations = []
+    for qasmFile in BatchQuery.expandInputs(args.inputs):
+        qc = QasmCache.getCircuit(qasmFile)
+        qc.name = qasmFile
+        backends = BackendStore.getProfiles(qc, args.n)
+
+        resultDict, execTimes = Est.runQuery(qc, backends, "swap_est_compare", args.jobs)
+        Est.printResultsSwapCompare(resultDict, execTimes[0], execTimes[1])
+        estTime += execTimes[0]
+        actTime += execTimes[1]
+
+        #No entry when the circuit fits no backend
+        results = [r for r in resultDict.get(qc.name, {}).values()
+                   if r['PredSwaps'] is not None and r['ActSwaps'] is not None]
+        errors += [abs(r['PredSwaps'] - r['ActSwaps']) for r in results]
+        if len(results) > 1:
+            correlations.append(spearmanr([r['PredSwaps'] for r in results],
+                                          [r['ActSwaps'] for r in results]).correlation)
+
+    print("Estimated in {:.6f}(s), compiled in {:.6f}(s)".format(
+        estTime/(10**9), actTime/(10**9)))
+    if errors:
+        print("Mean absolute error: {:.3f} swaps".format(np.mean(errors)))
+    #Circuits without swaps on every backend have no rank correlation
+    correlations = [c for c in correlations if np.isfinite(c)]
+    if correlations:
+        print("Mean Spearman rank correlation: {:.3f}".format(np.mean(correlations)))
+
+
+if __name__ == "__main__":
+    main()
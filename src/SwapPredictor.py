@@ -2,11 +2,9 @@
 
 # TensorFlow and tf.keras
 import tensorflow as tf
-from sklearn import preprocessing
 from keras.models import Sequential, save_model, load_model
 #from keras.utils import plot_model
 from keras.layers import Dense, BatchNormalization
-from sklearn.model_selection import train_test_split
 from keras.activations import sigmoid
 import joblib
 
@@ -14,8 +12,8 @@ import joblib
 import pandas as pd
 import numpy as np
 
-from os import listdir
-from os.path import isfile, join
+import DatasetStore
+import PredictorBatch
 
 out_columns = {'Swaps': None}
 out_columns_sig = ['PST', 'TVD', 'L2']
@@ -25,6 +23,8 @@ checkpoint_path = "./models_V2_swap/checkpoint_{}"
 scaler_path = "./models_V2_swap/scaler.save"
 
 MODEL = None
+SCALER = None
+PREDICT_FN = None
 
 #def plot_models():
 #    load_models()
@@ -33,8 +33,10 @@ MODEL = None
 
 
 def load():
-    global MODEL
+    global MODEL, SCALER, PREDICT_FN
+    SCALER = joblib.load(scaler_path)
     MODEL = load_model(checkpoint_path.format("Swaps"))
+    PREDICT_FN = PredictorBatch.trace_predict(MODEL)
 
 
 def create_swap_model(input_size, output_size):
@@ -88,57 +90,47 @@ def create_model_sigmoid(input_size, output_size):
 
 def queryModel(X: pd.DataFrame):
     """Load in v1 model and make prediction"""
-    min_max_scaler = joblib.load(scaler_path)
-    X = X[min_max_scaler.feature_names_in_]
-    X_scale = min_max_scaler.transform(X)
+    return MODEL(scale_input(X))
 
-    return MODEL(X_scale)
 
+def scale_input(X: pd.DataFrame):
+    return PredictorBatch.scale_input(SCALER, X)
 
-def main():
 
-    files = [join(dataset_path, f) for f in listdir(
-        dataset_path) if isfile(join(dataset_path, f))]
+def queryModelBatch(X: pd.DataFrame) -> pd.DataFrame:
+    """Predict swaps for all rows of X in a single pass"""
+    return PredictorBatch.query_batch(X, SCALER, {"Swaps": PREDICT_FN})
 
-    dfs = [pd.read_csv(f) for f in files]
-    df = pd.concat(dfs)
 
-    df = df.replace([np.inf, -np.inf, np.nan], 0)
+def main():
 
-    X = df.drop(columns=out_columns)
-    Y = df[out_columns]
+    dataset = DatasetStore.openDataset(dataset_path)
+    x_columns = [c for c in dataset.columns if c not in out_columns]
 
     # Scaling
-    min_max_scaler = preprocessing.MinMaxScaler()
-    X_scale = min_max_scaler.fit_transform(X)
+    min_max_scaler = DatasetStore.fitScaler(dataset, x_columns, fillNonFinite=True)
 
     joblib.dump(min_max_scaler, scaler_path)
 
-    X_train, X_val_and_test, Y_train, Y_val_and_test = train_test_split(
-        X_scale, Y, test_size=0.3)
-    X_val, X_test, Y_val, Y_test = train_test_split(
-        X_val_and_test, Y_val_and_test, test_size=0.5)
+    rows_train, rows_val, rows_test = DatasetStore.splitRows(dataset.numRows)
 
     out_column = "Swaps"
-    Y_out = Y[[out_column]]
-    Y_train_out = Y_train[[out_column]]
-    Y_test_out = Y_test[[out_column]]
-    Y_val_out = Y_val[[out_column]]
+    train = DatasetStore.getKerasSequence(dataset, rows_train, x_columns, [out_column],
+                                          32, min_max_scaler, fillNonFinite=True)
+    val = DatasetStore.getKerasSequence(dataset, rows_val, x_columns, [out_column],
+                                        32, min_max_scaler, shuffle=False, fillNonFinite=True)
 
-    model = create_swap_model(len(X.columns), 1)
+    model = create_swap_model(len(x_columns), 1)
 
     optimizer = tf.keras.optimizers.Adam(learning_rate=0.005, decay=5e-4)
     model.compile(optimizer=optimizer,
             loss='mean_absolute_error',
             metrics=['MSE'])
 
-    hist = model.fit(X_train, Y_train_out,
-                batch_size=32, epochs=1000,
-                validation_data=(X_val, Y_val_out))
+    hist = model.fit(train, epochs=1000, validation_data=val)
 
     save_model(model=model, filepath=checkpoint_path.format(out_column))
     #plot_model(out_columns[out_column], to_file=img_path.format(out_column), show_shapes=True)
 
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,92 @@
+#Content-addressed on-disk cache of transpiled circuits.
+#Results are stored as QPY files keyed by the canonical hash of the input
+#circuit and every transpile argument that can change the output, so hits
+#are served without invoking the transpiler across modes and runs.
+from os.path import exists, join
+from qiskit import transpile, qpy
+import qiskit
+import threading
+import hashlib
+import json
+import os
+
+import CircuitHash
+
+CACHE_DIR = "./transpile_cache/"
+
+HITS = 0
+MISSES = 0
+
+
+def getKey(qc, basisGates=None, couplingMap=None, optimizationLevel=0,
+           seed=None, profile=None, initialLayout=None) -> str:
+    key = {}
+    key["circuit"] = CircuitHash.getCircuitHash(qc)
+    key["basisGates"] = sorted(basisGates) if basisGates else None
+    key["couplingMap"] = sorted(map(list, couplingMap)) if couplingMap else None
+    key["optimizationLevel"] = optimizationLevel
+    key["seed"] = seed
+    #Layout passes read calibration data when transpiling against a backend
+    key["backend"] = profile.key if profile is not None else None
+    key["qiskit"] = qiskit.__version__
+    #Only part of the key when set, so existing entries stay valid
+    if initialLayout is not None:
+        key["initialLayout"] = list(initialLayout)
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _load(path):
+    try:
+        with open(path, 'rb') as f:
+            return qpy.load(f)[0]
+
+    #Treat unreadable entries as misses, they are rewritten below
+    except Exception:
+        return None
+
+
+def _store(path, qc) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    #Threads of one process may store the same entry concurrently
+    tmpPath = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmpPath, 'wb') as f:
+        qpy.dump(qc, f)
+    os.replace(tmpPath, path)
+
+
+def getTranspiled(qc, basisGates=None, couplingMap=None, optimizationLevel=0,
+                  seed=None, profile=None, initialLayout=None, cacheDir=CACHE_DIR):
+    """
+    transpile() memoized on disk. When profile is given the circuit is
+    transpiled against the full backend, which is only instantiated on a miss.
+    initialLayout lists the physical qubit of each circuit qubit.
+    """
+    global HITS, MISSES
+
+    key = getKey(qc, basisGates, couplingMap, optimizationLevel, seed, profile, initialLayout)
+    path = join(cacheDir, key[:2], key + ".qpy")
+
+    if exists(path):
+        out_qc = _load(path)
+        if out_qc is not None:
+            HITS += 1
+            out_qc.name = qc.name
+            return out_qc
+
+    MISSES += 1
+    if profile is not None:
+        out_qc = transpile(qc, basis_gates=basisGates, optimization_level=optimizationLevel,
+                           seed_transpiler=seed, initial_layout=initialLayout,
+                           backend=profile.getBackend())
+    else:
+        out_qc = transpile(qc, basis_gates=basisGates, coupling_map=couplingMap,
+                           optimization_level=optimizationLevel, seed_transpiler=seed,
+                           initial_layout=initialLayout)
+
+    _store(path, out_qc)
+    return out_qc
+
+
+def getStats() -> dict:
+    return {"hits": HITS, "misses": MISSES}
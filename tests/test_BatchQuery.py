@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip("qiskit")
+
+import BatchQuery
+
+
+class Circuit:
+    name = None
+
+
+class Profile:
+    def __init__(self, name):
+        self.name = name
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = {"n": [], "groups": []}
+
+    def getProfiles(qc, n):
+        calls["n"].append(n)
+        return [Profile("fake_{}".format(i)) for i in range(n or 5)]
+
+    def runQuery(qc, backends, mode, jobs=1):
+        calls["groups"].append((mode, len(backends)))
+        return {}, [0]
+
+    monkeypatch.setattr(BatchQuery.QasmCache, "getCircuit", lambda path: Circuit())
+    monkeypatch.setattr(BatchQuery.BackendStore, "getProfiles", getProfiles)
+    monkeypatch.setattr(BatchQuery.Est, "runQuery", runQuery)
+    monkeypatch.setattr(BatchQuery.Est, "getRecords", lambda mode, resultDict: [])
+    return calls
+
+
+def test_cascadeRanksEveryFittingBackendTogether(calls):
+    list(BatchQuery.scoreCircuit("a.qasm", ["cascade", "esp"]))
+
+    assert calls["n"] == [None, 10]
+    assert calls["groups"] == [("cascade", 5)] + [("esp", 1)]*10
+
+
+def test_explicitCountAppliesToCascade(calls):
+    list(BatchQuery.scoreCircuit("a.qasm", ["cascade"], n=3))
+
+    assert calls["n"] == [3]
+    assert calls["groups"] == [("cascade", 3)]
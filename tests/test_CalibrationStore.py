@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("qiskit")
+noise = pytest.importorskip("qiskit.providers.aer.noise")
+
+import CalibrationStore
+import QUtil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CSV = os.path.join(ROOT, "calibration_data", "ibmq_belem_calibrations.csv")
+
+
+@pytest.fixture(scope="module")
+def calibration():
+    return CalibrationStore.readCalibration(CSV)
+
+
+@pytest.fixture(scope="module")
+def backend():
+    return QUtil.getBackendsModule().FakeBelem()
+
+
+def test_noiseModelUsesCalibrationReadout(calibration, backend):
+    model = noise.NoiseModel.from_backend(
+        CalibrationStore.calibrateBackend(backend, calibration))
+
+    p10, p01 = calibration["readout"]
+    for q in range(calibration["numQubits"]):
+        probabilities = model._local_readout_errors[(q,)].probabilities
+        assert probabilities == pytest.approx(
+            np.array([[1 - p10[q], p10[q]], [p01[q], 1 - p01[q]]]))
+
+
+def test_propertiesUseCalibrationGateErrors(calibration, backend):
+    properties = CalibrationStore.calibrateProperties(backend.properties(), calibration)
+
+    for (a, b), error in calibration["edges"]["cx"].items():
+        assert properties.gate_error("cx", [a, b]) == pytest.approx(error)
+    for q, error in enumerate(calibration["gates"]["sx"]):
+        assert properties.gate_error("sx", q) == pytest.approx(error)
+
+    #The fake backend itself is left as it was
+    assert backend.properties().gate_error("cx", [0, 1]) != pytest.approx(
+        calibration["edges"]["cx"][(0, 1)])
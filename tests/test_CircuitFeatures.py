@@ -0,0 +1,70 @@
+import os
+import pytest
+
+pytest.importorskip("qiskit")
+pd = pytest.importorskip("pandas")
+from qiskit import QuantumCircuit, transpile
+
+import CircuitFeatures
+import QUtil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASIS_GATES = ['id', 'rz', 'sx', 'x', 'cx', 'reset']
+#Circuits of qasm/ with rows in dataSets_SWAP/, QFT-15 has ccx gates
+CIRCUITS = ["Noise_Benchmarks/Adder-1", "Noise_Benchmarks/qft_n4",
+            "SWAP_Benchmarks/QFT-15", "SupermarQ/qaoa_vanilla_3"]
+
+COUNT_COLUMNS = ['id', 'rz', 'sx', 'x', 'cx', 'reset', 'measure', 'u1', 'u2', 'u3']
+CX_COLUMNS = ['CXGraphDensity', 'CXAvgConnectivity', 'CXAvgNeighborDegree', 'CXAvgClustering',
+              'CXAvgShortestPath', 'CXAverageDegree', 'CXAverageWeight', 'CXMaxWeight', 'CXMinWeight']
+QAS_COLUMNS = ['qubit_count', 'circuit_depth', 'circuit_width', 'retention_lifespan', 'gate_density',
+               'dual_gate_count', 'measurement_density', 'size_factor', 'gate_count',
+               'entanglement_variance']
+
+
+@pytest.fixture(scope="module")
+def stored():
+    return pd.concat([pd.read_csv(os.path.join(ROOT, "dataSets_SWAP", f))
+                      for f in ["opt_0.csv", "opt_2.csv"]], ignore_index=True)
+
+
+def getRows(stored, name):
+    """Original circuit, transpiled circuit and the stored SWAP rows of name"""
+    qc = QuantumCircuit.from_qasm_file(
+        os.path.join(ROOT, "qasm", name + ".qasm"))
+    out_qc = transpile(qc, basis_gates=BASIS_GATES, optimization_level=0)
+
+    #Rows are identified by their gate counts, -1 for gates outside the basis
+    counts = CircuitFeatures.extract(out_qc, BASIS_GATES)["gateCounts"]
+    select = (stored["Depth"] == out_qc.depth())
+    for c in COUNT_COLUMNS:
+        select &= (stored[c] == counts.get(c, -1))
+
+    rows = stored[select]
+    if not len(rows):
+        pytest.skip("{} is not in the stored data, transpiled differently?".format(name))
+
+    return qc, out_qc, rows
+
+
+@pytest.mark.parametrize("name", CIRCUITS)
+def test_cxMetricsMatchStoredRows(stored, name):
+    qc, out_qc, rows = getRows(stored, name)
+
+    metrics = QUtil.getCxEdgeMetrics(*CircuitFeatures.getCxEdges(qc))
+    for c in CX_COLUMNS:
+        assert rows[c].to_numpy() == pytest.approx(metrics[c]), c
+
+
+@pytest.mark.parametrize("name", CIRCUITS)
+def test_qasMetricsMatchStoredRows(stored, name):
+    try:
+        QUtil.getQASMetricModule()
+    except ImportError:
+        pytest.skip("qasm/QASMBench submodule is not checked out")
+
+    qc, out_qc, rows = getRows(stored, name)
+
+    metrics = CircuitFeatures.getQASMetrics(out_qc, name)
+    for c in QAS_COLUMNS:
+        assert rows[c].to_numpy() == pytest.approx(metrics[c]), c
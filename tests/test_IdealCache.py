@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("qiskit")
+from qiskit import QuantumCircuit
+
+import EvalMetrics as EM
+import IdealCache
+
+
+@pytest.mark.parametrize("numQubits", [11, 12])
+def test_uniformCircuitKeepsEveryOutcome(tmp_path, numQubits):
+    #Each outcome is below one shot in SAMPLE_SHOTS
+    qc = QuantumCircuit(numQubits, numQubits)
+    qc.h(range(numQubits))
+    qc.measure(range(numQubits), range(numQubits))
+
+    ideal = IdealCache.getIdealCounts(qc, cacheDir=str(tmp_path))
+    assert len(ideal) == 2**numQubits
+    assert sum(ideal.values()) == pytest.approx(1)
+
+    noisy = {"0"*numQubits: 600, "1"*numQubits: 424}
+    metrics = EM.computeMetrics(ideal, noisy, swaps=0)
+    assert all(np.isfinite(v) for v in metrics.values())
+    assert metrics["PST"] == pytest.approx(1)
@@ -0,0 +1,85 @@
+from itertools import permutations
+import numpy as np
+import pytest
+
+pytest.importorskip("qiskit")
+from qiskit import QuantumCircuit
+
+import LayoutSearch
+import TranspileCache
+
+GATE_IDS = {"rz": 0, "sx": 1, "cx": 2, "measure": 3}
+
+
+class Profile:
+    """Minimal BackendStore profile with a random success table"""
+
+    def __init__(self, couplingMap, numQubits, seed):
+        rng = np.random.default_rng(seed)
+        self.name = "test"
+        self.key = "test@{}".format(seed)
+        self.numQubits = numQubits
+        self.couplingMap = couplingMap
+        self.basisGates = list(GATE_IDS)
+        self.gateIds = GATE_IDS
+
+        n = numQubits
+        self.table = np.ones((len(GATE_IDS), n, n))
+        diagonal = np.arange(n)
+        for gate in ["rz", "sx", "measure"]:
+            self.table[GATE_IDS[gate], diagonal, diagonal] = rng.uniform(0.9, 1, n)
+        for a, b in couplingMap:
+            self.table[GATE_IDS["cx"], a, b] = rng.uniform(0.8, 1)
+
+    def getSuccessTable(self):
+        return self.table
+
+
+def getCircuit():
+    qc = QuantumCircuit(3, 3)
+    for q in range(3):
+        qc.rz(0.5, q)
+        qc.sx(q)
+    qc.cx(0, 1)
+    qc.cx(1, 2)
+    qc.cx(0, 2)
+    qc.cx(0, 1)
+    qc.measure(range(3), range(3))
+    return qc
+
+
+@pytest.fixture(autouse=True)
+def noTranspile(monkeypatch):
+    #The circuit is already in the basis gates, and the cache would hit disk
+    monkeypatch.setattr(TranspileCache, "getTranspiled", lambda qc, **kwargs: qc)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_searchLayoutMatchesBruteForce(seed):
+    #T shaped 5 qubit map, no triangle to embed the circuit's interactions on
+    profile = Profile([[0, 1], [1, 0], [1, 2], [2, 1], [1, 3], [3, 1], [3, 4], [4, 3]], 5, seed)
+    qc = getCircuit()
+
+    result = LayoutSearch.searchLayout(qc, profile)
+
+    histogram = LayoutSearch.getCircuitHistogram(qc, profile)
+    layouts = np.array(list(permutations(range(5), 3)), dtype=np.int64)
+    scores = LayoutSearch.scoreLayouts(layouts, histogram, profile)
+
+    assert result["logESP"] == pytest.approx(scores.max())
+    assert LayoutSearch.scoreLayouts(
+        np.array([result["layout"]]), histogram, profile)[0] == pytest.approx(result["logESP"])
+
+
+def test_exactSearchStopsAtTimeLimit(monkeypatch):
+    profile = Profile([[0, 1], [1, 2], [2, 3], [3, 4]], 5, 0)
+    qc = getCircuit()
+    qc.cx(1, 2)
+    histogram = LayoutSearch.getCircuitHistogram(qc, profile)
+
+    monkeypatch.setattr(LayoutSearch, "MAX_EXACT_TIME", 0)
+    assert LayoutSearch.getExactLayouts(histogram, profile) == []
+
+    result = LayoutSearch.searchLayout(qc, profile)
+    assert not result["exact"]
+    assert len(set(result["layout"])) == 3
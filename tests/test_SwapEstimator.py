@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("qiskit")
+from qiskit import QuantumCircuit
+
+import SwapEstimator
+
+
+class Profile:
+    def __init__(self, couplingMap, numQubits):
+        self.couplingMap = couplingMap
+        self.numQubits = numQubits
+
+
+LINE = Profile([[i, i + 1] for i in range(4)], 5)
+
+
+def getCircuit(barrier):
+    qc = QuantumCircuit(5, 5)
+    qc.h(0)
+    qc.cx(0, 1)
+    qc.cx(1, 3)
+    if barrier:
+        qc.barrier()
+    qc.cx(0, 4)
+    qc.cx(2, 4)
+    qc.measure(range(5), range(5))
+    return qc
+
+
+def test_barrierDoesNotChangeEstimate():
+    assert SwapEstimator.getInteractions(getCircuit(True)) == \
+        SwapEstimator.getInteractions(getCircuit(False))
+    assert SwapEstimator.estimateSwaps(getCircuit(True), LINE) == \
+        SwapEstimator.estimateSwaps(getCircuit(False), LINE)
+
+
+def test_ccxCountsItsDecomposition():
+    qc = QuantumCircuit(3)
+    qc.ccx(0, 1, 2)
+    assert SwapEstimator.getInteractions(qc) == \
+        [(1, 2), (0, 2), (1, 2), (0, 2), (0, 1), (0, 1)]